@@ -0,0 +1,190 @@
+"""
+Fusion benchmarks on synthetic movies, the results are written as JSON:
+    python benchmarks/run_benchmarks.py [--output bench_output.json] [--frames 200] [--repeat 3]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from benchmarks.synthetic_movie import create_synthetic_storage, generate_synthetic_movie
+from benchmarks.startup_benchmark import measure_startup
+from fusion_task import FusionPipeline, FUSION_VERSION
+from utils.image_utils import bb_intersection, bb_intersection_over_union, bb_smallest_area, \
+                                bb_intersection_matrix, bb_intersection_over_union_matrix, bb_smallest_area_matrix
+
+# Scene: (faces per frame, person ROIs per frame, overlap density, person scale, shot length)
+SCENES = {
+    'sparse': (2, 3, 0.5, 1.0, 1),
+    'crowded': (25, 30, 0.9, 1.0, 1),
+    'stadium': (400, 500, 0.9, 0.1, 1),
+    'dialogue': (25, 30, 0.9, 1.0, 40),
+}
+BENCH_NUM_FRAMES = 200
+BENCH_REPEAT = 3
+BENCH_OUTPUT = "bench_output.json"
+TEMPORAL_COUNTERS = ('frames_propagated', 'frames_partially_rescored', 'frames_fully_scored', 'pairs_reused')
+
+
+def best_time(fn, repeat):
+    """
+    Returns the best wall time of `repeat` calls of `fn`, and the result of the last call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def peak_memory(fn):
+    """
+    Returns the peak traced memory (bytes) of one call of `fn`.
+    """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_fusion_pipeline(scene, num_frames, repeat, temporal_tolerance=None):
+    faces_per_frame, rois_per_frame, overlap_density, person_scale, shot_length = SCENES[scene]
+    movie_id = "Movies/bench_{}".format(scene)
+    storage = create_synthetic_storage([movie_id], num_frames, faces_per_frame, rois_per_frame, overlap_density,
+                                       person_scale=person_scale, shot_length=shot_length)
+    with contextlib.redirect_stdout(io.StringIO()):
+        fusion_pipeline = FusionPipeline(incremental=False, storage=storage, temporal_tolerance=temporal_tolerance)
+        run = lambda: fusion_pipeline.run_fusion_pipeline(movie_id)
+        seconds, result = best_time(run, repeat)
+        peak_bytes = peak_memory(run)
+    results = {
+        'seconds': seconds,
+        'frames': num_frames,
+        'frames_per_second': num_frames / seconds,
+        'peak_traced_bytes': peak_bytes,
+        'success': result[0],
+    }
+    if temporal_tolerance is not None:
+        counters = fusion_pipeline.last_run_report['counters']
+        results['temporal'] = {name: counters.get(name, 0) for name in TEMPORAL_COUNTERS}
+    return results
+
+
+def bench_correct_matches(scene, num_frames, repeat):
+    faces_per_frame, rois_per_frame, overlap_density, person_scale, shot_length = SCENES[scene]
+    reid_doc, vc_docs = generate_synthetic_movie("Movies/bench", num_frames, faces_per_frame, rois_per_frame,
+                                                 overlap_density, person_scale=person_scale, shot_length=shot_length)
+    with contextlib.redirect_stdout(io.StringIO()):
+        fusion_pipeline = FusionPipeline(storage=create_synthetic_storage([], 0, 0, 0, 0))
+    frames_matches = [fusion_pipeline.find_candidates(frame['re-id'], vc_doc['roi'])
+                      for frame, vc_doc in zip(reid_doc['frames'], vc_docs)]
+    num_pairs = sum(len(matches) for matches in frames_matches)
+    seconds, _ = best_time(lambda: [fusion_pipeline.correct_matches(matches) for matches in frames_matches], repeat)
+    return {
+        'seconds': seconds,
+        'candidate_pairs': num_pairs,
+        'pairs_per_second': num_pairs / seconds if seconds else None,
+        'frames_per_second': num_frames / seconds,
+    }
+
+
+def bench_box_functions(scene, num_frames, repeat):
+    """
+    Scores all the face x ROI pairs of every frame, with the scalar and with the matrix box functions.
+    """
+    faces_per_frame, rois_per_frame, overlap_density, person_scale, shot_length = SCENES[scene]
+    reid_doc, vc_docs = generate_synthetic_movie("Movies/bench", num_frames, faces_per_frame, rois_per_frame,
+                                                 overlap_density, person_scale=person_scale, shot_length=shot_length)
+    frames = []
+    for frame, vc_doc in zip(reid_doc['frames'], vc_docs):
+        face_bboxes = [face['bbox'] for face in frame['re-id']]
+        vc_bboxes = [json.loads(vc_roi['bbox']) for vc_roi in vc_doc['roi']]
+        frames.append((face_bboxes, vc_bboxes))
+    num_pairs = num_frames * faces_per_frame * rois_per_frame
+
+    def scalar():
+        for face_bboxes, vc_bboxes in frames:
+            for face_bbox in face_bboxes:
+                for vc_bbox in vc_bboxes:
+                    bb_intersection(face_bbox, vc_bbox)
+                    bb_smallest_area(face_bbox, vc_bbox)
+                    bb_intersection_over_union(face_bbox, vc_bbox)
+
+    def matrix():
+        for face_bboxes, vc_bboxes in frames:
+            face_bboxes = np.asarray(face_bboxes, dtype=np.float64)
+            vc_bboxes = np.asarray(vc_bboxes, dtype=np.float64)
+            bb_intersection_matrix(face_bboxes, vc_bboxes)
+            bb_smallest_area_matrix(face_bboxes, vc_bboxes)
+            bb_intersection_over_union_matrix(face_bboxes, vc_bboxes)
+
+    results = {'pairs': num_pairs}
+    for name, fn in [('scalar', scalar), ('matrix', matrix)]:
+        seconds, _ = best_time(fn, repeat)
+        results[name] = {'seconds': seconds, 'pairs_per_second': num_pairs / seconds}
+    return results
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(num_frames=BENCH_NUM_FRAMES, repeat=BENCH_REPEAT, scenes=None):
+    report = {
+        'git_revision': get_git_revision(),
+        'fusion_version': FUSION_VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'num_frames': num_frames,
+        'repeat': repeat,
+        'startup': measure_startup(),
+        'scenes': {},
+    }
+    for scene in (scenes or SCENES):
+        faces_per_frame, rois_per_frame, overlap_density, person_scale, shot_length = SCENES[scene]
+        print("Benchmarking scene: {}".format(scene))
+        report['scenes'][scene] = {
+            'faces_per_frame': faces_per_frame,
+            'rois_per_frame': rois_per_frame,
+            'overlap_density': overlap_density,
+            'person_scale': person_scale,
+            'shot_length': shot_length,
+            'run_fusion_pipeline': bench_fusion_pipeline(scene, num_frames, repeat),
+            'run_fusion_pipeline_temporal': bench_fusion_pipeline(scene, num_frames, repeat, temporal_tolerance=0),
+            'correct_matches': bench_correct_matches(scene, num_frames, repeat),
+            'box_functions': bench_box_functions(scene, num_frames, repeat),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fusion benchmarks on synthetic movies")
+    parser.add_argument('--output', default=BENCH_OUTPUT)
+    parser.add_argument('--frames', type=int, default=BENCH_NUM_FRAMES)
+    parser.add_argument('--repeat', type=int, default=BENCH_REPEAT)
+    parser.add_argument('--scene', action='append', choices=sorted(SCENES))
+    args = parser.parse_args()
+    report = run_benchmarks(args.frames, args.repeat, args.scene)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print("Benchmark results written to: {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
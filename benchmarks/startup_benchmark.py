@@ -0,0 +1,84 @@
+"""
+Cold start benchmark: the time to import `fusion_task` and to construct a `FusionPipeline`, in fresh interpreters.
+    python benchmarks/startup_benchmark.py [--repeat 5] [--max-import-seconds 1.0] [--max-init-seconds 0.5]
+Exits with 1 when a budget is exceeded or when a rendering dependency is imported by the matching core.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_REPEAT = 5
+# Only the QA rendering path may import these, and the database is connected on first use.
+HEAVY_MODULES = ('cv2', 'PIL', 'requests', 'tqdm', 'csv', 'database.arangodb')
+MAX_IMPORT_SECONDS = 1.0
+MAX_INIT_SECONDS = 0.5
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import fusion_task
+imported = time.perf_counter()
+fusion_task.FusionPipeline()
+initialized = time.perf_counter()
+print(json.dumps({
+    'import_seconds': imported - start,
+    'init_seconds': initialized - imported,
+    'heavy_modules': [name for name in %r if name in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_startup_once():
+    """
+    Imports fusion_task and constructs a FusionPipeline in a fresh interpreter, returns its timings.
+    """
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], cwd=REPO_ROOT)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure_startup(repeat=STARTUP_REPEAT):
+    """
+    The best import and init times of `repeat` cold starts (the OS file cache is warm after the first one).
+    """
+    runs = [measure_startup_once() for _ in range(repeat)]
+    return {
+        'repeat': repeat,
+        'import_seconds': min(run['import_seconds'] for run in runs),
+        'init_seconds': min(run['init_seconds'] for run in runs),
+        'heavy_modules': sorted(set(name for run in runs for name in run['heavy_modules'])),
+    }
+
+
+def check_startup(report, max_import_seconds=MAX_IMPORT_SECONDS, max_init_seconds=MAX_INIT_SECONDS):
+    """
+    Returns the list of the budget violations of a `measure_startup` report.
+    """
+    errors = []
+    if report['import_seconds'] > max_import_seconds:
+        errors.append("import took {:.3f}s, the budget is {}s".format(report['import_seconds'], max_import_seconds))
+    if report['init_seconds'] > max_init_seconds:
+        errors.append("FusionPipeline() took {:.3f}s, the budget is {}s".format(report['init_seconds'],
+                                                                              max_init_seconds))
+    if report['heavy_modules']:
+        errors.append("the matching core imported: {}".format(", ".join(report['heavy_modules'])))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fusion cold start benchmark")
+    parser.add_argument('--repeat', type=int, default=STARTUP_REPEAT)
+    parser.add_argument('--max-import-seconds', type=float, default=MAX_IMPORT_SECONDS)
+    parser.add_argument('--max-init-seconds', type=float, default=MAX_INIT_SECONDS)
+    args = parser.parse_args()
+    report = measure_startup(args.repeat)
+    errors = check_startup(report, args.max_import_seconds, args.max_init_seconds)
+    report['errors'] = errors
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
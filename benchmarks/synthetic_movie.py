@@ -0,0 +1,78 @@
+import random
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.fusion_storage import InMemoryStorage, REID_COLLECTION_NAME, VISUAL_CLUES_COLLECTION_NAME
+
+FRAME_WIDTH = 1280
+FRAME_HEIGHT = 720
+FRAME_STEP = 10
+
+
+def _random_person_box(rnd, person_scale=1.0):
+    width = max(4, int(rnd.randint(60, 300) * person_scale))
+    height = max(8, int(rnd.randint(150, FRAME_HEIGHT - 20) * person_scale))
+    x1 = rnd.randint(0, FRAME_WIDTH - width - 1)
+    y1 = rnd.randint(0, FRAME_HEIGHT - height - 1)
+    return [float(x1), float(y1), float(x1 + width), float(y1 + height)]
+
+
+def _random_face_box(rnd, person_box=None):
+    """
+    A face inside the upper part of `person_box`, or anywhere in the frame.
+    """
+    size = rnd.randint(15, 50)
+    if person_box is None:
+        x1 = rnd.randint(0, FRAME_WIDTH - size - 1)
+        y1 = rnd.randint(0, FRAME_HEIGHT - size - 1)
+    else:
+        px1, py1, px2, py2 = [int(xy) for xy in person_box]
+        size = min(size, px2 - px1, py2 - py1)
+        x1 = rnd.randint(px1, px2 - size)
+        y1 = rnd.randint(py1, py1 + max(0, (py2 - py1) // 4 - size) + 1)
+    return [x1, y1, x1 + size, y1 + size]
+
+
+def generate_synthetic_movie(movie_id, num_frames, faces_per_frame, rois_per_frame, overlap_density, seed=0,
+                             person_scale=1.0, shot_length=1):
+    """
+    Returns the (s4_re_id document, s4_visual_clues documents) of a synthetic movie.
+    Every frame has `rois_per_frame` person ROIs and `faces_per_frame` RE-ID faces,
+    a face lies inside one of the ROIs with probability `overlap_density`.
+    `person_scale` scales the person boxes, e.g. 0.1 for a stadium shot.
+    The boxes only change every `shot_length` frames, e.g. 30 for static dialogue shots.
+    """
+    rnd = random.Random(seed)
+    reid_doc = {'movie_id': movie_id, 'frames': []}
+    vc_docs = []
+    for frame_idx in range(num_frames):
+        frame_num = frame_idx * FRAME_STEP + 1
+        if frame_idx % shot_length == 0:
+            person_boxes = [_random_person_box(rnd, person_scale) for _ in range(rois_per_frame)]
+            face_boxes = []
+            for _ in range(faces_per_frame):
+                person_box = rnd.choice(person_boxes) if person_boxes and rnd.random() < overlap_density else None
+                face_boxes.append(_random_face_box(rnd, person_box))
+        vc_rois = [{'roi_id': roi_id, 'bbox': str(person_box), 'bbox_object': 'person'}
+                   for roi_id, person_box in enumerate(person_boxes)]
+        faces = [{'id': face_id, 'bbox': list(face_box), 'actor_name': 'actor_{}'.format(face_id)}
+                 for face_id, face_box in enumerate(face_boxes)]
+        reid_doc['frames'].append({'frame_num': frame_num, 're-id': faces})
+        vc_docs.append({'movie_id': movie_id, 'frame_num': frame_num, 'roi': vc_rois,
+                        'url': '/synthetic/{}/frame{:04d}.jpg'.format(movie_id.replace('/', '_'), frame_num)})
+    return reid_doc, vc_docs
+
+
+def create_synthetic_storage(movie_ids, num_frames, faces_per_frame, rois_per_frame, overlap_density, seed=0,
+                             person_scale=1.0, shot_length=1):
+    """
+    An InMemoryStorage with the RE-ID and Visual Clues documents of synthetic movies.
+    """
+    collections = {REID_COLLECTION_NAME: [], VISUAL_CLUES_COLLECTION_NAME: []}
+    for idx, movie_id in enumerate(movie_ids):
+        reid_doc, vc_docs = generate_synthetic_movie(movie_id, num_frames, faces_per_frame, rois_per_frame,
+                                                     overlap_density, seed=seed + idx, person_scale=person_scale,
+                                                     shot_length=shot_length)
+        collections[REID_COLLECTION_NAME].append(reid_doc)
+        collections[VISUAL_CLUES_COLLECTION_NAME].extend(vc_docs)
+    return InMemoryStorage(collections)
@@ -0,0 +1,112 @@
+"""
+Resumable fusion backfill: queues movies in a durable SQLite job queue (see utils/job_queue.py) and fuses them
+with worker processes that checkpoint every flushed batch of frames. A killed backfill is resumed by running
+it again, and more workers (on this or on other hosts sharing the queue file) can join with --no-enqueue.
+    python fusion_backfill.py --queue backfill.sqlite [--tag v100 | --movies id1,id2] [--num-workers 4]
+                              [--no-enqueue] [--force]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from fusion_task import FusionPipeline, FUSION_NUM_WORKERS
+from utils.job_queue import FusionJobQueue, default_worker_id, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS
+from utils.fusion_logging import get_logger, configure_fusion_logging, configured_level
+
+FUSION_JOB_QUEUE_PATH = os.environ.get("FUSION_JOB_QUEUE_PATH", "fusion_backfill.sqlite")
+PIPELINES_COLLECTION_NAME = "pipelines"
+
+logger = get_logger("backfill")
+
+
+def drain_queue(queue_path, fusion_pipeline=None, force=False, lease_seconds=JOB_LEASE_SECONDS,
+                max_attempts=JOB_MAX_ATTEMPTS, worker_id=None):
+    """
+    Claims and fuses movies until the queue has none left, returns the number of fused movies.
+    The lease of the current movie is renewed by a heartbeat while it is fused.
+    """
+    worker_id = worker_id or default_worker_id()
+    fusion_pipeline = fusion_pipeline or FusionPipeline()
+    num_movies = 0
+    with FusionJobQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts) as job_queue:
+        while True:
+            movie_id = job_queue.claim(worker_id)
+            if movie_id is None:
+                return num_movies
+            with job_queue.heartbeat(movie_id, worker_id):
+                try:
+                    is_success, output = fusion_pipeline.run_fusion_pipeline(
+                        movie_id, force=force, checkpoint=job_queue.checkpoint(movie_id, worker_id))
+                except Exception as e:
+                    logger.exception("Movie ID %s failed", movie_id)
+                    is_success, output = False, "{}: {}".format(type(e).__name__, e)
+            if is_success:
+                is_held = job_queue.complete(movie_id, worker_id)
+            else:
+                is_held = job_queue.fail(movie_id, worker_id, output or "The fusion failed")
+            if not is_held:
+                # Another worker claimed the movie after the lease expired, it is counted there.
+                logger.warning("Lost the lease of Movie ID %s, it is fused by another worker", movie_id)
+            elif is_success:
+                num_movies += 1
+
+
+def _drain_queue_worker(args):
+    queue_path, force, lease_seconds, max_attempts, log_level = args
+    if log_level is not None:
+        configure_fusion_logging(log_level)
+    return drain_queue(queue_path, force=force, lease_seconds=lease_seconds, max_attempts=max_attempts)
+
+
+def run_backfill(queue_path, num_workers=FUSION_NUM_WORKERS, force=False, lease_seconds=JOB_LEASE_SECONDS,
+                 max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Drains the queue with `num_workers` processes (the current one when `num_workers` <= 1).
+    """
+    args = (queue_path, force, lease_seconds, max_attempts, configured_level())
+    if num_workers <= 1:
+        return _drain_queue_worker(args)
+    # Spawn (and not fork) so no database connection or writer thread is shared with the parent.
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=num_workers) as pool:
+        return sum(pool.map(_drain_queue_worker, [args] * num_workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable fusion backfill")
+    parser.add_argument('--queue', default=FUSION_JOB_QUEUE_PATH, help="the SQLite job queue file")
+    parser.add_argument('--tag', help="queue the movies of the pipelines with this benchmark tag")
+    parser.add_argument('--movies', help="queue these comma separated movie ids")
+    parser.add_argument('--no-enqueue', action='store_true', help="only drain the movies already queued")
+    parser.add_argument('--num-workers', type=int, default=FUSION_NUM_WORKERS)
+    parser.add_argument('--force', action='store_true', help="recompute the frames whose inputs didn't change")
+    parser.add_argument('--lease-seconds', type=float, default=JOB_LEASE_SECONDS)
+    parser.add_argument('--max-attempts', type=int, default=JOB_MAX_ATTEMPTS)
+    args = parser.parse_args()
+    configure_fusion_logging()
+
+    with FusionJobQueue(args.queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts) as job_queue:
+        if not args.no_enqueue:
+            movie_ids = []
+            if args.tag:
+                movie_ids += FusionPipeline().get_movie_ids_by_tag(args.tag, PIPELINES_COLLECTION_NAME)
+            if args.movies:
+                movie_ids += [movie_id for movie_id in args.movies.split(",") if movie_id]
+            logger.info("Queued %d of %d movies", job_queue.enqueue(movie_ids), len(movie_ids))
+
+    num_movies = run_backfill(args.queue, num_workers=args.num_workers, force=args.force,
+                              lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+
+    with FusionJobQueue(args.queue) as job_queue:
+        stats = job_queue.stats()
+        failed_movies = job_queue.failed_movies()
+    logger.info("Fused %d movies, queue: %s", num_movies, json.dumps(stats))
+    if failed_movies:
+        logger.error("%d movies failed: %s", len(failed_movies), json.dumps(failed_movies))
+    sys.exit(1 if failed_movies else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Ground-truth evaluation of the fusion: fuses a movie set in parallel, without writing to s4_fusion,
+and reports the face <-> person assignment precision and recall against s4_fusion_groundtruth.
+    python fusion_evaluation.py [--movies groundtruth|training] [--num-workers 4] [--output eval_output.json]
+                                [--baseline eval_output.json]
+Set FUSION_SNAPSHOT_DIR to evaluate on recorded inputs (see utils/fusion_storage.py) instead of ArangoDB.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from fusion_task import FusionPipeline, run_movies_in_pool, FUSION_NUM_WORKERS, REID_COLLECTION_NAME
+from utils.fusion_config import GROUND_TRUTH_MOVIE_IDS, TRAINING_SET_MOVIE_IDS
+from utils.fusion_storage import create_storage
+from utils.ground_truth import load_ground_truth
+from utils.fusion_logging import get_logger, configure_fusion_logging
+
+MOVIE_SETS = {
+    'groundtruth': GROUND_TRUTH_MOVIE_IDS,
+    'training': TRAINING_SET_MOVIE_IDS,
+}
+EVAL_OUTPUT = "eval_output.json"
+# The unmatched person ROIs are stored with this face id.
+UNMATCHED_FACE_ID = "-1"
+
+logger = get_logger("evaluation")
+
+
+def predict_movie(fusion_pipeline, movie_id):
+    """
+    Fuses a movie like `run_fusion_pipeline` (never incrementally) but keeps the s4_fusion documents in memory.
+    Returns (True, {'frames': documents, 'report': the run report}) or (False, error message).
+    """
+    fusion_pipeline.start_metrics(movie_id)
+    is_success, output = fusion_pipeline.finish_metrics(_predict_movie(fusion_pipeline, movie_id))
+    if is_success:
+        output = {'frames': output, 'report': fusion_pipeline.last_run_report}
+    return is_success, output
+
+
+def _predict_movie(fusion_pipeline, movie_id):
+    reid_detections = fusion_pipeline.get_reid_detections(movie_id=movie_id, collection=REID_COLLECTION_NAME)
+    if not reid_detections:
+        return False, "REID detections were not found"
+    fusion_pipeline.build_reid_index(movie_id, collection=REID_COLLECTION_NAME, reid_detections=reid_detections)
+    empty_idx = fusion_pipeline.find_empty_reid_frame(reid_detections)
+    if empty_idx is not None:
+        data_for_db = fusion_pipeline.fuse_empty_reid_movie(movie_id, reid_detections, empty_idx)
+        if data_for_db is None:
+            return False, "VISUAL CLUES DATA was not found"
+        return True, [data_for_db]
+    frames = fusion_pipeline.read_fusion_frames(movie_id, reid_detections)
+    fusion_docs = fusion_pipeline.generate_fusion_docs(movie_id, fusion_pipeline.generate_frame_candidates(frames))
+    frame_docs = []
+    try:
+        for frame_num, data_for_db in fusion_docs:
+            if data_for_db is None:
+                return False, "VISUAL CLUES DATA was not found, frame: {}".format(frame_num)
+            frame_docs.append(data_for_db)
+    finally:
+        fusion_docs.close()
+    return True, frame_docs
+
+
+def frame_assignments(frame_docs):
+    """
+    The set of (frame_num, face_id, vc_id) face <-> person assignments of s4_fusion documents.
+    """
+    assignments = set()
+    for frame_doc in frame_docs:
+        for roi in frame_doc.get('rois', []):
+            face_id = str(roi.get('face_id', UNMATCHED_FACE_ID))
+            if face_id != UNMATCHED_FACE_ID:
+                assignments.add((int(frame_doc['frame_num']), face_id, str(roi['vc_id'])))
+    return assignments
+
+
+def precision_recall(true_positives, false_positives, false_negatives):
+    num_predicted = true_positives + false_positives
+    num_expected = true_positives + false_negatives
+    return {
+        'true_positives': true_positives,
+        'false_positives': false_positives,
+        'false_negatives': false_negatives,
+        'precision': true_positives / num_predicted if num_predicted else None,
+        'recall': true_positives / num_expected if num_expected else None,
+    }
+
+
+def score_assignments(predicted, expected):
+    return precision_recall(len(predicted & expected), len(predicted - expected), len(expected - predicted))
+
+
+def evaluate_movies(movie_ids, num_workers=FUSION_NUM_WORKERS, storage=None):
+    """
+    Fuses the movies with a pool of `num_workers` processes and scores them against the ground truth.
+    With a `storage` the movies run in the current process on it, the workers use `create_storage()`.
+    """
+    storage = storage if storage is not None else create_storage()
+    ground_truth = load_ground_truth(storage, movie_ids)
+    fusion_pipeline = FusionPipeline(incremental=False, storage=storage) if num_workers <= 1 else None
+    start = time.perf_counter()
+    results = run_movies_in_pool(predict_movie, movie_ids, num_workers=num_workers, fusion_pipeline=fusion_pipeline,
+                                 incremental=False)
+    wall_seconds = time.perf_counter() - start
+
+    report = {
+        'num_movies': len(movie_ids),
+        'num_workers': num_workers,
+        'wall_seconds': wall_seconds,
+        'movies': {},
+        'failed_movies': {},
+        'missing_ground_truth': [],
+    }
+    totals = [0, 0, 0]
+    num_frames = 0
+    for movie_id, (is_success, output) in results:
+        if not is_success:
+            report['failed_movies'][movie_id] = output
+            continue
+        num_frames += output['report']['counters'].get('frames_processed', 0)
+        if movie_id not in ground_truth:
+            report['missing_ground_truth'].append(movie_id)
+            continue
+        scores = score_assignments(frame_assignments(output['frames']), frame_assignments(ground_truth[movie_id]))
+        scores['seconds'] = output['report']['wall_seconds']
+        report['movies'][movie_id] = scores
+        totals = [total + scores[name] for total, name in
+                  zip(totals, ('true_positives', 'false_positives', 'false_negatives'))]
+    report['aggregate'] = precision_recall(*totals)
+    report['frames_per_second'] = num_frames / wall_seconds if wall_seconds else None
+    report['movies_per_second'] = len(movie_ids) / wall_seconds if wall_seconds else None
+    return report
+
+
+def compare_to_baseline(report, baseline):
+    """
+    Returns the movies whose assignment counts differ from the baseline report.
+    """
+    changed = {}
+    for movie_id, scores in report['movies'].items():
+        baseline_scores = baseline.get('movies', {}).get(movie_id)
+        if baseline_scores is None:
+            continue
+        for name in ('true_positives', 'false_positives', 'false_negatives'):
+            if scores[name] != baseline_scores[name]:
+                changed[movie_id] = {'baseline': baseline_scores, 'current': scores}
+                break
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fusion evaluation against the ground truth")
+    parser.add_argument('--movies', default='groundtruth', choices=sorted(MOVIE_SETS))
+    parser.add_argument('--num-workers', type=int, default=FUSION_NUM_WORKERS)
+    parser.add_argument('--output', default=EVAL_OUTPUT)
+    parser.add_argument('--baseline', help="a previous evaluation report, fails when an assignment count changed")
+    args = parser.parse_args()
+    configure_fusion_logging()
+
+    report = evaluate_movies(MOVIE_SETS[args.movies], num_workers=args.num_workers)
+    report['movie_set'] = args.movies
+    changed = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            changed = compare_to_baseline(report, json.load(f))
+        report['changed_movies'] = changed
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    aggregate = report['aggregate']
+    logger.info("Evaluated %d movies (%d failed, %d without ground truth) in %.1fs: precision %s, recall %s",
+                report['num_movies'], len(report['failed_movies']), len(report['missing_ground_truth']),
+                report['wall_seconds'], aggregate['precision'], aggregate['recall'])
+    if changed:
+        logger.error("The assignments of %d movies changed from the baseline: %s", len(changed), sorted(changed))
+    logger.info("Evaluation report written to: %s", args.output)
+    sys.exit(1 if changed else 0)
+
+
+if __name__ == '__main__':
+    main()
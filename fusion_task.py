@@ -1,179 +1,616 @@
 import numpy as np
-from database.arangodb import DBBase
-import cv2
-from pathlib import Path
-import csv
-
-import tqdm
-from PIL import Image
 import time
 import random
 import os, sys
-import ast
-from utils.image_utils import bb_intersection_over_union, bb_intersection, \
-                                bb_smallest_area, plot_one_box, save_img_with_bboxes, \
-                                    bb_hueristic_face_coordinate, bb_center_coordinate, \
-                                        distance_between_two_points
+import multiprocessing
+import asyncio
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+from utils.image_utils import bb_intersection_matrix, bb_intersection_pairs, bb_smallest_area_pairs, \
+                                bb_intersection_over_union_pairs, bb_overlapping_pairs, bb_center_coordinates, \
+                                    bb_hueristic_face_coordinates, distances_between_points
+from utils.fusion_writer import FusionDocWriter
+from utils.stage_pipeline import bounded_stage
+from utils.fusion_records import CANDIDATE_DTYPE, FrameCandidates, FrameFaces, FrameRois
+from utils.fusion_storage import create_storage
+from utils.fusion_metrics import FusionMetrics, MeteredStorage, write_prometheus_textfile, doc_size
+from utils.fusion_memory import MemoryProfile, FUSION_MEMORY_PROFILE
+from utils.fusion_export import MovieExport, FUSION_EXPORT_FORMAT, FUSION_EXPORT_DIR, FUSION_EXPORT_ONLY
+from utils.doc_cache import DocCache, CachedStorage, query_key
+from utils.ground_truth import GROUND_TRUTH_COLLECTION_NAME, ground_truth_doc, load_ground_truth
+from utils.fusion_logging import get_logger, SampledLogger, configure_fusion_logging, configured_level
 
 # from visual_clues.bboxes_implementation import DetectronBBInitter
 
 URL_PREFIX = "http://74.82.29.209:9000"
 CUR_FOLDER = os.path.dirname(os.path.abspath(__file__))
 INTERSECTION_THRESHOLD = 0.97
+# Frames with at least this many face x ROI pairs are scored through a grid index (`bb_overlapping_pairs`),
+# smaller frames score all their pairs at once.
+SPATIAL_INDEX_MIN_PAIRS = 16384
 CELEBRITY_PATH = os.path.join(os.path.join(CUR_FOLDER, "data"), "list_of_celebrities.txt")
 REID_COLLECTION_NAME = "s4_re_id"
 VISUAL_CLUES_COLLECTION_NAME = "s4_visual_clues"
+VC_PREFETCH_BATCH_SIZE = 500
+# The benchmark tag of the pipeline documents, see `get_movie_ids_by_tag`.
+BENCHMARK_TAG_ATTRIBUTE = "inputs.videoprocessing.benchmark.benchmark_tag"
+# Part of every frame's input fingerprint, bump it when the fusion output changes for the same inputs.
+# 2: the match conflicts are resolved by the rules of `resolve_match_conflicts`.
+FUSION_VERSION = 2
+FUSION_WRITE_BATCH_SIZE = 200
+FUSION_WRITE_FLUSH_INTERVAL = 5.0
+FUSION_WRITE_MAX_QUEUE_SIZE = 1000
+FUSION_STREAM_WINDOW_SIZE = 32
+FUSION_ASYNC_MAX_CONCURRENCY = 8
+FUSION_ASYNC_LOOKAHEAD = 16
+FUSION_NUM_WORKERS = int(os.environ.get("FUSION_NUM_WORKERS", 1))
+# When set, the metrics of every fused movie are written to this Prometheus textfile.
+FUSION_METRICS_TEXTFILE = os.environ.get("FUSION_METRICS_TEXTFILE")
+# When set, the faces and person ROIs that kept their id and moved at most this many pixels since the previous
+# frame reuse its scores (see `propagate_frame_candidates`). 0 reuses only the unchanged boxes, and is exact.
+FUSION_TEMPORAL_TOLERANCE = os.environ.get("FUSION_TEMPORAL_TOLERANCE")
+FUSION_TEMPORAL_TOLERANCE = float(FUSION_TEMPORAL_TOLERANCE) if FUSION_TEMPORAL_TOLERANCE else None
+
+logger = get_logger("task")
+sampled_logger = SampledLogger(logger)
 
 class FusionPipeline:
-    def __init__(self):
-        self.nre = DBBase()
-        print("Connected to database: {}".format(self.nre.database))
+    def __init__(self, prefetch_visual_clues=True, write_batch_size=FUSION_WRITE_BATCH_SIZE,
+                 write_flush_interval=FUSION_WRITE_FLUSH_INTERVAL, incremental=True, storage=None,
+                 temporal_tolerance=FUSION_TEMPORAL_TOLERANCE, memory_profile=FUSION_MEMORY_PROFILE,
+                 export_format=FUSION_EXPORT_FORMAT, export_dir=FUSION_EXPORT_DIR, export_only=FUSION_EXPORT_ONLY):
+        # The documents storage (see utils/fusion_storage.py), ArangoDB unless FUSION_SNAPSHOT_DIR is set.
+        # Every database call is counted into `self.metrics`, the timings and counters of the current movie.
+        self.metrics = FusionMetrics()
+        self.metered_storage = MeteredStorage(storage if storage is not None else create_storage(), self.metrics)
+        # The lookups of the movie and pipeline documents, repeated across movies, are served from `self.doc_cache`
+        # (see utils/doc_cache.py), which is bounded, so a long-lived worker can fuse any number of movies.
+        self.doc_cache = DocCache()
+        self.storage = CachedStorage(self.metered_storage, self.doc_cache, self.metrics)
         self.collection_name = "s4_fusion"
         self.celebrity_data = self.get_celebrity_data()
+        # When enabled, the Visual Clues frames of a movie are read with one query: in frame order next to the
+        # RE-ID frames by the stream (see `read_fusion_frames`), all at once into `self.visual_clues_snapshot`
+        # for the per-frame lookups of the ground truth fusion.
+        self.prefetch_visual_clues = prefetch_visual_clues
+        self.visual_clues_snapshot = None
+        # Per-movie RE-ID view: frame_num -> (face ids, actor names, bboxes), built once per movie.
+        self.reid_index = None
+        # Fusion documents are written behind the compute loop, in batches.
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        # Skip the frames whose s4_fusion document was fused from the same inputs (see `frame_fingerprint`).
+        self.incremental = incremental
+        # Carry the scores and matches of the previous frame forward, None scores every frame on its own.
+        self.temporal_tolerance = temporal_tolerance
+        # Account the memory of every movie into its report (see utils/fusion_memory.py), slows the fusion down.
+        self.memory_profile = memory_profile
+        # Every fused movie is also exported as one columnar file (see utils/fusion_export.py) when a format is set,
+        # and with `export_only` instead of the s4_fusion documents. Exported movies are never fused incrementally.
+        self.export_format = export_format
+        self.export_dir = export_dir
+        self.export_only = export_only and bool(export_format)
+        self.movie_export = None
+        self.last_run_stats = None
+        self.last_run_report = None
+
+    def start_metrics(self, movie_id):
+        if self.metrics.memory is not None:
+            # The previous movie was not finished with `finish_metrics`.
+            self.metrics.memory.stop()
+        memory = None
+        if self.memory_profile:
+            memory = MemoryProfile(movie_id)
+            memory.start()
+        self.metrics = FusionMetrics(movie_id, memory=memory)
+        self.movie_export = MovieExport(movie_id, self.export_format, self.export_dir) if self.export_format else None
+        self.metered_storage.metrics = self.metrics
+        self.storage.metrics = self.metrics
+        self.last_run_stats = None
+
+    def finish_metrics(self, result, return_report=False):
+        """
+        Builds the JSON report of the movie (see utils/fusion_metrics.py) into `self.last_run_report`,
+        returns the (bool, str) result, followed by the report if `return_report`.
+        """
+        if self.movie_export is not None:
+            if result[0]:
+                with self.metrics.stage('export_write'):
+                    path = self.movie_export.write()
+                logger.info("Exported %d rows of Movie ID %s to: %s", len(self.movie_export), self.metrics.movie_id,
+                            path)
+            self.movie_export = None
+        report = self.metrics.to_report(success=result[0], run_stats=self.last_run_stats)
+        if self.metrics.memory is not None:
+            self.metrics.memory.stop()
+            memory = report['memory']
+            logger.info("Memory of Movie ID: %s, peak RSS: %s bytes, peak traced: %d bytes, RE-ID document: %d bytes, "
+                        "largest frame candidates: %d bytes", report['movie_id'], memory['peak_rss_bytes'],
+                        memory['peak_traced_bytes'], memory['sizes'].get('reid_doc_bytes', 0),
+                        memory['sizes'].get('frame_candidates_bytes', 0))
+        self.last_run_report = report
+        counters = report['counters']
+        logger.info("Fused Movie ID: %s, success: %s, frames recomputed: %d, reused: %d, pairs evaluated: %d, "
+                    "above threshold: %d, db round-trips: %d, %.3fs (%s bound)", report['movie_id'], report['success'],
+                    counters.get('frames_recomputed', 0), counters.get('frames_reused', 0),
+                    counters.get('pairs_evaluated', 0), counters.get('pairs_above_threshold', 0),
+                    counters.get('db_round_trips', 0), report['wall_seconds'], report['bound'])
+        if FUSION_METRICS_TEXTFILE:
+            write_prometheus_textfile(FUSION_METRICS_TEXTFILE, report)
+        if return_report:
+            return result[0], result[1], report
+        return result
+
+    def run_fusion_pipeline(self, movie_id, window_size=FUSION_STREAM_WINDOW_SIZE, force=False, return_report=False,
+                            checkpoint=None):
+        """
+        Fuses a movie, see `_run_fusion_pipeline`. Returns (is_success, None), or with `return_report`
+        (is_success, None, report) with the stage timings and counters of the run.
+        """
+        self.start_metrics(movie_id)
+        return self.finish_metrics(self._run_fusion_pipeline(movie_id, window_size, force, checkpoint), return_report)
 
-    def run_fusion_pipeline(self, movie_id):
-        print("Starting to record time of fusion task!")
-        start_time = time.time()
-
-        print("Working on Movie ID: {}".format(movie_id))
+    def _run_fusion_pipeline(self, movie_id, window_size=FUSION_STREAM_WINDOW_SIZE, force=False, checkpoint=None):
+        """
+        Fuses a movie as a stream of stages: read frame -> candidate pairs -> correction & document -> write.
+        The stages are connected by queues of `window_size` frames, so the memory held by the run depends on the
+        window size and not on the number of frames, and the documents reach s4_fusion while the movie is processed.
+        In incremental mode (unless `force`) the frames whose inputs didn't change since the last run are skipped,
+        the recomputed / reused counts are kept in `self.last_run_stats`.
+        A `checkpoint` (see utils/job_queue.py) resumes an interrupted run: the frames in its `completed_frames()`
+        are skipped, and `frames_flushed(docs)` is called after every batch written to s4_fusion.
+        """
+        logger.info("Working on Movie ID: %s", movie_id)
 
         reid_detections = self.get_reid_detections(movie_id = movie_id, collection=REID_COLLECTION_NAME)
         if not reid_detections:
-            print("ERROR!!! REID data was not found!")
+            logger.error("REID data was not found! Movie ID: %s", movie_id)
             return False, None
-        
-        fusion_output = {
-            'movie_id': movie_id,
-            'frame_numbers': {}
-        }
-        
-        data_for_db = {}
+        self.build_reid_index(movie_id, collection=REID_COLLECTION_NAME, reid_detections=reid_detections)
 
-        # Iterate over all the RE-ID frames.
+        empty_idx = self.find_empty_reid_frame(reid_detections)
+        if empty_idx is not None: # We have no RE-ID face(s), so no fusion is available.
+            data_for_db = self.fuse_empty_reid_movie(movie_id, reid_detections, empty_idx)
+            if data_for_db is None:
+                return False, None
+            self.insert_json_to_db(data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
+            logger.info("Fusion didn't fuse any faces because RE-ID didn't find any! Appending empty document.")
+            return True, None
+
+        fusion_fingerprints = {}
+        if self.incremental and not force and self.movie_export is None:
+            fusion_fingerprints = self.get_fusion_fingerprints(movie_id, collection="s4_fusion")
+        run_stats = {'frames_recomputed': 0, 'frames_reused': 0}
+        self.last_run_stats = run_stats
+        completed_frames = None
+        # An export holds all the frames of the movie, so none is skipped.
+        if checkpoint is not None and self.movie_export is None:
+            completed_frames = checkpoint.completed_frames()
+            run_stats['frames_checkpointed'] = len(completed_frames)
+
+        frames = bounded_stage(self.read_fusion_frames(movie_id, reid_detections, completed_frames), window_size)
+        frame_candidates = bounded_stage(self.generate_frame_candidates(frames, fusion_fingerprints, run_stats),
+                                         window_size)
+        fusion_docs = self.generate_fusion_docs(movie_id, frame_candidates)
+        is_success = True
+        try:
+            with self.create_fusion_writer(collection_name="s4_fusion", key_list=['movie_id', 'frame_num'],
+                                           on_flush=checkpoint.frames_flushed if checkpoint else None) as fusion_writer:
+                for frame_num, data_for_db in fusion_docs:
+                    if data_for_db is None:
+                        logger.error("VISUAL CLUES DATA was not found! Movie ID: %s, frame: %s", movie_id, frame_num)
+                        is_success = False
+                        break
+                    fusion_writer.write(data_for_db)
+        finally:
+            fusion_docs.close()
+        return is_success, None
+
+    def find_empty_reid_frame(self, reid_detections):
+        """
+        Returns the index of the first RE-ID frame without faces, or None.
+        """
+        for idx, reid_detection in enumerate(reid_detections):
+            if not reid_detection['re-id']:
+                return idx
+        return None
+
+    def fuse_empty_reid_movie(self, movie_id, reid_detections, empty_idx):
+        """
+        A movie with a RE-ID frame without faces (see `find_empty_reid_frame`) fuses no face: returns its single
+        empty s4_fusion document, or None when the Visual Clues data of a frame up to that one is missing.
+        """
+        for reid_detection in reid_detections[:empty_idx + 1]:
+            if not self.get_visual_clues_data(movie_id=movie_id, collection=VISUAL_CLUES_COLLECTION_NAME,
+                                              frame_num=reid_detection['frame_num']):
+                logger.error("VISUAL CLUES DATA was not found! Movie ID: %s, frame: %s", movie_id,
+                             reid_detection['frame_num'])
+                return None
+        return {"movie_id": movie_id, "frame_num": 0, 'rois': [], 'face_ids_not_matched': []}
+
+    def group_reid_frames(self, reid_detections):
+        """
+        Groups the RE-ID frames by frame number, frames that appear more than once are fused into one document.
+        """
+        reid_frames = collections.OrderedDict()
         for reid_detection in reid_detections:
+            reid_frames.setdefault(str(reid_detection['frame_num']), []).append(reid_detection)
+        return reid_frames
 
-            reid_frame = reid_detection['frame_num']
-            vc_data = self.get_visual_clues_data(movie_id = movie_id, collection=VISUAL_CLUES_COLLECTION_NAME, frame_num=reid_frame)
+    def read_fusion_frames(self, movie_id, reid_detections, skip_frames=None):
+        """
+        Stage 1: yields (frame_num, RE-ID detections, visual clues document) for every RE-ID frame
+        that is not in `skip_frames` (a set of int frame numbers).
+        A missing visual clues document is yielded as None and ends the stream.
+        With `prefetch_visual_clues` the visual clues documents are read from one query in frame order, next to the
+        RE-ID frames: only the document after the current frame is held. A frame that the query already passed
+        (RE-ID frames out of order) or doesn't have is looked up on its own.
+        """
+        vc_frames = self.stream_visual_clues_frames(movie_id, collection=VISUAL_CLUES_COLLECTION_NAME) \
+            if self.prefetch_visual_clues else None
+        next_vc_data = next(vc_frames, None) if vc_frames is not None else None
+        try:
+            for frame_num, frame_detections in self.group_reid_frames(reid_detections).items():
+                if skip_frames and int(frame_num) in skip_frames:
+                    continue
+                vc_data = None
+                # The documents of the frames without RE-ID frames are skipped, the last one of a frame is kept.
+                while next_vc_data is not None and int(next_vc_data['frame_num']) <= int(frame_num):
+                    if int(next_vc_data['frame_num']) == int(frame_num):
+                        vc_data = next_vc_data
+                    next_vc_data = next(vc_frames, None)
+                if vc_data is None:
+                    vc_data = self.get_visual_clues_data(movie_id=movie_id, collection=VISUAL_CLUES_COLLECTION_NAME,
+                                                         frame_num=frame_detections[0]['frame_num'])
+                yield frame_num, frame_detections, vc_data
+                if not vc_data:
+                    return
+        finally:
+            if vc_frames is not None:
+                vc_frames.close()
+
+    def generate_frame_candidates(self, frames, fusion_fingerprints=None, run_stats=None):
+        """
+        Stage 2: yields (frame_num, FrameCandidates, input fingerprint) for every frame whose fingerprint
+        differs from the one stored in `fusion_fingerprints` (frame_num -> fingerprint).
+        """
+        fusion_fingerprints = fusion_fingerprints or {}
+        previous_candidates = None
+        for frame_num, frame_detections, vc_data in frames:
             if not vc_data:
-                print("ERROR!!! VISUAL CLUES DATA was not found!")
-                return False, None
+                yield frame_num, None, None
+                return
             vc_rois = self.get_visual_clues_rois(visual_clue_data=vc_data)
-                
-            reid_bboxes = reid_detection['re-id']
-            if not reid_bboxes: # We have no RE-ID face(s), so no fusion is available.
-                data_for_db = {"movie_id": movie_id, "frame_num": 0, 'rois': [], 'face_ids_not_matched': []}
-                self.insert_json_to_db(data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
-                end_time = time.time() - start_time
-                print("Fusion didn't fuse any faces because RE-ID didn't find any! Appending empty document.")
-                print("Total time it took for fusion task: {}".format(end_time))
-                return True, None
+            fingerprint = self.frame_fingerprint(frame_detections, vc_rois)
+            if fusion_fingerprints.get(int(frame_num)) == fingerprint:
+                if run_stats is not None:
+                    run_stats['frames_reused'] += 1
+                continue
+            if run_stats is not None:
+                run_stats['frames_recomputed'] += 1
+            previous_candidates = self.find_frame_candidates(frame_detections, vc_rois, previous_candidates)
+            yield frame_num, previous_candidates, fingerprint
+
+    def generate_fusion_docs(self, movie_id, frame_candidates):
+        """
+        Stage 3: corrects the matches and yields (frame_num, s4_fusion document) for the frames with candidates.
+        """
+        for frame_num, candidates, fingerprint in frame_candidates:
+            if candidates is None:
+                yield frame_num, None
+                return
+            if not len(candidates):
+                continue
+            logger.debug("Working on movie: %s, frame: %s", movie_id, frame_num)
+            yield frame_num, self.build_frame_fusion_doc(movie_id, frame_num, candidates, fingerprint)
+
+    def find_frame_candidates(self, frame_detections, vc_rois, previous_candidates=None):
+        """
+        Parses the RE-ID faces and the Visual Clues person ROIs of the frame once,
+        and scores all of them against each other.
+        In temporal mode the frame starts from `previous_candidates`, the candidates of the previous frame,
+        and the matches are corrected here (into `kept`) so the next frame can carry them forward.
+        """
+        with self.metrics.stage('candidate_generation'):
+            frame_candidates = None
+            if self.temporal_tolerance is not None and previous_candidates is not None:
+                # Static shots repeat the inputs of the previous frame, which are already parsed.
+                reid_bboxes = FrameFaces.frame_reid_bboxes(frame_detections)
+                faces = previous_candidates.faces
+                if not faces.has_inputs(reid_bboxes):
+                    faces = FrameFaces(reid_bboxes)
+                rois = previous_candidates.rois
+                if not rois.has_inputs(vc_rois):
+                    rois = FrameRois(vc_rois)
+                frame_candidates = self.propagate_frame_candidates(faces, rois, previous_candidates)
+            else:
+                faces = FrameFaces.from_frame_detections(frame_detections)
+                rois = FrameRois(vc_rois)
+            if frame_candidates is None:
+                frame_candidates = self.score_frame(faces, rois)
+                if self.temporal_tolerance is not None:
+                    self.metrics.count('frames_fully_scored')
+        if self.temporal_tolerance is not None and frame_candidates.kept is None:
+            frame_candidates.kept = self.correct_candidates(frame_candidates)
+        self.metrics.count('frames_processed')
+        self.metrics.count('pairs_above_threshold', len(frame_candidates))
+        self.metrics.record_size('frame_candidates_bytes', frame_candidates.nbytes)
+        return frame_candidates
+
+    def propagate_frame_candidates(self, faces, rois, previous_candidates):
+        """
+        Builds the candidates of a frame from the ones of the previous frame. A face or ROI is unchanged when
+        its id is in the previous frame and none of its coordinates moved more than `temporal_tolerance`:
+            - Everything unchanged: the previous rows and corrected matches are carried forward as is.
+            - Otherwise only the pairs of the changed faces and ROIs are scored, the pairs of unchanged ones are
+              reused, and the matches are corrected again.
+        Returns None when nothing is unchanged, the frame is then scored in full.
+        """
+        previous_faces, previous_rois = previous_candidates.faces, previous_candidates.rois
+        if faces is previous_faces and rois is previous_rois:
+            self.metrics.count('frames_propagated')
+            return FrameCandidates(faces, rois, previous_candidates.rows, kept=previous_candidates.kept)
+        face_prev = match_previous_rows(faces.face_ids.tolist(), faces.bboxes, previous_faces.face_ids.tolist(),
+                                        previous_faces.bboxes, self.temporal_tolerance)
+        unchanged_faces = np.flatnonzero(face_prev >= 0)
+        if not len(unchanged_faces):
+            return None
+        roi_prev = match_previous_rows(rois.raw_ids, rois.bboxes, previous_rois.raw_ids, previous_rois.bboxes,
+                                       self.temporal_tolerance)
+        unchanged_rois = np.flatnonzero(roi_prev >= 0)
+        if not len(unchanged_rois):
+            return None
+        if len(faces) == len(previous_faces) and len(rois) == len(previous_rois) and \
+                np.array_equal(face_prev, np.arange(len(faces))) and np.array_equal(roi_prev, np.arange(len(rois))):
+            self.metrics.count('frames_propagated')
+            return FrameCandidates(faces, rois, previous_candidates.rows, kept=previous_candidates.kept)
+
+        # Reuse the previous rows whose face and ROI are both unchanged, in the indices of this frame.
+        face_current = np.full(len(previous_faces), -1, dtype=np.int64)
+        face_current[face_prev[unchanged_faces]] = unchanged_faces
+        roi_current = np.full(len(previous_rois), -1, dtype=np.int64)
+        roi_current[roi_prev[unchanged_rois]] = unchanged_rois
+        previous_rows = previous_candidates.rows
+        reused_rows = previous_rows[(face_current[previous_rows['face_idx']] >= 0) &
+                                    (roi_current[previous_rows['vc_idx']] >= 0)].copy()
+        reused_rows['face_idx'] = face_current[reused_rows['face_idx']]
+        reused_rows['vc_idx'] = roi_current[reused_rows['vc_idx']]
+
+        # Score the changed faces against all the ROIs, and the unchanged faces against the changed ROIs.
+        rows = [reused_rows]
+        changed_faces = np.flatnonzero(face_prev < 0)
+        changed_rois = np.flatnonzero(roi_prev < 0)
+        for face_idxs, roi_idxs in [(changed_faces, np.arange(len(rois))), (unchanged_faces, changed_rois)]:
+            if not len(face_idxs) or not len(roi_idxs):
+                continue
+            scored_rows = self.score_frame(faces.take(face_idxs), rois.take(roi_idxs)).rows.copy()
+            scored_rows['face_idx'] = face_idxs[scored_rows['face_idx']]
+            scored_rows['vc_idx'] = roi_idxs[scored_rows['vc_idx']]
+            rows.append(scored_rows)
+        rows = np.concatenate(rows)
+        # The order of `score_frame`, by face and then by ROI, the conflict resolution depends on it.
+        rows = rows[np.lexsort((rows['vc_idx'], rows['face_idx']))]
+        self.metrics.count('frames_partially_rescored')
+        self.metrics.count('pairs_reused', len(reused_rows))
+        return FrameCandidates(faces, rois, rows)
+
+    def frame_fingerprint(self, frame_detections, vc_rois):
+        """
+        A hash of the frame's fusion inputs: its RE-ID faces and Visual Clues person ROIs,
+        the intersection threshold and the fusion version (and the temporal tolerance, when it is not exact).
+        """
+        frame_inputs = {
+            'version': FUSION_VERSION,
+            'threshold': INTERSECTION_THRESHOLD,
+            'faces': [reid_detection['re-id'] for reid_detection in frame_detections],
+            'rois': [[vc_roi['roi_id'], vc_roi['bbox']] for vc_roi in vc_rois]
+        }
+        if self.temporal_tolerance:
+            frame_inputs['temporal_tolerance'] = self.temporal_tolerance
+        return hashlib.sha1(json.dumps(frame_inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
-            # Iterate over the RE-ID face(s) in the current frame (There may be multiple different Face IDs)
-            for reid_bbox_obj in reid_bboxes:
-                face_id = reid_bbox_obj['id']
-                reid_bbox = reid_bbox_obj['bbox']
-
-                # Iterate over Visual Clues bboxes for the specific face. (that have 'person' in them)
-                for vc_roi in vc_rois:
-                    vc_bbox = vc_roi['bbox']
-                    vc_bbox = vc_bbox.replace("[","").replace("]","").split(",")
-                    vc_bbox = [float(xy) for xy in vc_bbox]
-                    bboxes_intersection = self.calculate_intersection \
-                                            (reid_bbox=reid_bbox, vc_bbox=vc_bbox, movie_id=movie_id, frame_num=reid_frame)
-                    
-                    # Keep the bounding boxes that have high intersection
-                    if bboxes_intersection > INTERSECTION_THRESHOLD:
-                        # Save the information of strong candidates regrding bboxes intersection
-                        reid_frame_str = str(reid_frame)
-                        if reid_frame_str not in fusion_output['frame_numbers']:
-                            fusion_output['frame_numbers'][reid_frame_str] = {'intersections' : [], 'ious': []}
-                        
-                        face_area = bb_smallest_area(reid_bbox, vc_bbox)
-                        iou = bb_intersection_over_union(reid_bbox, vc_bbox)
-                        fusion_output['frame_numbers'][reid_frame_str]['intersections'].append(
-                            {
-                                'reid_bbox': reid_bbox,
-                                'vc_bbox': vc_bbox,
-                                'bbox_intersection': bboxes_intersection,
-                                'face_area': face_area,
-                                'face_id': str(face_id),
-                                'iou': iou,
-                                'vc_id': str(vc_roi['roi_id'])
-                            }
-                        )
-                        if bboxes_intersection == 1.0:
-                            fusion_output['frame_numbers'][reid_frame_str]['ious'].append(
-                                {
-                                    'iou': bboxes_intersection,
-                                    'face_id': str(face_id),
-                                    'vc_id': str(vc_roi['roi_id']),
-                                    'reid_bbox': reid_bbox,
-                                    'vc_bbox': vc_bbox
-                                }
-                            )
+    def get_fusion_fingerprints(self, movie_id, collection):
+        """
+        Returns frame_num -> input fingerprint of the movie's fusion documents, with one query.
+        """
+        cursor = self.storage.find_docs({'movie_id': movie_id}, collection, fields=['frame_num', 'input_fingerprint'],
+                                        batch_size=VC_PREFETCH_BATCH_SIZE)
+        fusion_fingerprints = {}
+        for doc in cursor:
+            if doc.get('input_fingerprint'):
+                fusion_fingerprints[int(doc['frame_num'])] = doc['input_fingerprint']
+        return fusion_fingerprints
+
+    def build_frame_fusion_doc(self, movie_id, frame_num, frame_candidates, fingerprint=None):
+        kept_idxs = frame_candidates.kept
+        if kept_idxs is None:
+            kept_idxs = self.correct_candidates(frame_candidates)
+        faces, rois, rows = frame_candidates.faces, frame_candidates.rois, frame_candidates.rows
+        matched_ids = [(str(faces.face_ids[rows['face_idx'][idx]]), str(rois.raw_ids[rows['vc_idx'][idx]]))
+                       for idx in kept_idxs.tolist()]
+        vc_ids = list(rois.raw_ids)
+        face_ids = self.get_reid_face_ids(movie_id, frame_num, collection=REID_COLLECTION_NAME)
+        face_ids_to_actor_names = self.get_reid_face_ids_with_actor_names(movie_id, frame_num,
+                                                                          collection=REID_COLLECTION_NAME)
+        data_for_db = self.build_fusion_doc(movie_id, frame_num, matched_ids, vc_ids, face_ids, face_ids_to_actor_names)
+        if self.movie_export is not None:
+            kept_rows = rows[kept_idxs]
+            self.export_frame(data_for_db, {
+                (int(face_id), int(vc_id)): (bbox_intersection, iou, face_area)
+                for (face_id, vc_id), bbox_intersection, iou, face_area in
+                zip(matched_ids, kept_rows['bbox_intersection'].tolist(), kept_rows['iou'].tolist(),
+                    kept_rows['face_area'].tolist())})
+        if fingerprint:
+            data_for_db['input_fingerprint'] = fingerprint
+        return data_for_db
+
+    def export_frame(self, data_for_db, match_scores):
+        """
+        Adds the frame's s4_fusion document to the export of the movie, see `MovieExport.add_frame`.
+        """
+        if self.movie_export is not None:
+            self.movie_export.add_frame(data_for_db, match_scores)
 
-        movie_id = fusion_output['movie_id']
-        frames = fusion_output['frame_numbers']
-        for frame_num, _ in frames.items():
-            
-            image_url = self.get_image_url(movie_id, frame_num=int(frame_num), collection=VISUAL_CLUES_COLLECTION_NAME)
-            movie_name = image_url.split("/")[-2]
-            print("Working on movie: {}, frame: {}".format(movie_name, frame_num))
-
-            matches = []
-            # Get all the matches for the current frame
-            for intersection in frames[str(frame_num)]['intersections']:
-                matches.append({
-                                'reid_bbox':            intersection['reid_bbox'],
-                                'vc_bbox':              intersection['vc_bbox'],
-                                'bbox_intersection':    intersection['bbox_intersection'],
-                                'face_area':            intersection['face_area'],
-                                'face_id':              intersection['face_id'],
-                                'vc_id':                intersection['vc_id']
-                            })
-            
-            post_processed_matches = self.correct_matches(matches)
-
-            vc_ids = self.get_visual_clues_person_ids(movie_id, int(frame_num), collection="s4_visual_clues")
-            face_ids = self.get_reid_face_ids(movie_id, frame_num, collection="s4_re_id")
-            face_ids_to_actor_names = self.get_reid_face_ids_with_actor_names(movie_id, frame_num, collection="s4_re_id")
-            matched_ids = []
-            for idx, post_processed_match in enumerate(post_processed_matches):
-                    face_id = str(post_processed_match['face_id'])
-                    vc_id = str(post_processed_match['vc_id'])
-
-                    if face_id in face_ids:
-                        face_ids.remove(face_id)
-                    if vc_id in vc_ids:
-                        vc_ids.remove(vc_id)
-
-                    matched_ids.append((face_id, vc_id))
-            unmatched_face_ids = face_ids
-            unmatched_vc_ids = vc_ids
-            data_for_db = {"movie_id": movie_id, "frame_num": int(frame_num), 'rois': [], 'face_ids_not_matched': unmatched_face_ids}
-            for idx in range(len(matched_ids)):
-                face_id = matched_ids[idx][0]
-                vc_id = matched_ids[idx][1]
-                data_for_db['rois'].append(
-                    {
-                        'face_id': int(face_id),
-                        'vc_id': int(vc_id),
-                        'reid_name': face_ids_to_actor_names[int(face_id)]
-                    }
-                )  
-            for vc_id in unmatched_vc_ids:
-                data_for_db['rois'].append(
-                    {
-                        'face_id': -1,
-                        'vc_id': vc_id
-                    }
-                )  
-            self.insert_json_to_db(data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
+    async def run_fusion_pipeline_async(self, movie_id, max_concurrency=FUSION_ASYNC_MAX_CONCURRENCY,
+                                        lookahead=FUSION_ASYNC_LOOKAHEAD, force=False, return_report=False):
+        """
+        Fuses a movie, see `_run_fusion_pipeline_async`. Returns the same results as `run_fusion_pipeline`.
+        """
+        self.start_metrics(movie_id)
+        result = await self._run_fusion_pipeline_async(movie_id, max_concurrency, lookahead, force)
+        return self.finish_metrics(result, return_report)
+
+    async def _run_fusion_pipeline_async(self, movie_id, max_concurrency=FUSION_ASYNC_MAX_CONCURRENCY,
+                                         lookahead=FUSION_ASYNC_LOOKAHEAD, force=False):
+        """
+        Async variant of `run_fusion_pipeline` that overlaps the database I/O with the matching compute.
+        Database reads and writes run on a thread executor, at most `max_concurrency` at a time, and the
+        Visual Clues frames k+1..k+lookahead are fetched while frame k is matched.
+        Writes the same s4_fusion documents as `run_fusion_pipeline`, and as there, on a missing Visual Clues frame
+        it returns (False, None) after the frames before it may already be written.
+        Usage: asyncio.run(fusion_pipeline.run_fusion_pipeline_async(movie_id))
+        """
+        logger.info("Working on Movie ID: %s (async)", movie_id)
+
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="fusion-db")
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # Reads the frames of the ordered Visual Clues query one after the other.
+        stream_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fusion-vc")
+        fusion_frames = None
+
+        async def run_db(fn, *args, **kwargs):
+            async with semaphore:
+                return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
 
-        end_time = time.time() - start_time
-        print("Total time it took for fusion task: {}".format(end_time))
+        async def fetch_visual_clues(frame_num):
+            return await run_db(self.get_visual_clues_data, movie_id=movie_id,
+                                collection=VISUAL_CLUES_COLLECTION_NAME, frame_num=frame_num)
+
+        async def fetch_frame(frame_num, frame_detections):
+            return frame_num, frame_detections, await fetch_visual_clues(frame_detections[0]['frame_num'])
+
+        pending_frames = collections.deque()
+        write_tasks = []
+        try:
+            reid_detections = await run_db(self.get_reid_detections, movie_id=movie_id, collection=REID_COLLECTION_NAME)
+            if not reid_detections:
+                logger.error("REID data was not found! Movie ID: %s", movie_id)
+                return False, None
+            self.build_reid_index(movie_id, collection=REID_COLLECTION_NAME, reid_detections=reid_detections)
+
+            # Same as the sync path: a RE-ID frame without faces ends the movie with an empty document,
+            # provided that the Visual Clues frames up to it exist. Check it before writing anything.
+            empty_idx = self.find_empty_reid_frame(reid_detections)
+            if empty_idx is not None:
+                vc_datas = await asyncio.gather(*[fetch_visual_clues(reid_detection['frame_num'])
+                                                  for reid_detection in reid_detections[:empty_idx + 1]])
+                if not all(vc_datas):
+                    logger.error("VISUAL CLUES DATA was not found! Movie ID: %s", movie_id)
+                    return False, None
+                data_for_db = {"movie_id": movie_id, "frame_num": 0, 'rois': [], 'face_ids_not_matched': []}
+                await run_db(self.insert_json_to_db, data_for_db, collection_name="s4_fusion",
+                             key_list=['movie_id', 'frame_num'])
+                logger.info("Fusion didn't fuse any faces because RE-ID didn't find any! Appending empty document.")
+                return True, None
+
+            fusion_fingerprints = {}
+            if self.incremental and not force and self.movie_export is None:
+                fusion_fingerprints = await run_db(self.get_fusion_fingerprints, movie_id, collection="s4_fusion")
+            run_stats = {'frames_recomputed': 0, 'frames_reused': 0}
+            self.last_run_stats = run_stats
+
+            reid_frames_iter = iter(self.group_reid_frames(reid_detections).items())
+            if self.prefetch_visual_clues:
+                # The same frames, with the Visual Clues frames read in frame order from one query.
+                fusion_frames = self.read_fusion_frames(movie_id, reid_detections)
+            previous_candidates = None
+
+            def schedule_frames():
+                while len(pending_frames) < max(1, lookahead):
+                    frame = next(reid_frames_iter, None)
+                    if frame is None:
+                        return
+                    if fusion_frames is not None:
+                        pending_frames.append(loop.run_in_executor(stream_executor, next, fusion_frames, None))
+                    else:
+                        pending_frames.append(asyncio.ensure_future(fetch_frame(*frame)))
+
+            docs_to_write = []
+            schedule_frames()
+            while pending_frames:
+                frame_num, frame_detections, vc_data = await pending_frames.popleft()
+                schedule_frames()
+                if not vc_data:
+                    logger.error("VISUAL CLUES DATA was not found! Movie ID: %s, frame: %s", movie_id, frame_num)
+                    return False, None
+                vc_rois = self.get_visual_clues_rois(visual_clue_data=vc_data)
+                fingerprint = self.frame_fingerprint(frame_detections, vc_rois)
+                if fusion_fingerprints.get(int(frame_num)) == fingerprint:
+                    run_stats['frames_reused'] += 1
+                    continue
+                run_stats['frames_recomputed'] += 1
+                candidates = self.find_frame_candidates(frame_detections, vc_rois, previous_candidates)
+                previous_candidates = candidates
+                if not len(candidates):
+                    continue
+                docs_to_write.append(self.build_frame_fusion_doc(movie_id, frame_num, candidates, fingerprint))
+                if len(docs_to_write) >= self.write_batch_size:
+                    write_tasks.append(asyncio.ensure_future(run_db(self.insert_jsons_to_db, docs_to_write,
+                                       collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])))
+                    docs_to_write = []
+            if docs_to_write:
+                write_tasks.append(asyncio.ensure_future(run_db(self.insert_jsons_to_db, docs_to_write,
+                                   collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])))
+            await asyncio.gather(*write_tasks)
+        finally:
+            for frame_task in pending_frames:
+                frame_task.cancel()
+            # Let the writes that were already sent finish before returning.
+            await asyncio.gather(*write_tasks, return_exceptions=True)
+            executor.shutdown(wait=False)
+            if fusion_frames is not None:
+                # Closes the query once the frame being read is done.
+                await loop.run_in_executor(stream_executor, fusion_frames.close)
+            stream_executor.shutdown(wait=False)
         return True, None
 
+    def build_fusion_doc(self, movie_id, frame_num, matched_ids, vc_ids, face_ids, face_ids_to_actor_names):
+        """
+        Builds the s4_fusion document of a frame from its corrected (face_id, vc_id) matches.
+        `vc_ids` and `face_ids` are the person ROI ids and face ids of the frame, the unmatched ones are kept.
+        """
+        for face_id, vc_id in matched_ids:
+            if face_id in face_ids:
+                face_ids.remove(face_id)
+            if vc_id in vc_ids:
+                vc_ids.remove(vc_id)
+
+        unmatched_face_ids = face_ids
+        unmatched_vc_ids = vc_ids
+        data_for_db = {"movie_id": movie_id, "frame_num": int(frame_num), 'rois': [], 'face_ids_not_matched': unmatched_face_ids}
+        for idx in range(len(matched_ids)):
+            face_id = matched_ids[idx][0]
+            vc_id = matched_ids[idx][1]
+            data_for_db['rois'].append(
+                {
+                    'face_id': int(face_id),
+                    'vc_id': int(vc_id),
+                    'reid_name': face_ids_to_actor_names[int(face_id)]
+                }
+            )  
+        for vc_id in unmatched_vc_ids:
+            data_for_db['rois'].append(
+                {
+                    'face_id': -1,
+                    'vc_id': vc_id
+                }
+            )  
+        return data_for_db
+
     def get_celebrity_data(self):
         celebrity_dict = {}
         with open(CELEBRITY_PATH, 'r') as f:
@@ -186,21 +623,56 @@ class FusionPipeline:
         """
         Inserts a JSON with global & local tokens to the database.
         """
+        if self.export_only and collection_name == self.collection_name:
+            return None
 
-        res = self.nre.write_doc_by_key(json_obj, collection_name, overwrite=True, key_list=key_list)
+        with self.metrics.stage('db_write'):
+            res = self.storage.write_doc_by_key(json_obj, collection_name, overwrite=True, key_list=key_list)
 
-        print("Successfully inserted to database. Collection name: {}".format(collection_name))
+        logger.debug("Successfully inserted to database. Collection name: %s", collection_name)
         return res
 
+    def insert_jsons_to_db(self, json_objs, collection_name, key_list=[]):
+        """
+        Inserts (or replaces, by the key_list attributes) multiple JSONs to the database at once.
+        """
+        if not json_objs or (self.export_only and collection_name == self.collection_name):
+            return None
+        with self.metrics.stage('db_write'):
+            res = self.storage.write_docs_by_key(json_objs, collection_name, key_list=key_list)
+
+        logger.debug("Successfully inserted %d documents to database. Collection name: %s", len(json_objs), collection_name)
+        return res
+
+    def invalidate_doc_cache(self, collection=None, query=None):
+        """
+        Drops the cached documents of the `get_doc_by_key` query, of the collection or all of them.
+        Needed when the documents change in the database while a movie is fused.
+        """
+        self.doc_cache.invalidate(collection, query_key(query) if query is not None else None)
+
+    def create_fusion_writer(self, collection_name, key_list=[], on_flush=None):
+        """
+        Returns a write-behind writer that flushes the fusion documents in batches with `insert_jsons_to_db`.
+        `on_flush(json_objs)` is called on the writer thread after every written batch.
+        """
+        def flush_fn(json_objs):
+            self.insert_jsons_to_db(json_objs, collection_name=collection_name, key_list=key_list)
+            if on_flush is not None:
+                on_flush(json_objs)
+
+        return FusionDocWriter(flush_fn, batch_size=self.write_batch_size, flush_interval=self.write_flush_interval,
+                               max_queue_size=FUSION_WRITE_MAX_QUEUE_SIZE)
+
     def get_mdf_urls_from_db(self, movie_id, collection):
 
-        data = self.nre.get_doc_by_key({'_id': movie_id}, collection)
+        data = self.storage.get_cached_doc_by_key({'_id': movie_id}, collection)
         urls = []
         if not data:
-            print("{} not found in database. ".format(movie_id))
+            logger.warning("%s not found in database.", movie_id)
             return False
         if 'mdfs_path' not in data:
-            print("MDFs cannot be found in {}".format(movie_id))
+            logger.warning("MDFs cannot be found in %s", movie_id)
             return False
         for mdf_path in data['mdfs_path']:
             url = os.path.join(URL_PREFIX, mdf_path[1:])
@@ -209,12 +681,12 @@ class FusionPipeline:
     
     def get_pipelineid_from_db(self, movie_id, collection):
 
-        data = self.nre.get_doc_by_key({'_id': movie_id}, collection)
+        data = self.storage.get_cached_doc_by_key({'_id': movie_id}, collection)
         if not data:
-            print("{} not found in database. ".format(movie_id))
+            logger.warning("%s not found in database.", movie_id)
             return False
         if 'pipeline_id' not in data:
-            print("pipeline_id cannot be found in {}".format(movie_id))
+            logger.warning("pipeline_id cannot be found in %s", movie_id)
             return False
         pipeline_id = data['pipeline_id']
 
@@ -222,7 +694,7 @@ class FusionPipeline:
 
     def get_input_type_from_db(self, pipeline_id, collection):
 
-        pipeline_data = self.nre.get_doc_by_key({'_key': pipeline_id}, collection)
+        pipeline_data = self.storage.get_cached_doc_by_key({'_key': pipeline_id}, collection)
         if pipeline_data:
             if "dataset" in pipeline_data["inputs"]["videoprocessing"]:
                 input_type = pipeline_data["inputs"]["videoprocessing"]["dataset"]["type"]
@@ -232,18 +704,49 @@ class FusionPipeline:
 
     def get_reid_detections(self, movie_id, collection):
         try:
-            data = self.nre.get_doc_by_key({'movie_id': movie_id}, collection)
+            with self.metrics.stage('reid_fetch'):
+                data = self.storage.get_doc_by_key({'movie_id': movie_id}, collection)
         except KeyError:
-            print("Movie ID {} not found.".format(movie_id))
+            logger.warning("Movie ID %s not found.", movie_id)
         if not data:
             return None
+        self.metrics.record_size('reid_doc_bytes', lambda: doc_size(data))
         reid_detections = data['frames'] if 'frames' in data else []
         return reid_detections
 
+    def build_reid_index(self, movie_id, collection, reid_detections):
+        """
+        Index the RE-ID frames of a movie by frame number, so the per-frame getters
+        don't need to re-download and re-scan the whole RE-ID document.
+        """
+        frames = {}
+        for reid_det in reid_detections:
+            frame_entry = frames.setdefault(str(reid_det['frame_num']),
+                                            {'face_ids': [], 'actor_names': {}, 'bboxes': []})
+            for reid_bbox in reid_det['re-id']:
+                frame_entry['face_ids'].append(str(reid_bbox['id']))
+                frame_entry['actor_names'][int(reid_bbox['id'])] = reid_bbox.get('actor_name')
+                frame_entry['bboxes'].append(reid_bbox['bbox'])
+        self.reid_index = {'movie_id': movie_id, 'collection': collection, 'frames': frames}
+        return frames
+
+    def get_indexed_reid_frame(self, movie_id, collection, frame_num):
+        """
+        Returns a tuple of (is_indexed, RE-ID frame entry) for the given frame.
+        """
+        index = self.reid_index
+        if not index or index['movie_id'] != movie_id or index['collection'] != collection:
+            return False, None
+        return True, index['frames'].get(str(frame_num))
+
     def get_reid_face_ids(self, movie_id, frame_num, collection):
         """
         Get the bboxes that have 'person' detected in them.
         """
+        is_indexed, frame_entry = self.get_indexed_reid_frame(movie_id, collection, frame_num)
+        if is_indexed:
+            # Return a copy, the callers remove the matched face ids from it.
+            return list(frame_entry['face_ids']) if frame_entry else []
         reid_data = self.get_reid_detections(movie_id, collection)
         if not reid_data:
             return None
@@ -259,6 +762,9 @@ class FusionPipeline:
         """
         Get the bboxes that have 'person' detected in them.
         """
+        is_indexed, frame_entry = self.get_indexed_reid_frame(movie_id, collection, frame_num)
+        if is_indexed:
+            return dict(frame_entry['actor_names']) if frame_entry else {}
         reid_data = self.get_reid_detections(movie_id, collection)
         face_ids_to_actor_name = dict()
         for reid_det in reid_data:
@@ -270,11 +776,52 @@ class FusionPipeline:
 
         return face_ids_to_actor_name
     
+    def stream_visual_clues_frames(self, movie_id, collection):
+        """
+        Yields the Visual Clues frames of a movie in frame order, from a single streamed query.
+        """
+        cursor = iter(self.storage.find_docs({'movie_id': movie_id}, collection, batch_size=VC_PREFETCH_BATCH_SIZE,
+                                             sort='frame_num'))
+        while True:
+            with self.metrics.stage('vc_fetch'):
+                doc = next(cursor, None)
+            if doc is None:
+                return
+            yield doc
+
+    def prefetch_visual_clues_frames(self, movie_id, collection):
+        """
+        Load all the Visual Clues frames of a movie with a single streamed query.
+        The frames are kept in a frame_num-keyed snapshot used by the per-frame getters, for the ground truth fusion
+        which looks frames up more than once (the stream reads them in order, see `read_fusion_frames`).
+        """
+        frames = {}
+        with self.metrics.stage('vc_fetch'):
+            cursor = self.storage.find_docs({'movie_id': movie_id}, collection, batch_size=VC_PREFETCH_BATCH_SIZE)
+            for doc in cursor:
+                frames[int(doc['frame_num'])] = doc
+        self.visual_clues_snapshot = {'movie_id': movie_id, 'collection': collection, 'frames': frames}
+        logger.debug("Prefetched %d Visual Clues frames of Movie ID: %s", len(frames), movie_id)
+        return frames
+
+    def get_prefetched_visual_clues(self, movie_id, collection, frame_num):
+        """
+        Returns a tuple of (is_prefetched, visual clues document) for the given frame.
+        """
+        snapshot = self.visual_clues_snapshot
+        if not snapshot or snapshot['movie_id'] != movie_id or snapshot['collection'] != collection:
+            return False, None
+        return True, snapshot['frames'].get(int(frame_num))
+
     def get_visual_clues_data(self, movie_id, collection, frame_num):
+        is_prefetched, data = self.get_prefetched_visual_clues(movie_id, collection, frame_num)
+        if is_prefetched:
+            return data
         try:
-            data = self.nre.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
+            with self.metrics.stage('vc_fetch'):
+                data = self.storage.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
         except KeyError:
-            print("Movie ID {} and Frame not found.".format(movie_id))
+            logger.warning("Movie ID %s and Frame %s not found.", movie_id, frame_num)
         return data
 
     
@@ -303,39 +850,104 @@ class FusionPipeline:
     
     
     def get_image_url(self, movie_id, frame_num, collection):
+        is_prefetched, data = self.get_prefetched_visual_clues(movie_id, collection, frame_num)
+        if is_prefetched:
+            return data['url']
         try:
-            data = self.nre.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
+            data = self.storage.get_doc_by_key({'movie_id': movie_id, 'frame_num': frame_num}, collection)
         except KeyError:
-            print("Movie ID {} and Frame num {} not found.".format(movie_id, frame_num))
+            logger.warning("Movie ID %s and Frame num %s not found.", movie_id, frame_num)
         return data['url']
     
     def get_movie_ids_by_tag(self, tag, collection):
-
-        results = []
-        query = 'FOR doc IN {} RETURN doc'.format(collection)
-        cursor = self.nre.db.aql.execute(query)
+        """
+        Returns the (first) movie id of every pipeline document whose benchmark tag is `tag`.
+        The tag filter and the `movies` projection run in the database and the cursor is streamed in batches,
+        the filter can use the index of `ensure_benchmark_tag_index`.
+        """
+        cursor = self.storage.find_docs({BENCHMARK_TAG_ATTRIBUTE: tag}, collection, fields=['movies'],
+                                        batch_size=VC_PREFETCH_BATCH_SIZE)
+        movie_ids = []
         for doc in cursor:
-            results.append(doc)
-        temp_results = []
-        for result in results:
-            if result['movies']:
-                if 'benchmark' in result['inputs']['videoprocessing']:
-                    if result['inputs']['videoprocessing']['benchmark']['benchmark_tag'] == 'v100':
-                        temp_results.append(list(result['movies'].keys())[0])
-        return temp_results
+            if doc.get('movies'):
+                movie_ids.append(next(iter(doc['movies'])))
+        return movie_ids
 
+    def ensure_benchmark_tag_index(self, collection):
+        return self.storage.ensure_index(collection, [BENCHMARK_TAG_ATTRIBUTE])
 
-    def calculate_intersection(self, reid_bbox, vc_bbox, movie_id, frame_num):
+
+    def find_candidates(self, reid_bboxes, vc_rois):
         """
-        Calculate IOU between REID bbox and Visual Clues bbox.
+        Score every RE-ID face of a frame against every Visual Clues person ROI with one array operation.
+        Returns the face/ROI pairs with high intersection as dicts, ordered by face and then by ROI.
         """
-        
-        # Calculate Intersection
-        intersection = bb_intersection(reid_bbox, vc_bbox)
-        print("Intersection: {}".format(intersection))
+        if not reid_bboxes or not vc_rois:
+            return []
+        return self.score_frame(FrameFaces(reid_bboxes), FrameRois(vc_rois)).to_dicts()
+
+    def score_frame(self, faces, rois):
+        """
+        Score the FrameFaces against the FrameRois, returns the FrameCandidates with high intersection,
+        ordered by face and then by ROI.
+        In crowded frames only the pairs that share a cell of the grid index are scored (`bb_overlapping_pairs`),
+        the others don't overlap and can't pass the threshold. The scored pairs are counted as `pairs_evaluated`.
+        """
+        if not len(faces) or not len(rois):
+            return FrameCandidates(faces, rois)
+        overlapping_pairs = None
+        if len(faces) * len(rois) >= SPATIAL_INDEX_MIN_PAIRS:
+            overlapping_pairs = bb_overlapping_pairs(faces.bboxes, rois.bboxes)
+        if overlapping_pairs is None:
+            self.metrics.count('pairs_evaluated', len(faces) * len(rois))
+            intersections = bb_intersection_matrix(faces.bboxes, rois.bboxes)
+            # Keep the bounding boxes that have high intersection
+            face_idxs, vc_idxs = np.nonzero(intersections > INTERSECTION_THRESHOLD)
+            intersections = intersections[face_idxs, vc_idxs]
+        else:
+            face_idxs, vc_idxs = overlapping_pairs
+            self.metrics.count('pairs_evaluated', len(face_idxs))
+            intersections = bb_intersection_pairs(faces.bboxes[face_idxs], rois.bboxes[vc_idxs])
+            is_candidate = intersections > INTERSECTION_THRESHOLD
+            face_idxs, vc_idxs, intersections = face_idxs[is_candidate], vc_idxs[is_candidate], intersections[is_candidate]
+            order = np.lexsort((vc_idxs, face_idxs))
+            face_idxs, vc_idxs, intersections = face_idxs[order], vc_idxs[order], intersections[order]
+        rows = np.empty(len(face_idxs), dtype=CANDIDATE_DTYPE)
+        rows['face_idx'] = face_idxs
+        rows['vc_idx'] = vc_idxs
+        if len(rows):
+            face_bboxes, vc_bboxes = faces.bboxes[face_idxs], rois.bboxes[vc_idxs]
+            rows['bbox_intersection'] = intersections
+            rows['face_area'] = bb_smallest_area_pairs(face_bboxes, vc_bboxes)
+            rows['iou'] = bb_intersection_over_union_pairs(face_bboxes, vc_bboxes)
+            if sampled_logger.is_enabled():
+                for face_idx, vc_idx, bbox_intersection, _, iou in rows.tolist():
+                    sampled_logger.debug("pair", "face: %s, ROI: %s, intersection: %s, IoU: %s",
+                                         faces.face_ids[face_idx], rois.raw_ids[vc_idx], bbox_intersection, iou)
+        return FrameCandidates(faces, rois, rows)
+
+    def add_frame_candidates(self, fusion_output, frame_num, candidates):
+        """
+        Save the information of strong candidates regrding bboxes intersection
+        """
+        if not candidates:
+            return
+        frame_num_str = str(frame_num)
+        if frame_num_str not in fusion_output['frame_numbers']:
+            fusion_output['frame_numbers'][frame_num_str] = {'intersections' : [], 'ious': []}
+        for candidate in candidates:
+            fusion_output['frame_numbers'][frame_num_str]['intersections'].append(candidate)
+            if candidate['bbox_intersection'] == 1.0:
+                fusion_output['frame_numbers'][frame_num_str]['ious'].append(
+                    {
+                        'iou': candidate['bbox_intersection'],
+                        'face_id': candidate['face_id'],
+                        'vc_id': candidate['vc_id'],
+                        'reid_bbox': candidate['reid_bbox'],
+                        'vc_bbox': candidate['vc_bbox']
+                    }
+                )
 
-        return intersection
-    
     def calc_iou_on_matches(self, matches):
         """
         Calclate IOU on all matches
@@ -344,6 +956,21 @@ class FusionPipeline:
 
 
     
+    def correct_candidates(self, frame_candidates):
+        """
+        `correct_matches` for FrameCandidates, returns the indices of the kept candidate rows.
+        Like there, faces (person ROIs) with equal bboxes are the same bbox.
+        """
+        rows = frame_candidates.rows
+        if not len(rows):
+            return np.empty(0, dtype=np.int64)
+        with self.metrics.stage('correct_matches'):
+            face_bboxes, vc_bboxes = frame_candidates.face_bboxes(), frame_candidates.vc_bboxes()
+            _, face_keys = np.unique(face_bboxes, axis=0, return_inverse=True)
+            _, person_keys = np.unique(vc_bboxes, axis=0, return_inverse=True)
+            return resolve_match_conflicts(face_keys.reshape(-1), person_keys.reshape(-1), face_bboxes, vc_bboxes,
+                                           rows['face_area'])
+
     def correct_matches(self, matches):
         """
         Correcting the edge cases of matches between face bbox and its corresponding person bbox
@@ -355,104 +982,291 @@ class FusionPipeline:
                     - One face bbox intersects with both bboxes, Other face bbox intersects with one bbox.
                     - One face bbox intersects with both bboxes but partially in one of them, Other face bbox intersects with one bbox.
                     - Both faces bboxes intersects with both bboxes.
+        See `resolve_match_conflicts` for the rules, each bbox is identified by its string as before.
         """
-        
-        detected_person_bboxes, detected_reid_bboxes = {}, {}
+        if not matches:
+            return []
 
-        corrected_matches = matches.copy()
+        kept = resolve_match_conflicts([str(match['reid_bbox']) for match in matches],
+                                       [str(match['vc_bbox']) for match in matches],
+                                       [match['reid_bbox'] for match in matches],
+                                       [match['vc_bbox'] for match in matches],
+                                       [match['face_area'] for match in matches])
 
-        for match in matches:
-            cur_reid_bbox = str(match['reid_bbox'])
-            cur_vc_bbox = str(match['vc_bbox'])
-            cur_face_area = match['face_area']
+        corrected_matches = [matches[idx] for idx in kept.tolist()]
+        return corrected_matches
+
+
+def match_previous_rows(ids, bboxes, previous_ids, previous_bboxes, tolerance):
+    """
+    For every box, the row of the box with the same id in the previous frame, or -1 when the id is new or
+    the box moved more than `tolerance` on any coordinate. Ids that repeat in a frame are never matched.
+    """
+    if ids == previous_ids:
+        # The usual case, the same ids in the same order.
+        if len(set(ids)) != len(ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        rows = np.arange(len(ids))
+        rows[np.abs(bboxes - previous_bboxes).max(axis=1, initial=0) > tolerance] = -1
+        return rows
+    previous_rows = {}
+    for row, previous_id in enumerate(previous_ids):
+        previous_rows[previous_id] = -1 if previous_id in previous_rows else row
+    id_counts = collections.Counter(ids)
+    rows = np.asarray([previous_rows.get(cur_id, -1) if id_counts[cur_id] == 1 else -1 for cur_id in ids],
+                      dtype=np.int64)
+    matched = np.flatnonzero(rows >= 0)
+    moved = np.abs(bboxes[matched] - previous_bboxes[rows[matched]]).max(axis=1, initial=0) > tolerance
+    rows[matched[moved]] = -1
+    return rows
+
+
+def resolve_match_conflicts(face_keys, person_keys, reid_bboxes, vc_bboxes, face_areas):
+    """
+    The conflict resolution of `FusionPipeline.correct_matches`, on matches given as parallel sequences:
+    the face and person bbox key of every match (equal keys are the same bbox), its face and person bboxes
+    and its face area. Returns the indices of the kept matches, in order.
+    The conflicts are resolved with two sorts, in O(n log n):
+        - A person bbox keeps the match with the largest face area (which is the closest face and our hueristic),
+          the later match on a tie.
+        - A face bbox then keeps, of its remaining matches, the person bbox whose upper center ('upper half of
+          bbox') is the nearest to the face center, the earlier match on a tie.
+    """
+    face_areas = np.asarray(face_areas, dtype=np.float64)
+    if not len(face_areas):
+        return np.empty(0, dtype=np.int64)
+    _, face_rows = np.unique(np.asarray(face_keys), return_inverse=True)
+    _, person_rows = np.unique(np.asarray(person_keys), return_inverse=True)
+    face_rows, person_rows = face_rows.reshape(-1), person_rows.reshape(-1)
+    match_idxs = np.arange(len(face_areas))
+
+    order = np.lexsort((-match_idxs, -face_areas, person_rows))
+    kept = order[_first_of_groups(person_rows[order])]
+
+    distances = distances_between_points(bb_hueristic_face_coordinates(np.asarray(vc_bboxes)[kept]),
+                                         bb_center_coordinates(np.asarray(reid_bboxes)[kept]))
+    order = np.lexsort((kept, distances, face_rows[kept]))
+    kept = kept[order][_first_of_groups(face_rows[kept][order])]
+    return np.sort(kept).astype(np.int64)
+
+
+def _first_of_groups(sorted_keys):
+    """
+    A mask of the first element of every run of equal keys.
+    """
+    is_first = np.ones(len(sorted_keys), dtype=bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return is_first
+
+
+_worker_fusion_pipeline = None
+
+def _init_fusion_worker(pipeline_kwargs, log_level=None):
+    """
+    Pool initializer, every worker process holds its own FusionPipeline (database connection and celebrity table).
+    """
+    global _worker_fusion_pipeline
+    if log_level is not None:
+        configure_fusion_logging(log_level)
+    _worker_fusion_pipeline = FusionPipeline(**pipeline_kwargs)
+
+def _run_fusion_worker(job, fusion_pipeline=None):
+    movie_fn, movie_id = job
+    try:
+        return movie_id, movie_fn(fusion_pipeline or _worker_fusion_pipeline, movie_id)
+    except Exception as e:
+        # Failures are isolated per movie, the other movies keep running.
+        logger.exception("Movie ID %s failed", movie_id)
+        return movie_id, (False, "{}: {}".format(type(e).__name__, e))
+
+def run_movie_fusion(fusion_pipeline, movie_id):
+    return fusion_pipeline.run_fusion_pipeline(movie_id)
+
+def run_movie_fusion_async(fusion_pipeline, movie_id):
+    return asyncio.run(fusion_pipeline.run_fusion_pipeline_async(movie_id))
+
+def run_movies_in_pool(movie_fn, movie_ids, num_workers=FUSION_NUM_WORKERS, stop_on_failure=False,
+                       fusion_pipeline=None, **pipeline_kwargs):
+    """
+    Runs `movie_fn(fusion_pipeline, movie_id)` over the movies with a pool of `num_workers` processes.
+    `movie_fn` must be a module level function that returns a (bool, output) tuple.
+    With a single worker the movies run in the current process, on `fusion_pipeline` if given.
+    Returns a list of (movie_id, (bool, output)) in the order of `movie_ids`.
+    With `stop_on_failure` the pool is terminated on the first failed movie and the results so far are returned.
+    """
+    results = []
+    jobs = [(movie_fn, movie_id) for movie_id in movie_ids]
+    if num_workers <= 1:
+        fusion_pipeline = fusion_pipeline or FusionPipeline(**pipeline_kwargs)
+        for job in jobs:
+            results.append(_run_fusion_worker(job, fusion_pipeline=fusion_pipeline))
+            if stop_on_failure and not results[-1][1][0]:
+                break
+        return results
+
+    # Spawn (and not fork) so no database connection or writer thread is shared with the parent.
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=num_workers, initializer=_init_fusion_worker,
+                  initargs=(pipeline_kwargs, configured_level())) as pool:
+        for result in pool.imap(_run_fusion_worker, jobs):
+            results.append(result)
+            if stop_on_failure and not result[1][0]:
+                logger.warning("Stopping the fusion pool, Movie ID %s failed: %s", result[0], result[1][1])
+                pool.terminate()
+                break
+    return results
+
+def run_fusion_pipelines(movie_ids, num_workers=FUSION_NUM_WORKERS, stop_on_failure=False,
+                         fusion_pipeline=None, **pipeline_kwargs):
+    """
+    Runs `FusionPipeline.run_fusion_pipeline` over multiple movies in parallel.
+    Returns a list of (movie_id, (bool, str)) in the order of `movie_ids`.
+    """
+    return run_movies_in_pool(run_movie_fusion, movie_ids, num_workers=num_workers, stop_on_failure=stop_on_failure,
+                              fusion_pipeline=fusion_pipeline, **pipeline_kwargs)
+
+
+def fuse_groundtruth_movie(fusion_pipeline, movie_id, save_image=True, qa_output=None, qa_sample_every=None):
+    """
+    Fuses a single ground-truth movie, saves the QA output (see `utils.qa_output`) and returns its per-frame documents.
+    `qa_output` and `qa_sample_every` default to FUSION_QA_OUTPUT and FUSION_QA_SAMPLE_EVERY.
+    The run report of the movie is kept in `fusion_pipeline.last_run_report`.
+    """
+    fusion_pipeline.start_metrics(movie_id)
+    try:
+        result = _fuse_groundtruth_movie(fusion_pipeline, movie_id, save_image, qa_output, qa_sample_every)
+    finally:
+        # Don't hold the movie's prefetched Visual Clues frames until the next one.
+        fusion_pipeline.visual_clues_snapshot = None
+    return fusion_pipeline.finish_metrics(result)
+
+
+def _fuse_groundtruth_movie(fusion_pipeline, movie_id, save_image=True, qa_output=None, qa_sample_every=None):
+    logger.info("Working on Movie ID: %s", movie_id)
+    collection = "s4_re_id"
+    reid_detections = fusion_pipeline.get_reid_detections(movie_id = movie_id, collection=collection)
+    if not reid_detections:
+        logger.warning("Skipping Movie ID: %s, Because REID detections were not found", movie_id)
+        return False, "REID detections were not found"
+    fusion_pipeline.build_reid_index(movie_id, collection=collection, reid_detections=reid_detections)
+    collection = "s4_visual_clues"
+    if fusion_pipeline.prefetch_visual_clues:
+        fusion_pipeline.prefetch_visual_clues_frames(movie_id, collection=collection)
+
+    fusion_output = {
+        'movie_id': movie_id,
+        'frame_numbers': {}
+    }
+
+    # Iterate over all the RE-ID frames.
+    for reid_detection in reid_detections:
+        reid_frame = reid_detection['frame_num']
+        vc_data = fusion_pipeline.get_visual_clues_data(movie_id = movie_id, collection=collection, frame_num=reid_frame)
+        vc_rois = fusion_pipeline.get_visual_clues_rois(visual_clue_data=vc_data)
             
-            # We detected that the person bbox has already been found.
-            if cur_vc_bbox in detected_person_bboxes:
-                # Get the previous face area
-                prev_face_area = detected_person_bboxes[cur_vc_bbox]
-                
-                temp_corrected_matches = corrected_matches.copy()
-                # Update with the higest area (which is the closest face and our hueristic)
-                # Then proceed to delete the previous intersection from the matches
-                if cur_face_area > prev_face_area:
-                    detected_person_bboxes.update({cur_vc_bbox: cur_face_area})
-
-                    for idx, correct_match in enumerate(temp_corrected_matches):
-                        if correct_match['face_area'] == prev_face_area:
-                            del temp_corrected_matches[idx]
-                            corrected_matches = temp_corrected_matches
-                
-                # Delete the current face area which is smaller/equal than the highest face area
-                # It's equal when a face is fully intersected with two different person bounding boxes.
-                else:
-                    for jdx, correct_match in enumerate(temp_corrected_matches):
-                        # The "str(correct_match['vc_bbox']) == cur_vc_bbox" is important because we want to make sure
-                        # That we delete the face is associated to the same person bbox
-                        # Because the same face can be inside multiple person bboxes with same face area
-                        # If two people are close to one another their bboxes can be big enough to contain the same face
-                        # So we have to make sure the person bbox is the one that we already detected
-                        if correct_match['face_area'] == cur_face_area and \
-                                str(correct_match['vc_bbox']) == cur_vc_bbox: 
-                                
-                            del temp_corrected_matches[jdx]
-                            corrected_matches = temp_corrected_matches
+        reid_bboxes = reid_detection['re-id']
+        # Score the RE-ID face(s) in the current frame against all the Visual Clues
+        # bboxes (that have 'person' in them) at once.
+        fusion_pipeline.add_frame_candidates(fusion_output, reid_frame,
+                                             fusion_pipeline.find_candidates(reid_bboxes, vc_rois))
+    fusion_pipeline.metrics.record_size('fusion_output_bytes', lambda: doc_size(fusion_output))
 
+    movie_names = []
+    gt_data_for_db = []
+    if save_image:
+        movie_id = fusion_output['movie_id']
+        frames = fusion_output['frame_numbers']
+        # The rendering dependencies (OpenCV, PIL, requests) are only imported when QA output is saved.
+        from utils.qa_output import create_qa_output, FUSION_QA_OUTPUT, FUSION_QA_SAMPLE_EVERY
+        qa_output = qa_output or FUSION_QA_OUTPUT
+        qa_sample_every = qa_sample_every or FUSION_QA_SAMPLE_EVERY
+        # The frames are downloaded and drawn on in the background, while the next frames are fused.
+        qa_outputs = {}
+        with fusion_pipeline.create_fusion_writer(collection_name="s4_fusion",
+                                                  key_list=['movie_id', 'frame_num']) as fusion_writer:
+            for frame_num, _ in frames.items():
             
-            # Add the detections.
-            if cur_vc_bbox not in detected_person_bboxes:
-                detected_person_bboxes.update({cur_vc_bbox: cur_face_area})
+                image_url = fusion_pipeline.get_image_url(movie_id, frame_num=int(frame_num), collection="s4_visual_clues")
+                movie_name = image_url.split("/")[-2]
+                logger.debug("Working on movie: %s, frame: %s", movie_name, frame_num)
+                if movie_name not in movie_names:
+                    movie_names.append(movie_name)
 
+                matches = []
+                # Get all the matches for the current frame
+                for intersection in frames[str(frame_num)]['intersections']:
+                    matches.append({
+                                    'reid_bbox':            intersection['reid_bbox'],
+                                    'vc_bbox':              intersection['vc_bbox'],
+                                    'bbox_intersection':    intersection['bbox_intersection'],
+                                    'face_area':            intersection['face_area'],
+                                    'face_id':              intersection['face_id'],
+                                    'vc_id':                intersection['vc_id']
+                                })
             
-            temp_corrected_matches = corrected_matches.copy()
-            # We detected that the face bbox has already been found.
-            if cur_reid_bbox in detected_reid_bboxes:
-                # Calculate the huristic face ('upper half of bbox') center coordinate of
-                # prev face & person bbox and current ones
-                prev_vc_bbox = ast.literal_eval(detected_reid_bboxes[cur_reid_bbox])
-                cur_reid_bbox = ast.literal_eval(cur_reid_bbox)
-                prev_upper_cen_coord = bb_hueristic_face_coordinate(prev_vc_bbox)
-                cur_vc_bbox = ast.literal_eval(cur_vc_bbox)
-                curr_upper_cen_coord = bb_hueristic_face_coordinate(cur_vc_bbox)
-
-                # Check which person bbox is hueristically better matched to the current face bbox
-                # By checking the euclidian distance between the center face and upper center person bboxes.
-                face_center_coord = bb_center_coordinate(cur_reid_bbox)
-
-                prev_vc_bbox_distance = distance_between_two_points(prev_upper_cen_coord, face_center_coord)
-                curr_vc_bbox_distance = distance_between_two_points(curr_upper_cen_coord, face_center_coord)
-
-                if prev_vc_bbox_distance > curr_vc_bbox_distance:
-                    for idx, correct_match in enumerate(temp_corrected_matches):
-                        # We saved the person bbox in `detected_reid_bboxes[cur_reid_bbox]`
-                        # Thats how we can uniquely idenify the person bbox which is further away
-                        # from the current person bbox.
-                        if str(correct_match['vc_bbox']) == detected_reid_bboxes[str(cur_reid_bbox)]:
-                            del temp_corrected_matches[idx]
-                            corrected_matches = temp_corrected_matches
-                else:
-                    # Delete the current face & person bbox
-                    for idx, correct_match in enumerate(temp_corrected_matches):
-                        if correct_match['vc_bbox'] == cur_vc_bbox and \
-                            correct_match['reid_bbox'] == cur_reid_bbox:
-                            del temp_corrected_matches[idx]
-                            corrected_matches = temp_corrected_matches
-                
-            # Add the face detections with their current person bbox for future
-            # calculations such as finding the center coordinate
-            if str(cur_reid_bbox) not in detected_reid_bboxes:
-                detected_reid_bboxes.update({cur_reid_bbox: cur_vc_bbox})
-        
+                post_processed_matches = fusion_pipeline.correct_matches(matches)
 
-        return corrected_matches
+                vc_ids = fusion_pipeline.get_visual_clues_person_ids(movie_id, int(frame_num), collection="s4_visual_clues")
+                face_ids = fusion_pipeline.get_reid_face_ids(movie_id, frame_num, collection="s4_re_id")
+                face_ids_to_actor_names = fusion_pipeline.get_reid_face_ids_with_actor_names(movie_id, frame_num, collection="s4_re_id")
+                matched_ids = []
+                for idx, post_processed_match in enumerate(post_processed_matches):
+                        face_id = str(post_processed_match['face_id'])
+                        vc_id = str(post_processed_match['vc_id'])
 
+                        if face_id in face_ids:
+                            face_ids.remove(face_id)
+                        if vc_id in vc_ids:
+                            vc_ids.remove(vc_id)
+
+                        matched_ids.append((face_id, vc_id))
+                unmatched_face_ids = face_ids
+                unmatched_vc_ids = vc_ids
+                data_for_db = {"movie_id": movie_id, "frame_num": str(frame_num), 'rois': [], 'face_ids_not_matched': unmatched_face_ids}
+                for idx in range(len(matched_ids)):
+                    face_id = matched_ids[idx][0]
+                    vc_id = matched_ids[idx][1]
+                    data_for_db['rois'].append(
+                        {
+                            'face_id': face_id,
+                            'vc_id': vc_id,
+                            'reid_name': face_ids_to_actor_names[int(face_id)]
+                        }
+                    )  
+                for vc_id in unmatched_vc_ids:
+                    data_for_db['rois'].append(
+                        {
+                            'face_id': "-1",
+                            'vc_id': vc_id
+                        }
+                    )  
+                # Draw all the matches on the current frame
+                if post_processed_matches:
+                    if movie_name not in qa_outputs:
+                        qa_outputs[movie_name] = create_qa_output(movie_name, mode=qa_output,
+                                                                  sample_every=qa_sample_every)
+                    qa_outputs[movie_name].add_frame(frame_num, image_url, post_processed_matches,
+                                                     frames[str(frame_num)]['ious'])
         
         
-
-    
-
-
-def main():
-    
+                fusion_pipeline.export_frame(data_for_db, {
+                    (int(intersection['face_id']), int(intersection['vc_id'])):
+                        (intersection['bbox_intersection'], intersection['iou'], intersection['face_area'])
+                    for intersection in frames[str(frame_num)]['intersections']})
+                gt_data_for_db.append(data_for_db)
+                fusion_writer.write(data_for_db)
+        for movie_qa_output in qa_outputs.values():
+            movie_qa_output.close()
+        fusion_pipeline.metrics.record_size('groundtruth_docs_bytes', lambda: doc_size(gt_data_for_db))
+    return True, {'movie_names': movie_names, 'frames': gt_data_for_db}
+
+
+def main(num_workers=FUSION_NUM_WORKERS, replace_ground_truth=False):
+    """
+    Fuses the ground truth movies with their QA output. A movie's ground truth is only written when it has none,
+    unless `replace_ground_truth`: it is what the evaluation (fusion_evaluation.py) compares the fusion to.
+    """
+    configure_fusion_logging()
     fusion_pipeline = FusionPipeline()
     # fusion_pipeline.run_fusion_pipeline(movie_id="Movies/7023181708619934815")
     tag='v100'
@@ -518,177 +1332,29 @@ def main():
     #         else:
     #             print("Invalid movie_id: {}".format(movie_id))
     
-    print("Going over {} movies.".format(len(working_movie_ids)))
+    logger.info("Going over %d movies.", len(working_movie_ids))
 
-    gt_data_for_db = { 'movie_ids':  [] }
+    existing_ground_truth = set() if replace_ground_truth else \
+        set(load_ground_truth(fusion_pipeline.storage, working_movie_ids))
     skipped_movie_ids = []
     movie_names = []
-    for movie_id in working_movie_ids:
-
-        print("Working on Movie ID: {}".format(movie_id))
-        collection = "s4_re_id"
-        reid_detections = fusion_pipeline.get_reid_detections(movie_id = movie_id, collection=collection)
-        if not reid_detections:
-            print("Skipping Movie ID: {}, Because REID detections were not found".format(movie_id))
+    results = run_movies_in_pool(fuse_groundtruth_movie, working_movie_ids, num_workers=num_workers,
+                                 fusion_pipeline=fusion_pipeline)
+    for movie_id, (is_success, movie_output) in results:
+        if not is_success:
             skipped_movie_ids.append(movie_id)
             continue
-        collection = "s4_visual_clues"
-        
-        fusion_output = {
-            'movie_id': movie_id,
-            'frame_numbers': {}
-        }
-        
-        data_for_db = { }
-
-        # Iterate over all the RE-ID frames.
-        for reid_detection in reid_detections:
-            
-            # Mapping between RE-ID details (bbox, frame_num, intersection confidence) and VC bboxes
-            reid_intersections = {}
-            # Mapping between RE-ID bboxes to VC bboxes to save which ones have high intersection
-            map_reid_bbox_to_vc_bbox = {}
-
-            reid_frame = reid_detection['frame_num']
-            vc_data = fusion_pipeline.get_visual_clues_data(movie_id = movie_id, collection=collection, frame_num=reid_frame)
-            vc_rois = fusion_pipeline.get_visual_clues_rois(visual_clue_data=vc_data)
-                
-            reid_bboxes = reid_detection['re-id']
-            # Iterate over the RE-ID face(s) in the current frame (There may be multiple different Face IDs)
-            for reid_bbox_obj in reid_bboxes:
-                face_id = reid_bbox_obj['id']
-                reid_bbox = reid_bbox_obj['bbox']
-
-                # Iterate over Visual Clues bboxes for the specific face. (that have 'person' in them)
-                for vc_roi in vc_rois:
-                    vc_bbox = vc_roi['bbox']
-                    vc_bbox = vc_bbox.replace("[","").replace("]","").split(",")
-                    vc_bbox = [float(xy) for xy in vc_bbox]
-                    bboxes_intersection = fusion_pipeline.calculate_intersection \
-                                            (reid_bbox=reid_bbox, vc_bbox=vc_bbox, movie_id=movie_id, frame_num=reid_frame)
-                    
-                    # Keep the bounding boxes that have high intersection
-                    if bboxes_intersection > INTERSECTION_THRESHOLD:
-                        # Save the information of strong candidates regrding bboxes intersection
-                        reid_frame_str = str(reid_frame)
-                        if reid_frame_str not in fusion_output['frame_numbers']:
-                            fusion_output['frame_numbers'][reid_frame_str] = {'intersections' : [], 'ious': []}
-                        
-                        face_area = bb_smallest_area(reid_bbox, vc_bbox)
-                        iou = bb_intersection_over_union(reid_bbox, vc_bbox)
-                        fusion_output['frame_numbers'][reid_frame_str]['intersections'].append(
-                            {
-                                'reid_bbox': reid_bbox,
-                                'vc_bbox': vc_bbox,
-                                'bbox_intersection': bboxes_intersection,
-                                'face_area': face_area,
-                                'face_id': str(face_id),
-                                'iou': iou,
-                                'vc_id': str(vc_roi['roi_id'])
-                            }
-                        )
-                        if bboxes_intersection == 1.0:
-                            fusion_output['frame_numbers'][reid_frame_str]['ious'].append(
-                                {
-                                    'iou': bboxes_intersection,
-                                    'face_id': str(face_id),
-                                    'vc_id': str(vc_roi['roi_id']),
-                                    'reid_bbox': reid_bbox,
-                                    'vc_bbox': vc_bbox
-                                }
-                            )
-                        
-            # print(reid_intersections)
-        # print(fusion_output)
-        # fusion_pipeline.insert_json_to_db(fusion_output, fusion_pipeline.collection_name)
-
-        save_image = True
-        if save_image:
-            movie_id = fusion_output['movie_id']
-            frames = fusion_output['frame_numbers']
-            for frame_num, _ in frames.items():
-                
-                image_url = fusion_pipeline.get_image_url(movie_id, frame_num=int(frame_num), collection="s4_visual_clues")
-                movie_name = image_url.split("/")[-2]
-                print("Working on movie: {}, frame: {}".format(movie_name, frame_num))
-                if movie_name not in movie_names:
-                    movie_names.append(movie_name)
-
-                matches = []
-                # Get all the matches for the current frame
-                for intersection in frames[str(frame_num)]['intersections']:
-                    matches.append({
-                                    'reid_bbox':            intersection['reid_bbox'],
-                                    'vc_bbox':              intersection['vc_bbox'],
-                                    'bbox_intersection':    intersection['bbox_intersection'],
-                                    'face_area':            intersection['face_area'],
-                                    'face_id':              intersection['face_id'],
-                                    'vc_id':                intersection['vc_id']
-                                })
-                
-                post_processed_matches = fusion_pipeline.correct_matches(matches)
-
-                vc_ids = fusion_pipeline.get_visual_clues_person_ids(movie_id, int(frame_num), collection="s4_visual_clues")
-                face_ids = fusion_pipeline.get_reid_face_ids(movie_id, frame_num, collection="s4_re_id")
-                face_ids_to_actor_names = fusion_pipeline.get_reid_face_ids_with_actor_names(movie_id, frame_num, collection="s4_re_id")
-                matched_ids = []
-                for idx, post_processed_match in enumerate(post_processed_matches):
-                        face_id = str(post_processed_match['face_id'])
-                        vc_id = str(post_processed_match['vc_id'])
-
-                        if face_id in face_ids:
-                            face_ids.remove(face_id)
-                        if vc_id in vc_ids:
-                            vc_ids.remove(vc_id)
-
-                        matched_ids.append((face_id, vc_id))
-                unmatched_face_ids = face_ids
-                unmatched_vc_ids = vc_ids
-                data_for_db = {"movie_id": movie_id, "frame_num": str(frame_num), 'rois': [], 'face_ids_not_matched': unmatched_face_ids}
-                for idx in range(len(matched_ids)):
-                    face_id = matched_ids[idx][0]
-                    vc_id = matched_ids[idx][1]
-                    data_for_db['rois'].append(
-                        {
-                            'face_id': face_id,
-                            'vc_id': vc_id,
-                            'reid_name': face_ids_to_actor_names[int(face_id)]
-                        }
-                    )  
-                for vc_id in unmatched_vc_ids:
-                    data_for_db['rois'].append(
-                        {
-                            'face_id': "-1",
-                            'vc_id': vc_id
-                        }
-                    )  
-                # Draw all the matches on the current frame
-                #faces_no_person.append({'roi_id': vc_roi['roi_id']})
-                #person_no_faces.append(v)
-                if post_processed_matches:
-                    
-                    save_img_with_bboxes(bbox_details=post_processed_matches, image_url=image_url, \
-                                    frame_num=frame_num, movie_name=movie_name)
-                
-                    movie_name_path =  os.path.join(CUR_FOLDER, "images/{}".format(movie_name))
-                    cur_frame_path = os.path.join(movie_name_path, "frame_{}.txt".format(frame_num))
-                    with open(cur_frame_path, 'w+') as f:
-                        for iou_data in frames[str(frame_num)]['ious']:
-                            f.write("-------- IOUs Frame Number: {} -------\n".format(str(frame_num)))
-                            f.write("VC_ID: {}\n".format(iou_data['vc_id']))
-                            f.write("FACE_ID: {}\n".format(iou_data['face_id']))
-                            f.write("VC_BBOX: {}\n".format(iou_data['vc_bbox']))
-                            f.write("FACE_BBOX: {}\n".format(iou_data['reid_bbox']))
-                            f.write("IOU: {}\n".format(iou_data['iou']))
-                            print("-"*20+"\n")
-            
-            
-                gt_data_for_db['movie_ids'].append(data_for_db)
-                fusion_pipeline.insert_json_to_db(data_for_db, collection_name="s4_fusion", key_list=['movie_id', 'frame_num'])
-    print("Skipped movie ids: {}".format(skipped_movie_ids))
-        
-    fusion_pipeline.insert_json_to_db(gt_data_for_db, collection_name="s4_fusion_groundtruth")
-    print("Movie Names: {}".format(movie_names))
+        if movie_id in existing_ground_truth:
+            logger.info("Kept the existing ground truth of Movie ID: %s", movie_id)
+        else:
+            fusion_pipeline.insert_json_to_db(ground_truth_doc(movie_id, movie_output['frames'],
+                                                               movie_output['movie_names']),
+                                              collection_name=GROUND_TRUTH_COLLECTION_NAME, key_list=['movie_id'])
+        for movie_name in movie_output['movie_names']:
+            if movie_name not in movie_names:
+                movie_names.append(movie_name)
+    logger.info("Skipped movie ids: %s", skipped_movie_ids)
+    logger.info("Movie Names: %s", movie_names)
 
 if __name__ == '__main__':
     main()
@@ -1,33 +1,83 @@
 from experts.pipeline.api import PipelineApi, PipelineTask
 import sys
 import os
+import asyncio
 sys.path.append(os.path.dirname(__file__))
-from fusion_task import FusionPipeline
-from typing import Tuple
+from fusion_task import FusionPipeline, run_movies_in_pool, run_movie_fusion, run_movie_fusion_async, \
+    FUSION_NUM_WORKERS
+from utils.fusion_logging import configure_fusion_logging, get_logger
+from typing import List, Tuple
 
-def test_pipeline_task(pipeline_id):
+STOP_ON_FAILURE = os.environ.get('FUSION_STOP_ON_FAILURE', 'false').lower() == 'true'
+USE_ASYNC = os.environ.get('FUSION_USE_ASYNC', 'false').lower() == 'true'
+PIPELINES_COLLECTION_NAME = 'pipelines'
+
+logger = get_logger("run")
+
+def test_pipeline_task(pipeline_id, stop_on_failure=STOP_ON_FAILURE, num_workers=FUSION_NUM_WORKERS):
     class MyTask(PipelineTask):
         def __init__(self):
             super().__init__()
             self.fusion_pipeline = FusionPipeline()
-            print("Initialized successfully.")
-
-        def process_movie(self, movie_id: str) -> Tuple[bool, str]:
-            print (f'handling movie: {movie_id}')
+            # movie_id -> (bool, str) of the movies of the pipeline fused by `fuse_pipeline_movies`.
+            self.results = {}
+            logger.info("Initialized successfully.")
 
-            output = self.fusion_pipeline.run_fusion_pipeline(movie_id)
+        def fuse_pipeline_movies(self, pipeline_id):
+            """
+            Fuses the movies of the pipeline in parallel, `process_movie` then reports their results to the
+            PipelineApi. The movies that are not in the pipeline document are fused by `process_movie` itself.
+            """
+            pipeline_doc = self.fusion_pipeline.storage.get_cached_doc_by_key({'_key': pipeline_id},
+                                                                               PIPELINES_COLLECTION_NAME)
+            movie_ids = list(pipeline_doc.get('movies') or []) if pipeline_doc else []
+            if not movie_ids:
+                logger.warning("No movies found for pipeline %s, fusing them one by one.", pipeline_id)
+                return
+            self.results = dict(run_movies_parallel(movie_ids, num_workers=num_workers,
+                                                    stop_on_failure=stop_on_failure,
+                                                    fusion_pipeline=self.fusion_pipeline))
 
-            print("Finished handling movie.")
-            print(output)
+        def process_movie(self, movie_id: str) -> Tuple[bool, str]:
+            if movie_id in self.results:
+                output = self.results.pop(movie_id)
+            else:
+                logger.info("Handling movie: %s", movie_id)
+                output = run_movies_parallel([movie_id], num_workers=1, fusion_pipeline=self.fusion_pipeline)[0][1]
+            logger.info("Finished handling Movie ID %s: %s", movie_id, output)
             return output
+
         def get_name(self) -> str:
             return "fusion"
 
     pipeline = PipelineApi(None)
     task = MyTask()
-    pipeline.handle_pipeline_task(task, pipeline_id, stop_on_failure=True)
+    task.fuse_pipeline_movies(pipeline_id)
+    pipeline.handle_pipeline_task(task, pipeline_id, stop_on_failure=stop_on_failure)
+
+def run_movies_parallel(movie_ids: List[str], num_workers=FUSION_NUM_WORKERS, stop_on_failure=STOP_ON_FAILURE,
+                        use_async=USE_ASYNC, fusion_pipeline=None) -> List[Tuple[str, Tuple[bool, str]]]:
+    """
+    Fuses the movies with a pool of `num_workers` processes, each with its own FusionPipeline
+    (`fusion_pipeline` with a single worker). A failed movie doesn't stop the others unless `stop_on_failure`
+    is set.
+    """
+    logger.info("Handling %d movies with %d workers", len(movie_ids), num_workers)
+    movie_fn = run_movie_fusion_async if use_async else run_movie_fusion
+    results = run_movies_in_pool(movie_fn, movie_ids, num_workers=num_workers, stop_on_failure=stop_on_failure,
+                                 fusion_pipeline=fusion_pipeline)
+    failed_movie_ids = [movie_id for movie_id, output in results if not output[0]]
+    logger.info("Finished handling movies, %d succeeded, failed: %s", len(results) - len(failed_movie_ids),
+                failed_movie_ids)
+    return results
 
 def test():
+    configure_fusion_logging()
+    # Comma separated movie ids, fused in parallel instead of through the pipeline task.
+    movie_ids = os.environ.get('FUSION_MOVIE_IDS')
+    if movie_ids:
+        run_movies_parallel(movie_ids.split(','))
+        return
     pipeline_id = os.environ.get('PIPELINE_ID')
     # pipeline_id = "dff9a316-4296-45b1-a503-359bb8457bba" 
     # print(pipeline_id)
@@ -0,0 +1,219 @@
+"""
+Pins `correct_matches` (and the FrameCandidates path of the stream) to its two rules: the largest face area wins
+a person bbox, then the nearest upper center wins a face. The original dict based heuristics are kept as a
+reference, they agree with the rules on the frames without conflicts.
+    python -m pytest tests
+"""
+import ast
+import os
+import random
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fusion_task import FusionPipeline, INTERSECTION_THRESHOLD
+from utils.fusion_records import FrameFaces, FrameRois
+from utils.fusion_storage import InMemoryStorage
+from utils.image_utils import bb_intersection, bb_smallest_area, bb_hueristic_face_coordinate, \
+                                bb_center_coordinate, distance_between_two_points
+
+
+def reference_correct_matches(matches):
+    """
+    The original `FusionPipeline.correct_matches`, unchanged. It deletes matches by face area equality and
+    compares a face against person bboxes it already dropped, so it only follows the rules on frames without
+    conflicts.
+    """
+    detected_person_bboxes, detected_reid_bboxes = {}, {}
+
+    corrected_matches = matches.copy()
+
+    for match in matches:
+        cur_reid_bbox = str(match['reid_bbox'])
+        cur_vc_bbox = str(match['vc_bbox'])
+        cur_face_area = match['face_area']
+
+        if cur_vc_bbox in detected_person_bboxes:
+            prev_face_area = detected_person_bboxes[cur_vc_bbox]
+
+            temp_corrected_matches = corrected_matches.copy()
+            if cur_face_area > prev_face_area:
+                detected_person_bboxes.update({cur_vc_bbox: cur_face_area})
+
+                for idx, correct_match in enumerate(temp_corrected_matches):
+                    if correct_match['face_area'] == prev_face_area:
+                        del temp_corrected_matches[idx]
+                        corrected_matches = temp_corrected_matches
+            else:
+                for jdx, correct_match in enumerate(temp_corrected_matches):
+                    if correct_match['face_area'] == cur_face_area and \
+                            str(correct_match['vc_bbox']) == cur_vc_bbox:
+                        del temp_corrected_matches[jdx]
+                        corrected_matches = temp_corrected_matches
+
+        if cur_vc_bbox not in detected_person_bboxes:
+            detected_person_bboxes.update({cur_vc_bbox: cur_face_area})
+
+        temp_corrected_matches = corrected_matches.copy()
+        if cur_reid_bbox in detected_reid_bboxes:
+            prev_vc_bbox = ast.literal_eval(detected_reid_bboxes[cur_reid_bbox])
+            cur_reid_bbox = ast.literal_eval(cur_reid_bbox)
+            prev_upper_cen_coord = bb_hueristic_face_coordinate(prev_vc_bbox)
+            cur_vc_bbox = ast.literal_eval(cur_vc_bbox)
+            curr_upper_cen_coord = bb_hueristic_face_coordinate(cur_vc_bbox)
+
+            face_center_coord = bb_center_coordinate(cur_reid_bbox)
+
+            prev_vc_bbox_distance = distance_between_two_points(prev_upper_cen_coord, face_center_coord)
+            curr_vc_bbox_distance = distance_between_two_points(curr_upper_cen_coord, face_center_coord)
+
+            if prev_vc_bbox_distance > curr_vc_bbox_distance:
+                for idx, correct_match in enumerate(temp_corrected_matches):
+                    if str(correct_match['vc_bbox']) == detected_reid_bboxes[str(cur_reid_bbox)]:
+                        del temp_corrected_matches[idx]
+                        corrected_matches = temp_corrected_matches
+            else:
+                for idx, correct_match in enumerate(temp_corrected_matches):
+                    if correct_match['vc_bbox'] == cur_vc_bbox and \
+                        correct_match['reid_bbox'] == cur_reid_bbox:
+                        del temp_corrected_matches[idx]
+                        corrected_matches = temp_corrected_matches
+
+        if str(cur_reid_bbox) not in detected_reid_bboxes:
+            detected_reid_bboxes.update({cur_reid_bbox: cur_vc_bbox})
+
+    return corrected_matches
+
+
+def rule_correct_matches(matches):
+    """
+    The rules of `resolve_match_conflicts`, one match at a time.
+    """
+    person_matches = {}
+    for idx, match in enumerate(matches):
+        vc_bbox = str(match['vc_bbox'])
+        if vc_bbox not in person_matches or match['face_area'] >= matches[person_matches[vc_bbox]]['face_area']:
+            person_matches[vc_bbox] = idx
+    face_matches = {}
+    for idx in sorted(person_matches.values()):
+        match = matches[idx]
+        distance = distance_between_two_points(bb_hueristic_face_coordinate(match['vc_bbox']),
+                                               bb_center_coordinate(match['reid_bbox']))
+        reid_bbox = str(match['reid_bbox'])
+        if reid_bbox not in face_matches or distance < face_matches[reid_bbox][0]:
+            face_matches[reid_bbox] = (distance, idx)
+    return [matches[idx] for idx in sorted(idx for _, idx in face_matches.values())]
+
+
+def frame_matches(face_bboxes, vc_bboxes):
+    """
+    The matches of a frame, in the order the fusion scores them: by face and then by person ROI.
+    """
+    matches = []
+    for face_id, reid_bbox in enumerate(face_bboxes):
+        for vc_id, vc_bbox in enumerate(vc_bboxes):
+            if bb_intersection(reid_bbox, vc_bbox) > INTERSECTION_THRESHOLD:
+                matches.append({'reid_bbox': reid_bbox, 'vc_bbox': vc_bbox, 'face_area': bb_smallest_area(reid_bbox, vc_bbox),
+                                'face_id': str(face_id), 'vc_id': str(vc_id)})
+    return matches
+
+
+def match_ids(matches):
+    return [(match['face_id'], match['vc_id']) for match in matches]
+
+
+def candidate_match_ids(fusion_pipeline, face_bboxes, vc_bboxes):
+    """
+    The corrected matches of the FrameCandidates path (`score_frame` + `correct_candidates`).
+    """
+    faces = FrameFaces([{'id': face_id, 'bbox': bbox} for face_id, bbox in enumerate(face_bboxes)])
+    rois = FrameRois([{'roi_id': vc_id, 'bbox': str(bbox)} for vc_id, bbox in enumerate(vc_bboxes)])
+    candidates = fusion_pipeline.score_frame(faces, rois)
+    rows = candidates.rows[fusion_pipeline.correct_candidates(candidates)]
+    return [(str(candidates.faces.face_ids[row['face_idx']]), str(candidates.rois.raw_ids[row['vc_idx']]))
+            for row in rows]
+
+
+def random_frame(rng, num_faces, num_rois):
+    vc_bboxes = []
+    for _ in range(num_rois):
+        x, y = rng.randrange(0, 60, 10), rng.randrange(0, 60, 10)
+        vc_bboxes.append([float(x), float(y), float(x + rng.choice([40, 60])), float(y + rng.choice([80, 100]))])
+    face_bboxes = []
+    for _ in range(num_faces):
+        x, y = rng.randrange(0, 80, 10), rng.randrange(0, 60, 10)
+        face_bboxes.append([x, y, x + 10, y + 10])
+    return face_bboxes, vc_bboxes
+
+
+# (face bboxes, person bboxes, corrected (face_id, vc_id) matches)
+PINNED_CASES = {
+    # Two faces of equal face area on one person bbox: the later match is kept.
+    'tie': ([[70, 50, 80, 60], [70, 20, 80, 30]], [[40.0, 0.0, 80.0, 80.0]], [('1', '0')]),
+    # The last face wins both person bboxes (equal face areas) and keeps the nearest one,
+    # the original dropped every match.
+    'collisions': ([[30, 40, 40, 50], [60, 30, 70, 40], [50, 30, 60, 40]],
+                   [[20.0, 30.0, 80.0, 110.0], [30.0, 50.0, 70.0, 130.0], [30.0, 0.0, 90.0, 100.0]], [('2', '0')]),
+    # One face on three person bboxes keeps the nearest one, the original kept two.
+    'face_on_three_boxes': ([[10, 50, 20, 60], [60, 50, 70, 60], [10, 20, 20, 30]],
+                            [[50.0, 10.0, 90.0, 90.0], [30.0, 40.0, 70.0, 120.0], [40.0, 30.0, 100.0, 110.0]],
+                            [('1', '2')]),
+}
+
+
+def fusion_pipeline():
+    return FusionPipeline(storage=InMemoryStorage())
+
+
+def test_pinned_cases():
+    pipeline = fusion_pipeline()
+    for name, (face_bboxes, vc_bboxes, expected) in PINNED_CASES.items():
+        matches = frame_matches(face_bboxes, vc_bboxes)
+        assert match_ids(rule_correct_matches(matches)) == expected, name
+        assert match_ids(pipeline.correct_matches(matches)) == expected, name
+        assert candidate_match_ids(pipeline, face_bboxes, vc_bboxes) == expected, name
+
+
+def test_no_matches():
+    assert fusion_pipeline().correct_matches([]) == []
+
+
+def test_same_as_rules_on_random_frames():
+    pipeline = fusion_pipeline()
+    rng = random.Random(0)
+    num_frames = 0
+    while num_frames < 2000:
+        face_bboxes, vc_bboxes = random_frame(rng, rng.randint(1, 6), rng.randint(1, 6))
+        matches = frame_matches(face_bboxes, vc_bboxes)
+        if not matches:
+            continue
+        num_frames += 1
+        expected = match_ids(rule_correct_matches(matches))
+        corrected_matches = pipeline.correct_matches(matches)
+        assert match_ids(corrected_matches) == expected, (face_bboxes, vc_bboxes)
+        assert candidate_match_ids(pipeline, face_bboxes, vc_bboxes) == expected, (face_bboxes, vc_bboxes)
+        # Every face and every person bbox keeps at most one match.
+        assert len({str(match['reid_bbox']) for match in corrected_matches}) == len(corrected_matches)
+        assert len({str(match['vc_bbox']) for match in corrected_matches}) == len(corrected_matches)
+
+
+def test_same_as_reference_without_conflicts():
+    pipeline = fusion_pipeline()
+    rng = random.Random(1)
+    num_frames = 0
+    while num_frames < 500:
+        face_bboxes, vc_bboxes = random_frame(rng, rng.randint(1, 6), rng.randint(1, 6))
+        matches = frame_matches(face_bboxes, vc_bboxes)
+        if not matches or len({str(match['reid_bbox']) for match in matches}) != len(matches) or \
+                len({str(match['vc_bbox']) for match in matches}) != len(matches):
+            continue
+        num_frames += 1
+        assert match_ids(pipeline.correct_matches(matches)) == match_ids(reference_correct_matches(matches)) == \
+            match_ids(matches)
+
+
+def test_crowded_frame():
+    pipeline = fusion_pipeline()
+    face_bboxes, vc_bboxes = random_frame(random.Random(2), 300, 300)
+    matches = frame_matches(face_bboxes, vc_bboxes)
+    assert len(matches) > 10000
+    assert match_ids(pipeline.correct_matches(matches)) == match_ids(rule_correct_matches(matches))
+    assert candidate_match_ids(pipeline, face_bboxes, vc_bboxes) == match_ids(rule_correct_matches(matches))
@@ -0,0 +1,81 @@
+"""
+Pins the DocCache eviction (least recently used first, after a TTL) and the lookups CachedStorage caches.
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.doc_cache import DocCache, CachedStorage, query_key
+from utils.fusion_metrics import FusionMetrics, MeteredStorage
+from utils.fusion_storage import InMemoryStorage
+
+
+def test_least_recently_used_evicted():
+    cache = DocCache(max_entries=2, ttl=None)
+    cache.put('c', '1', {'x': 1})
+    cache.put('c', '2', {'x': 2})
+    assert cache.get('c', '1') == {'x': 1}
+    cache.put('c', '3', {'x': 3})
+    assert cache.get('c', '2') is None
+    assert cache.get('c', '1') == {'x': 1} and cache.get('c', '3') == {'x': 3}
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_put_again_replaces():
+    cache = DocCache(max_entries=2, ttl=None)
+    cache.put('c', '1', {'x': 1})
+    cache.put('c', '1', {'x': 2})
+    assert len(cache) == 1 and cache.get('c', '1') == {'x': 2}
+
+
+def test_ttl_expiry():
+    cache = DocCache(ttl=0.05)
+    cache.put('c', '1', {'x': 1})
+    cache.put('c', '2', {'x': 2}, ttl=10)
+    assert cache.get('c', '1') == {'x': 1}
+    time.sleep(0.1)
+    assert cache.get('c', '1') is None
+    assert cache.get('c', '2') == {'x': 2}
+    assert len(cache) == 1
+
+
+def test_invalidate():
+    cache = DocCache(ttl=None)
+    for collection in ('a', 'b'):
+        for key in ('1', '2'):
+            cache.put(collection, key, {'x': key})
+    cache.invalidate('a', '1')
+    assert cache.get('a', '1') is None and cache.get('a', '2') is not None
+    cache.invalidate('a')
+    assert cache.get('a', '2') is None and cache.get('b', '1') is not None
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_disabled():
+    cache = DocCache(max_entries=0)
+    cache.put('c', '1', {'x': 1})
+    assert len(cache) == 0
+
+
+def test_only_cached_lookups_are_cached():
+    metrics = FusionMetrics()
+    storage = MeteredStorage(InMemoryStorage({'pipelines': [{'_key': 'p1', 'movies': ['Movies/1']}],
+                                              's4_re_id': [{'movie_id': 'Movies/1', 'frames': []}]}), metrics)
+    cached_storage = CachedStorage(storage, DocCache(ttl=None), metrics)
+    for _ in range(3):
+        assert cached_storage.get_cached_doc_by_key({'_key': 'p1'}, 'pipelines')['movies'] == ['Movies/1']
+        assert cached_storage.get_doc_by_key({'movie_id': 'Movies/1'}, 's4_re_id') is not None
+    assert len(cached_storage.cache) == 1
+    assert cached_storage.cache.get('pipelines', query_key({'_key': 'p1'})) is not None
+    assert metrics.counters['db_round_trips'] == 4
+    assert metrics.counters['doc_cache_hits'] == 2 and metrics.counters['doc_cache_misses'] == 1
+
+
+def test_write_invalidates_the_collection():
+    storage = InMemoryStorage({'pipelines': [{'_key': 'p1', 'tag': 'v1'}]})
+    cached_storage = CachedStorage(storage, DocCache(ttl=None))
+    assert cached_storage.get_cached_doc_by_key({'_key': 'p1'}, 'pipelines')['tag'] == 'v1'
+    cached_storage.write_doc_by_key({'_key': 'p1', 'tag': 'v2'}, 'pipelines', overwrite=True, key_list=['_key'])
+    assert cached_storage.get_cached_doc_by_key({'_key': 'p1'}, 'pipelines')['tag'] == 'v2'
@@ -0,0 +1,87 @@
+"""
+Pins the columnar export of the fused movies: what is written (as .npy columns or as parquet) is read back
+unchanged, and matches the s4_fusion documents of the movie.
+    python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_movie import create_synthetic_storage
+from fusion_task import FusionPipeline
+from utils.fusion_export import MovieExport, EXPORT_COLUMNS, load_movie_export, load_exports
+
+MOVIE_ID = 'Movies/export'
+
+
+def movie_export(export_format, export_dir):
+    export = MovieExport(MOVIE_ID, export_format, str(export_dir))
+    export.add_frame({'frame_num': '11', 'face_ids_not_matched': ['7'],
+                      'rois': [{'face_id': 3, 'vc_id': 1, 'reid_name': 'actor_3'},
+                               {'face_id': -1, 'vc_id': 2}]},
+                     {(3, 1): (0.98, 0.25, 400.0)})
+    export.add_frame({'frame_num': '21', 'face_ids_not_matched': [], 'rois': []}, {})
+    export.add_frame({'frame_num': '31', 'face_ids_not_matched': [],
+                      'rois': [{'face_id': 12, 'vc_id': 0, 'reid_name': 'a much longer actor name'}]},
+                     {(12, 0): (1.0, 0.5, 900.0)})
+    return export
+
+
+def assert_columns_equal(columns, expected):
+    assert list(columns) == list(EXPORT_COLUMNS)
+    for name in EXPORT_COLUMNS:
+        assert len(columns[name]) == len(expected[name])
+        if expected[name].dtype.kind == 'f':
+            assert np.array_equal(columns[name], expected[name], equal_nan=True)
+        else:
+            assert columns[name].tolist() == expected[name].tolist()
+
+
+def round_trip(export_format, tmp_path):
+    export = movie_export(export_format, tmp_path)
+    expected = export.to_arrays()
+    assert expected['frame_num'].tolist() == [11, 11, 11, 31]
+    assert expected['vc_id'].tolist() == [1, 2, -1, 0]
+    assert np.isnan(expected['iou'][1:3]).all()
+    path = export.write()
+    movie_id, columns = load_movie_export(path)
+    assert movie_id == MOVIE_ID
+    assert_columns_equal(columns, expected)
+    # A second export of the movie replaces the first one.
+    assert export.write() == path
+    exports = load_exports(str(tmp_path))
+    assert exports['movie_id'].tolist() == [MOVIE_ID] * 4
+    assert_columns_equal({name: exports[name] for name in EXPORT_COLUMNS}, expected)
+
+
+def test_npy_round_trip(tmp_path):
+    round_trip('npy', tmp_path)
+    _, columns = load_movie_export(os.path.join(str(tmp_path), 'Movies_export'))
+    assert isinstance(columns['iou'], np.memmap)
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    round_trip('parquet', tmp_path)
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        MovieExport(MOVIE_ID, 'csv', str(tmp_path))
+
+
+def test_export_matches_fusion_docs(tmp_path):
+    storage = create_synthetic_storage([MOVIE_ID], 20, 4, 6, 0.9)
+    pipeline = FusionPipeline(storage=storage, export_format='npy', export_dir=str(tmp_path))
+    is_success, _ = pipeline.run_fusion_pipeline(MOVIE_ID)
+    assert is_success
+    _, columns = load_movie_export(os.path.join(str(tmp_path), 'Movies_export'))
+    rows = []
+    for doc in sorted(storage.find_docs({}, 's4_fusion'), key=lambda doc: int(doc['frame_num'])):
+        rows.extend((int(doc['frame_num']), int(roi['face_id']), int(roi['vc_id'])) for roi in doc['rois'])
+        rows.extend((int(doc['frame_num']), int(face_id), -1) for face_id in doc['face_ids_not_matched'])
+    assert list(zip(columns['frame_num'].tolist(), columns['face_id'].tolist(), columns['vc_id'].tolist())) == rows
+    is_matched = (columns['face_id'] != -1) & (columns['vc_id'] != -1)
+    assert is_matched.any()
+    assert not np.isnan(columns['iou'][is_matched]).any() and np.isnan(columns['iou'][~is_matched]).all()
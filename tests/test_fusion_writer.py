@@ -0,0 +1,104 @@
+"""
+Pins the write-behind FusionDocWriter: every document is flushed exactly once, a full queue blocks the producer,
+and a failed flush is raised to the producer.
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.fusion_writer import FusionDocWriter
+
+
+class RecordingFlush:
+    def __init__(self, release=None):
+        self.batches = []
+        self.release = release
+
+    def __call__(self, batch):
+        if self.release is not None:
+            self.release.wait()
+        self.batches.append(list(batch))
+
+
+def test_every_doc_flushed_once():
+    flush_fn = RecordingFlush()
+    with FusionDocWriter(flush_fn, batch_size=64, flush_interval=None, max_queue_size=16) as writer:
+        for idx in range(1000):
+            writer.write({'frame_num': idx})
+    # Closing again flushes nothing.
+    writer.close()
+    docs = [doc['frame_num'] for batch in flush_fn.batches for doc in batch]
+    assert docs == list(range(1000))
+    assert all(len(batch) == 64 for batch in flush_fn.batches[:-1])
+    assert writer.num_docs == 1000 and writer.num_flushes == len(flush_fn.batches) == 16
+    with pytest.raises(RuntimeError):
+        writer.write({'frame_num': 1000})
+
+
+def test_no_docs_no_flush():
+    flush_fn = RecordingFlush()
+    FusionDocWriter(flush_fn).close()
+    assert flush_fn.batches == []
+
+
+def test_flush_interval():
+    flush_fn = RecordingFlush()
+    with FusionDocWriter(flush_fn, batch_size=1000, flush_interval=0.05) as writer:
+        writer.write({'frame_num': 0})
+        writer.write({'frame_num': 1})
+        deadline = time.monotonic() + 5
+        while not flush_fn.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert flush_fn.batches == [[{'frame_num': 0}, {'frame_num': 1}]]
+        writer.write({'frame_num': 2})
+    assert flush_fn.batches[-1] == [{'frame_num': 2}]
+
+
+def test_backpressure():
+    release = threading.Event()
+    flush_fn = RecordingFlush(release)
+    writer = FusionDocWriter(flush_fn, batch_size=1, flush_interval=None, max_queue_size=2)
+    num_written = []
+
+    def produce():
+        for idx in range(10):
+            writer.write({'frame_num': idx})
+            num_written.append(idx)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    time.sleep(0.2)
+    # One document is held by the blocked flush and two wait in the queue.
+    assert producer.is_alive() and len(num_written) == 3
+    release.set()
+    producer.join(5)
+    writer.close()
+    assert not producer.is_alive()
+    assert [batch[0]['frame_num'] for batch in flush_fn.batches] == list(range(10))
+
+
+def test_flush_error_raised_to_producer():
+    def flush_fn(batch):
+        raise ValueError("database is down")
+
+    writer = FusionDocWriter(flush_fn, batch_size=1, flush_interval=None, max_queue_size=2)
+    with pytest.raises(ValueError):
+        # The writer keeps draining the queue, so the producer is not blocked after the error.
+        for idx in range(1000):
+            writer.write({'frame_num': idx})
+            time.sleep(0.001)
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_flush_error_raised_on_close():
+    def flush_fn(batch):
+        raise ValueError("database is down")
+
+    writer = FusionDocWriter(flush_fn, batch_size=100, flush_interval=None)
+    writer.write({'frame_num': 0})
+    with pytest.raises(ValueError):
+        writer.close()
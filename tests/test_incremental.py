@@ -0,0 +1,69 @@
+"""
+Pins the incremental fusion: a frame whose s4_fusion document was fused from the same inputs (the same
+`input_fingerprint`) is reused, the frames whose inputs changed are fused again.
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_movie import create_synthetic_storage
+from fusion_task import FusionPipeline
+from utils.fusion_storage import REID_COLLECTION_NAME
+
+MOVIE_ID = 'Movies/incremental'
+NUM_FRAMES = 30
+
+
+def fusion_docs(storage):
+    return sorted(storage.find_docs({}, 's4_fusion'), key=lambda doc: int(doc['frame_num']))
+
+
+def run_incremental(run_async):
+    storage = create_synthetic_storage([MOVIE_ID], NUM_FRAMES, 4, 6, 0.9)
+    pipeline = FusionPipeline(storage=storage)
+
+    def run(**kwargs):
+        if run_async:
+            is_success, _ = asyncio.run(pipeline.run_fusion_pipeline_async(MOVIE_ID, **kwargs))
+        else:
+            is_success, _ = pipeline.run_fusion_pipeline(MOVIE_ID, **kwargs)
+        assert is_success
+        return dict(pipeline.last_run_stats)
+
+    first_stats = run()
+    first_docs = fusion_docs(storage)
+    assert first_stats == {'frames_recomputed': NUM_FRAMES, 'frames_reused': 0}
+    assert len(first_docs) == NUM_FRAMES and all(doc.get('input_fingerprint') for doc in first_docs)
+
+    # Nothing changed: every frame is reused and its document is left as it is.
+    assert run() == {'frames_recomputed': 0, 'frames_reused': NUM_FRAMES}
+    assert fusion_docs(storage) == first_docs
+
+    # A face of one frame moved: only that frame is fused again.
+    reid_frame = storage.collections[REID_COLLECTION_NAME][0]['frames'][3]
+    reid_frame['re-id'][0]['bbox'][0] += 1
+    assert run() == {'frames_recomputed': 1, 'frames_reused': NUM_FRAMES - 1}
+    changed_docs = fusion_docs(storage)
+    assert [doc['frame_num'] for doc, first_doc in zip(changed_docs, first_docs) if doc != first_doc] == \
+        [first_docs[3]['frame_num']]
+
+    # `force` fuses every frame again.
+    assert run(force=True) == {'frames_recomputed': NUM_FRAMES, 'frames_reused': 0}
+    assert fusion_docs(storage) == changed_docs
+
+
+def test_unchanged_frames_are_reused():
+    run_incremental(run_async=False)
+
+
+def test_unchanged_frames_are_reused_async():
+    run_incremental(run_async=True)
+
+
+def test_not_incremental_fuses_every_frame():
+    storage = create_synthetic_storage([MOVIE_ID], NUM_FRAMES, 4, 6, 0.9)
+    pipeline = FusionPipeline(storage=storage, incremental=False)
+    for _ in range(2):
+        pipeline.run_fusion_pipeline(MOVIE_ID)
+        assert pipeline.last_run_stats == {'frames_recomputed': NUM_FRAMES, 'frames_reused': 0}
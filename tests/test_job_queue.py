@@ -0,0 +1,109 @@
+"""
+Pins the leases of the backfill job queue: an expired lease is claimed again and its movie resumes from the
+checkpointed frames, the heartbeat keeps the lease of a running movie, and a worker that lost its lease does not
+finish the movie.
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_movie import create_synthetic_storage
+from fusion_backfill import drain_queue
+from fusion_task import FusionPipeline
+from utils.job_queue import FusionJobQueue, LeaseLostError
+
+MOVIE_ID = 'Movies/backfill'
+NUM_FRAMES = 30
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    with FusionJobQueue(str(tmp_path / 'queue.sqlite'), lease_seconds=0.2) as job_queue:
+        job_queue.enqueue([MOVIE_ID])
+        assert job_queue.claim('worker-1') == MOVIE_ID
+        assert job_queue.claim('worker-2') is None
+        time.sleep(0.3)
+        assert job_queue.claim('worker-2') == MOVIE_ID
+        with pytest.raises(LeaseLostError):
+            job_queue.renew(MOVIE_ID, 'worker-1')
+        assert not job_queue.complete(MOVIE_ID, 'worker-1')
+        assert job_queue.complete(MOVIE_ID, 'worker-2')
+        assert job_queue.stats()['done'] == 1
+
+
+def test_lease_expired_on_every_attempt_is_failed(tmp_path):
+    with FusionJobQueue(str(tmp_path / 'queue.sqlite'), lease_seconds=0.05, max_attempts=2) as job_queue:
+        job_queue.enqueue([MOVIE_ID])
+        for worker_id in ('worker-1', 'worker-2'):
+            assert job_queue.claim(worker_id) == MOVIE_ID
+            time.sleep(0.1)
+        assert job_queue.claim('worker-3') is None
+        assert job_queue.failed_movies() == {MOVIE_ID: "The lease expired"}
+
+
+def test_failed_movie_is_retried(tmp_path):
+    with FusionJobQueue(str(tmp_path / 'queue.sqlite'), max_attempts=2) as job_queue:
+        job_queue.enqueue([MOVIE_ID])
+        assert job_queue.claim('worker-1') == MOVIE_ID
+        assert job_queue.fail(MOVIE_ID, 'worker-1', "first")
+        assert job_queue.claim('worker-1') == MOVIE_ID
+        assert job_queue.fail(MOVIE_ID, 'worker-1', "second")
+        assert job_queue.claim('worker-1') is None
+        assert job_queue.failed_movies() == {MOVIE_ID: "second"}
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    with FusionJobQueue(str(tmp_path / 'queue.sqlite'), lease_seconds=0.3) as job_queue:
+        job_queue.enqueue([MOVIE_ID])
+        assert job_queue.claim('worker-1') == MOVIE_ID
+        with job_queue.heartbeat(MOVIE_ID, 'worker-1') as heartbeat:
+            time.sleep(1.0)
+            assert job_queue.claim('worker-2') is None
+        assert not heartbeat.lost
+        assert job_queue.complete(MOVIE_ID, 'worker-1')
+
+
+def test_resume_from_checkpoint(tmp_path):
+    queue_path = str(tmp_path / 'queue.sqlite')
+    storage = create_synthetic_storage([MOVIE_ID], NUM_FRAMES, 4, 6, 0.9)
+    pipeline = FusionPipeline(storage=storage, write_batch_size=10)
+    frame_nums = [frame['frame_num'] for frame in storage.collections['s4_re_id'][0]['frames']]
+    # A worker checkpointed the first 10 frames and was killed, their documents are not in this storage.
+    with FusionJobQueue(queue_path, lease_seconds=0.1) as job_queue:
+        job_queue.enqueue([MOVIE_ID])
+        assert job_queue.claim('killed-worker') == MOVIE_ID
+        job_queue.checkpoint_frames(MOVIE_ID, 'killed-worker', frame_nums[:10])
+    time.sleep(0.2)
+
+    assert drain_queue(queue_path, fusion_pipeline=pipeline, worker_id='worker-2') == 1
+    assert pipeline.last_run_stats == {'frames_recomputed': NUM_FRAMES - 10, 'frames_reused': 0,
+                                       'frames_checkpointed': 10}
+    # The checkpointed frames are skipped.
+    assert sorted(int(doc['frame_num']) for doc in storage.find_docs({}, 's4_fusion')) == frame_nums[10:]
+    with FusionJobQueue(queue_path) as job_queue:
+        assert job_queue.stats() == {'pending': 0, 'running': 0, 'done': 1, 'failed': 0, 'checkpointed_frames': 0}
+
+
+class LeaseStealingPipeline:
+    """
+    Stands for a FusionPipeline whose worker loses the lease while the movie is fused.
+    """
+    def __init__(self, queue_path):
+        self.queue_path = queue_path
+
+    def run_fusion_pipeline(self, movie_id, force=False, checkpoint=None):
+        with FusionJobQueue(self.queue_path, lease_seconds=-1) as job_queue:
+            job_queue.renew(movie_id, checkpoint.worker_id)
+        with FusionJobQueue(self.queue_path) as job_queue:
+            assert job_queue.claim('worker-2') == movie_id
+        return True, None
+
+
+def test_lost_lease_is_not_completed(tmp_path):
+    queue_path = str(tmp_path / 'queue.sqlite')
+    with FusionJobQueue(queue_path) as job_queue:
+        job_queue.enqueue([MOVIE_ID])
+    assert drain_queue(queue_path, fusion_pipeline=LeaseStealingPipeline(queue_path), worker_id='worker-1') == 0
+    with FusionJobQueue(queue_path) as job_queue:
+        assert job_queue.stats()['running'] == 1
@@ -0,0 +1,71 @@
+"""
+Pins the grid index of crowded frames (`bb_overlapping_pairs`) to the dense scoring of all the face x ROI pairs:
+both give the same candidate rows.
+    python -m pytest tests
+"""
+import os
+import random
+import sys
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fusion_task
+from benchmarks.synthetic_movie import generate_synthetic_movie
+from fusion_task import FusionPipeline
+from utils.fusion_records import FrameFaces, FrameRois
+from utils.fusion_storage import InMemoryStorage
+from utils.image_utils import bb_overlapping_pairs, bb_intersection_matrix
+
+
+def fusion_pipeline():
+    return FusionPipeline(storage=InMemoryStorage())
+
+
+def score_frames(monkeypatch, min_pairs, frames):
+    monkeypatch.setattr(fusion_task, 'SPATIAL_INDEX_MIN_PAIRS', min_pairs)
+    pipeline = fusion_pipeline()
+    rows = [pipeline.score_frame(FrameFaces(faces), FrameRois(rois)).rows for faces, rois in frames]
+    return rows, pipeline.metrics.counters.get('pairs_evaluated', 0)
+
+
+def synthetic_frames(num_frames, faces_per_frame, rois_per_frame, person_scale=1.0, seed=0):
+    reid_doc, vc_docs = generate_synthetic_movie('Movies/grid', num_frames, faces_per_frame, rois_per_frame, 0.9,
+                                                 seed=seed, person_scale=person_scale)
+    return [(reid_frame['re-id'], vc_doc['roi']) for reid_frame, vc_doc in zip(reid_doc['frames'], vc_docs)]
+
+
+def test_grid_rows_same_as_dense_rows(monkeypatch):
+    for scene in [(25, 30, 1.0), (150, 200, 0.2), (400, 500, 0.1)]:
+        frames = synthetic_frames(5, scene[0], scene[1], person_scale=scene[2])
+        dense_rows, dense_pairs = score_frames(monkeypatch, float('inf'), frames)
+        grid_rows, grid_pairs = score_frames(monkeypatch, 0, frames)
+        assert dense_pairs == 5 * scene[0] * scene[1]
+        for dense, grid in zip(dense_rows, grid_rows):
+            assert dense.dtype == grid.dtype
+            assert np.array_equal(dense, grid)
+        assert sum(len(rows) for rows in dense_rows)
+    # The stadium shot is pruned by the grid.
+    assert grid_pairs < dense_pairs
+
+
+def test_grid_pairs_cover_the_overlapping_pairs():
+    rng = random.Random(1)
+    for _ in range(20):
+        boxesA, boxesB = [], []
+        for boxes, num_boxes, max_size in ((boxesA, rng.randint(1, 60), 40), (boxesB, rng.randint(1, 60), 200)):
+            for _ in range(num_boxes):
+                x1, y1 = rng.uniform(0, 1000), rng.uniform(0, 1000)
+                boxes.append([x1, y1, x1 + rng.uniform(0, max_size), y1 + rng.uniform(0, max_size)])
+        pairs = bb_overlapping_pairs(boxesA, boxesB, max_pairs_fraction=1.0)
+        if pairs is None:
+            continue
+        expected = set(zip(*np.nonzero(bb_intersection_matrix(boxesA, boxesB) > 0)))
+        assert expected <= set(zip(*pairs))
+
+
+def test_grid_gives_up_on_huge_coordinates():
+    assert bb_overlapping_pairs([[0, 0, 10, 10]], [[0, 0, 1e12, 1e12]]) is None
+
+
+def test_no_boxes():
+    face_idxs, vc_idxs = bb_overlapping_pairs(np.empty((0, 4)), [[0, 0, 10, 10]])
+    assert not len(face_idxs) and not len(vc_idxs)
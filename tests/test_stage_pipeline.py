@@ -0,0 +1,94 @@
+"""
+Pins the shutdown of `bounded_stage`: the producing thread stops when the consumer closes the stage or stops
+early, and an error of the producing stage is raised to the consumer.
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.stage_pipeline import bounded_stage
+
+
+def stage_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'fusion-stage']
+
+
+class Producer:
+    def __init__(self, num_items=None, error_at=None):
+        self.num_items = num_items
+        self.error_at = error_at
+        self.produced = 0
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            idx = 0
+            while self.num_items is None or idx < self.num_items:
+                if idx == self.error_at:
+                    raise ValueError("stage failed")
+                self.produced += 1
+                yield idx
+                idx += 1
+        finally:
+            self.closed = True
+
+
+def test_all_items_in_order():
+    assert list(bounded_stage(Producer(100), 4)) == list(range(100))
+    assert not stage_threads()
+
+
+def test_producer_runs_window_ahead():
+    producer = Producer()
+    stage = bounded_stage(producer, 4)
+    assert next(stage) == 0
+    time.sleep(0.2)
+    # The item being consumed, the window and the item waiting on the full window.
+    assert producer.produced <= 1 + 4 + 1
+    stage.close()
+
+
+def test_close_stops_the_producer():
+    producer = Producer()
+    stage = bounded_stage(producer, 2)
+    assert [next(stage) for _ in range(3)] == [0, 1, 2]
+    stage.close()
+    assert producer.closed
+    assert not stage_threads()
+
+
+def test_consumer_error_stops_the_producer():
+    producer = Producer()
+    with pytest.raises(KeyError):
+        for item in bounded_stage(producer, 2):
+            if item == 5:
+                raise KeyError(item)
+    assert producer.closed
+    assert not stage_threads()
+
+
+def test_producer_error_raised_to_consumer():
+    consumed = []
+    with pytest.raises(ValueError):
+        for item in bounded_stage(Producer(error_at=7), 2):
+            consumed.append(item)
+    assert consumed == list(range(7))
+    assert not stage_threads()
+
+
+def test_chained_stages_close():
+    first, second = Producer(), []
+
+    def double(items):
+        for item in items:
+            second.append(item)
+            yield item * 2
+
+    stage = bounded_stage(double(bounded_stage(first, 2)), 2)
+    assert [next(stage) for _ in range(3)] == [0, 2, 4]
+    stage.close()
+    assert first.closed
+    assert not stage_threads()
@@ -0,0 +1,75 @@
+"""
+Pins the temporal propagation of the candidates (`temporal_tolerance`) to the scoring of every frame on its own:
+with a tolerance of 0 only the unchanged faces and ROIs are carried forward, so the s4_fusion documents are the same.
+    python -m pytest tests
+"""
+import ast
+import asyncio
+import os
+import random
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_movie import generate_synthetic_movie
+from fusion_task import FusionPipeline
+from utils.fusion_storage import InMemoryStorage, REID_COLLECTION_NAME, VISUAL_CLUES_COLLECTION_NAME
+
+MOVIE_ID = 'Movies/temporal'
+
+
+def jittered_movie(seed, num_frames=60):
+    """
+    A synthetic movie of 5 frame shots in which, on half of the frames, some faces and ROIs move by a pixel,
+    disappear or swap places.
+    """
+    rng = random.Random(seed)
+    reid_doc, vc_docs = generate_synthetic_movie(MOVIE_ID, num_frames, 12, 15, 0.9, seed=seed, shot_length=5)
+    for reid_frame, vc_doc in zip(reid_doc['frames'], vc_docs):
+        faces = reid_frame['re-id'] = [dict(face) for face in reid_frame['re-id']]
+        rois = vc_doc['roi'] = [dict(roi) for roi in vc_doc['roi']]
+        if rng.random() < 0.5:
+            continue
+        for face in faces:
+            if rng.random() < 0.1:
+                face['bbox'] = [xy + rng.choice([-1, 1]) for xy in face['bbox']]
+        for roi in rois:
+            if rng.random() < 0.1:
+                roi['bbox'] = str([float(xy) + rng.choice([-1, 1]) for xy in ast.literal_eval(roi['bbox'])])
+        if rng.random() < 0.1 and faces:
+            faces.pop(rng.randrange(len(faces)))
+        if rng.random() < 0.1 and rois:
+            rois.pop(rng.randrange(len(rois)))
+        if rng.random() < 0.1:
+            rng.shuffle(faces)
+            rng.shuffle(rois)
+    return reid_doc, vc_docs
+
+
+def fuse(reid_doc, vc_docs, temporal_tolerance, run_async=False):
+    storage = InMemoryStorage({REID_COLLECTION_NAME: [reid_doc], VISUAL_CLUES_COLLECTION_NAME: vc_docs})
+    pipeline = FusionPipeline(storage=storage, incremental=False, temporal_tolerance=temporal_tolerance)
+    if run_async:
+        is_success, _ = asyncio.run(pipeline.run_fusion_pipeline_async(MOVIE_ID))
+    else:
+        is_success, _ = pipeline.run_fusion_pipeline(MOVIE_ID, window_size=4)
+    assert is_success
+    docs = sorted(storage.find_docs({}, 's4_fusion'), key=lambda doc: int(doc['frame_num']))
+    return docs, pipeline.last_run_report['counters']
+
+
+def test_tolerance_0_same_as_full_scoring():
+    for seed in range(4):
+        reid_doc, vc_docs = jittered_movie(seed)
+        full_docs, full_counters = fuse(reid_doc, vc_docs, None)
+        docs, counters = fuse(reid_doc, vc_docs, 0)
+        assert docs == full_docs
+        assert 'frames_propagated' not in full_counters
+        assert counters['frames_propagated'] and counters['frames_partially_rescored']
+        assert counters['pairs_evaluated'] < full_counters['pairs_evaluated']
+
+
+def test_tolerance_0_same_as_full_scoring_async():
+    reid_doc, vc_docs = jittered_movie(7)
+    full_docs, _ = fuse(reid_doc, vc_docs, None, run_async=True)
+    docs, counters = fuse(reid_doc, vc_docs, 0, run_async=True)
+    assert docs == full_docs
+    assert counters.get('frames_propagated', 0) + counters.get('frames_partially_rescored', 0) > 0
@@ -0,0 +1,141 @@
+import collections
+import json
+import os
+import threading
+import time
+from utils.fusion_storage import FIND_BATCH_SIZE
+
+# 0 entries disables the cache.
+FUSION_DOC_CACHE_MAX_ENTRIES = int(os.environ.get("FUSION_DOC_CACHE_MAX_ENTRIES", 1024))
+# Seconds before a cached document is read again from the storage, empty keeps documents until they are evicted.
+FUSION_DOC_CACHE_TTL = os.environ.get("FUSION_DOC_CACHE_TTL", "600")
+FUSION_DOC_CACHE_TTL = float(FUSION_DOC_CACHE_TTL) if FUSION_DOC_CACHE_TTL else None
+
+
+class DocCache:
+    """
+    A thread safe LRU cache of documents keyed by (collection, key), bounded by a number of entries.
+    Entries may expire after a TTL.
+    """
+    def __init__(self, max_entries=FUSION_DOC_CACHE_MAX_ENTRIES, ttl=FUSION_DOC_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (collection, key) -> (document, expiry time or None), least recently used first.
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, collection, key):
+        """
+        Returns the cached document, or None.
+        """
+        with self.lock:
+            entry = self.entries.get((collection, key))
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self.entries[(collection, key)]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((collection, key))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, collection, key, doc, ttl=None):
+        """
+        Caches the document, `ttl` overrides the TTL of the cache.
+        """
+        if not self.enabled:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        with self.lock:
+            self.entries.pop((collection, key), None)
+            self.entries[(collection, key)] = (doc, time.monotonic() + ttl if ttl is not None else None)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection=None, key=None):
+        """
+        Drops the cached document of `key`, all the documents of `collection`, or everything.
+        """
+        with self.lock:
+            if collection is None:
+                self.entries.clear()
+            elif key is not None:
+                self.entries.pop((collection, key), None)
+            else:
+                for entry_key in [entry_key for entry_key in self.entries if entry_key[0] == collection]:
+                    del self.entries[entry_key]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def query_key(query):
+    return json.dumps(query, sort_keys=True, default=str)
+
+
+class CachedStorage:
+    """
+    A read-through cache in front of a FusionStorage: `get_cached_doc_by_key` is served from the DocCache when it
+    can, and every write drops the cached documents of its collection. Only the lookups that repeat across frames or
+    movies (the movie and pipeline documents) go through it, `get_doc_by_key` reads the storage, so the one-time reads
+    of the RE-ID and Visual Clues documents never fill the cache.
+    The cached documents are shared between the callers, which must not modify them.
+    The hits and misses of the current movie are counted into `self.metrics`.
+    """
+    def __init__(self, storage, cache=None, metrics=None):
+        self.storage = storage
+        self.cache = cache if cache is not None else DocCache()
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.count(name)
+
+    def get_doc_by_key(self, query, collection):
+        return self.storage.get_doc_by_key(query, collection)
+
+    def get_cached_doc_by_key(self, query, collection):
+        if not self.cache.enabled:
+            return self.storage.get_doc_by_key(query, collection)
+        key = query_key(query)
+        doc = self.cache.get(collection, key)
+        if doc is not None:
+            self.count('doc_cache_hits')
+            return doc
+        self.count('doc_cache_misses')
+        doc = self.storage.get_doc_by_key(query, collection)
+        if doc:
+            self.cache.put(collection, key, doc)
+        return doc
+
+    def find_docs(self, filters, collection, fields=None, batch_size=FIND_BATCH_SIZE, sort=None):
+        return self.storage.find_docs(filters, collection, fields=fields, batch_size=batch_size, sort=sort)
+
+    def write_doc_by_key(self, doc, collection, overwrite=False, key_list=[]):
+        try:
+            return self.storage.write_doc_by_key(doc, collection, overwrite=overwrite, key_list=key_list)
+        finally:
+            self.cache.invalidate(collection)
+
+    def write_docs_by_key(self, docs, collection, key_list=[]):
+        try:
+            return self.storage.write_docs_by_key(docs, collection, key_list=key_list)
+        finally:
+            self.cache.invalidate(collection)
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+import PIL.ImageColor as ImageColor
+from requests.adapters import HTTPAdapter
+
+from utils.image_utils import plot_one_box
+from utils.fusion_logging import get_logger
+
+CUR_FOLDER = os.path.abspath(__file__ + "/../../")
+IMAGES_DIR = os.path.join(CUR_FOLDER, "images")
+FRAME_CACHE_DIR = os.environ.get("FUSION_FRAME_CACHE_DIR", os.path.join(CUR_FOLDER, "frame_cache"))
+RENDER_NUM_THREADS = int(os.environ.get("FUSION_RENDER_NUM_THREADS", 8))
+HTTP_TIMEOUT = 30
+HTTP_MAX_RETRIES = 3
+
+logger = get_logger("renderer")
+
+_color_space = None
+_default_renderer = None
+_default_renderer_lock = threading.Lock()
+
+
+def get_color_space():
+    """
+    The named colors of PIL (without the first, light ones), built once.
+    """
+    global _color_space
+    if _color_space is None:
+        _color_space = [ImageColor.getrgb(n) for n, c in ImageColor.colormap.items()][7:]
+    return _color_space
+
+
+def face_color(face_id):
+    """
+    A color per face id, so a face keeps its color across the frames of a movie.
+    """
+    color_space = get_color_space()
+    try:
+        return list(color_space[int(face_id) % len(color_space)])
+    except (TypeError, ValueError):
+        return [random.randint(0, 255) for _ in range(3)]
+
+
+class FrameRenderer:
+    """
+    Renders the QA overlays of frames concurrently.
+    Frames are downloaded through one pooled, keep-alive HTTP session and cached on disk by the sha1 of their URL,
+    so a frame is downloaded once across runs. Fetch, decode, draw and encode run on a thread pool
+    (cv2 and the sockets release the GIL), `submit` returns a future and `wait` collects the rendered paths.
+    """
+    def __init__(self, cache_dir=FRAME_CACHE_DIR, images_dir=IMAGES_DIR, num_threads=RENDER_NUM_THREADS,
+                 timeout=HTTP_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.images_dir = images_dir
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=num_threads, pool_maxsize=num_threads, max_retries=HTTP_MAX_RETRIES)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="fusion-render")
+        self.futures = []
+        self.futures_lock = threading.Lock()
+
+    def cache_path(self, url):
+        url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, url_hash[:2], url_hash)
+
+    def fetch_frame(self, url):
+        """
+        Returns the encoded bytes of the frame, from the disk cache or downloaded (and then cached).
+        """
+        path = self.cache_path(url)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, a concurrent reader never sees a partial frame.
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(resp.content)
+        os.replace(tmp_path, path)
+        return resp.content
+
+    def draw_frame(self, bbox_details, image_url, frame_num):
+        """
+        Returns the decoded frame with the matched face and person bboxes drawn on it.
+        """
+        image = np.frombuffer(self.fetch_frame(image_url), dtype="uint8")
+        img_orig = cv2.imdecode(image, cv2.IMREAD_COLOR)
+        if img_orig is None:
+            raise ValueError("Frame {} could not be decoded: {}".format(frame_num, image_url))
+        for cur_details in bbox_details:
+            face_id = cur_details['face_id']
+            color = face_color(face_id)
+            plot_one_box(cur_details['reid_bbox'], img_orig, label=face_id, color=color, line_thickness=3)
+            plot_one_box(cur_details['vc_bbox'], img_orig, label=face_id, color=color, line_thickness=3)
+        return img_orig
+
+    def render_frame(self, bbox_details, image_url, frame_num, movie_name):
+        """
+        Draws the matched face and person bboxes on the frame and saves it as images/<movie_name>/frame_<num>.jpg.
+        Returns the path of the saved image.
+        """
+        img_orig = self.draw_frame(bbox_details, image_url, frame_num)
+        movie_name_path = os.path.join(self.images_dir, movie_name)
+        os.makedirs(movie_name_path, exist_ok=True)
+        image_path = os.path.join(movie_name_path, "frame_{}.jpg".format(frame_num))
+        cv2.imwrite(image_path, img_orig)
+        logger.debug("The image is saved with bboxes: %s", image_path)
+        return image_path
+
+    def submit(self, bbox_details, image_url, frame_num, movie_name):
+        future = self.executor.submit(self.render_frame, bbox_details, image_url, frame_num, movie_name)
+        with self.futures_lock:
+            self.futures.append(future)
+        return future
+
+    def submit_draw(self, bbox_details, image_url, frame_num):
+        """
+        Draws the frame on the pool, the caller owns the returned future (`wait` does not collect it).
+        """
+        return self.executor.submit(self.draw_frame, bbox_details, image_url, frame_num)
+
+    def wait(self):
+        """
+        Waits for the submitted frames, returns the paths of the rendered ones.
+        A frame that failed is logged and skipped, QA rendering never fails the fusion.
+        """
+        with self.futures_lock:
+            futures, self.futures = self.futures, []
+        image_paths = []
+        for future in futures:
+            try:
+                image_paths.append(future.result())
+            except Exception:
+                logger.exception("Failed to render a frame")
+        return image_paths
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_frame_renderer():
+    """
+    The FrameRenderer of the process, created on first use.
+    """
+    global _default_renderer
+    with _default_renderer_lock:
+        if _default_renderer is None:
+            _default_renderer = FrameRenderer()
+        return _default_renderer
@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import numpy as np
+
+# 'npy' writes a directory of one .npy file per column per movie, 'parquet' one .parquet file per movie
+# (needs pyarrow). Unset exports nothing.
+FUSION_EXPORT_FORMAT = os.environ.get("FUSION_EXPORT_FORMAT") or None
+FUSION_EXPORT_DIR = os.environ.get("FUSION_EXPORT_DIR", "fusion_export")
+# Only export, the s4_fusion documents are not written.
+FUSION_EXPORT_ONLY = os.environ.get("FUSION_EXPORT_ONLY", "false").lower() == "true"
+EXPORT_FORMATS = ('npy', 'parquet')
+EXPORT_META_NAME = "_movie.json"
+
+# One row per person ROI and per unmatched face of every frame. The unmatched ROIs have face_id -1, the unmatched
+# faces vc_id -1, and the scores of both are NaN.
+EXPORT_COLUMNS = ('frame_num', 'face_id', 'vc_id', 'reid_name', 'bbox_intersection', 'iou', 'face_area')
+EXPORT_DTYPES = {
+    'frame_num': np.int32,
+    'face_id': np.int64,
+    'vc_id': np.int64,
+    'bbox_intersection': np.float64,
+    'iou': np.float64,
+    'face_area': np.float64,
+}
+_NO_SCORES = (np.nan, np.nan, np.nan)
+
+
+def export_name(movie_id):
+    return movie_id.replace("/", "_")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet export needs pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+class MovieExport:
+    """
+    Collects the fused frames of a movie into columns, and writes them with `write` once the movie succeeded.
+    """
+    def __init__(self, movie_id, export_format, export_dir=FUSION_EXPORT_DIR):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError("Unknown export format: {}, expected one of {}".format(export_format, EXPORT_FORMATS))
+        if export_format == 'parquet':
+            _import_pyarrow()
+        self.movie_id = movie_id
+        self.export_format = export_format
+        self.export_dir = export_dir
+        self.columns = {name: [] for name in EXPORT_COLUMNS}
+
+    def add_row(self, frame_num, face_id, vc_id, reid_name, scores):
+        columns = self.columns
+        columns['frame_num'].append(frame_num)
+        columns['face_id'].append(face_id)
+        columns['vc_id'].append(vc_id)
+        columns['reid_name'].append(reid_name or "")
+        columns['bbox_intersection'].append(scores[0])
+        columns['iou'].append(scores[1])
+        columns['face_area'].append(scores[2])
+
+    def add_frame(self, data_for_db, match_scores):
+        """
+        Adds the rows of an s4_fusion document. `match_scores` maps the (int face_id, int vc_id) matches
+        to their (bbox_intersection, iou, face_area).
+        """
+        frame_num = int(data_for_db['frame_num'])
+        for roi in data_for_db['rois']:
+            face_id, vc_id = int(roi['face_id']), int(roi['vc_id'])
+            self.add_row(frame_num, face_id, vc_id, roi.get('reid_name'), match_scores.get((face_id, vc_id), _NO_SCORES))
+        for face_id in data_for_db['face_ids_not_matched']:
+            self.add_row(frame_num, int(face_id), -1, None, _NO_SCORES)
+
+    def __len__(self):
+        return len(self.columns['frame_num'])
+
+    def to_arrays(self):
+        arrays = {name: np.asarray(values, dtype=EXPORT_DTYPES[name]) for name, values in self.columns.items()
+                  if name in EXPORT_DTYPES}
+        # Fixed width strings, so the column can be memory-mapped like the others.
+        arrays['reid_name'] = np.asarray(self.columns['reid_name'], dtype=np.str_).astype(
+            'U{}'.format(max([len(name) for name in self.columns['reid_name']] + [1])))
+        return {name: arrays[name] for name in EXPORT_COLUMNS}
+
+    def write(self):
+        """
+        Writes the movie's file (or directory), replacing the previous export of the movie. Returns its path.
+        """
+        os.makedirs(self.export_dir, exist_ok=True)
+        arrays = self.to_arrays()
+        path = os.path.join(self.export_dir, export_name(self.movie_id))
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        if self.export_format == 'parquet':
+            pyarrow = _import_pyarrow()
+            path += ".parquet"
+            table = pyarrow.table(arrays).replace_schema_metadata({'movie_id': self.movie_id})
+            pyarrow.parquet.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+            return path
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+        with open(os.path.join(tmp_path, EXPORT_META_NAME), 'w') as f:
+            json.dump({'movie_id': self.movie_id, 'num_rows': len(self), 'columns': list(EXPORT_COLUMNS)}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return path
+
+
+def load_movie_export(path, columns=EXPORT_COLUMNS, mmap_mode='r'):
+    """
+    Reads an exported movie, returns (movie_id, column name -> array). The .npy columns are memory-mapped
+    with `mmap_mode` (None reads them into memory), the parquet file is read through a memory map.
+    """
+    if path.endswith(".parquet"):
+        pyarrow = _import_pyarrow()
+        table = pyarrow.parquet.read_table(path, columns=list(columns), memory_map=True)
+        movie_id = (table.schema.metadata or {}).get(b'movie_id', b'').decode()
+        return movie_id, {name: table.column(name).to_numpy() for name in columns}
+    with open(os.path.join(path, EXPORT_META_NAME)) as f:
+        movie_id = json.load(f)['movie_id']
+    return movie_id, {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in columns}
+
+
+def iter_exports(export_dir=FUSION_EXPORT_DIR, columns=EXPORT_COLUMNS, mmap_mode='r'):
+    """
+    Yields (movie_id, columns) for every movie exported to `export_dir`.
+    """
+    for name in sorted(os.listdir(export_dir)):
+        path = os.path.join(export_dir, name)
+        if name.endswith(".tmp"):
+            continue
+        if name.endswith(".parquet") or os.path.isfile(os.path.join(path, EXPORT_META_NAME)):
+            yield load_movie_export(path, columns=columns, mmap_mode=mmap_mode)
+
+
+def load_exports(export_dir=FUSION_EXPORT_DIR, columns=EXPORT_COLUMNS):
+    """
+    The columns of all the movies exported to `export_dir` concatenated, with a 'movie_id' column.
+    """
+    movie_ids = []
+    arrays = {name: [] for name in columns}
+    for movie_id, movie_columns in iter_exports(export_dir, columns=columns):
+        num_rows = len(movie_columns[columns[0]]) if columns else 0
+        movie_ids.append(np.full(num_rows, movie_id))
+        for name in columns:
+            arrays[name].append(movie_columns[name])
+    result = {name: np.concatenate(values) if values else np.empty(0) for name, values in arrays.items()}
+    result['movie_id'] = np.concatenate(movie_ids) if movie_ids else np.empty(0, dtype=np.str_)
+    return result
@@ -0,0 +1,81 @@
+import logging
+import os
+import sys
+import threading
+
+FUSION_LOGGER_NAME = "fusion"
+FUSION_LOG_LEVEL = os.environ.get("FUSION_LOG_LEVEL", "INFO").upper()
+# Per-pair and per-frame debug events are logged once every FUSION_LOG_SAMPLE_EVERY events.
+FUSION_LOG_SAMPLE_EVERY = int(os.environ.get("FUSION_LOG_SAMPLE_EVERY", 1000))
+LOG_FORMAT = "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"
+_configured_level = None
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """
+    Writes to the current sys.stdout, so redirecting stdout also redirects the logs.
+    """
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, stream):
+        pass
+
+
+def configure_fusion_logging(level=FUSION_LOG_LEVEL):
+    """
+    Sets the level of the "fusion" loggers. Unless the application configured logging,
+    they log to stdout (where the prints used to go) with one line per record.
+    Called by the entry points (and their worker processes), importing the fusion configures nothing.
+    """
+    global _configured_level
+    _configured_level = level
+    logger = logging.getLogger(FUSION_LOGGER_NAME)
+    logger.setLevel(level)
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = _StdoutHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.addHandler(handler)
+        logger.propagate = False
+    return logger
+
+
+def configured_level():
+    """
+    The level of the last `configure_fusion_logging` of this process, None when it was not called.
+    Spawned worker processes configure their logging with it.
+    """
+    return _configured_level
+
+
+def get_logger(name):
+    """
+    Returns the "fusion.<name>" logger.
+    """
+    return logging.getLogger("{}.{}".format(FUSION_LOGGER_NAME, name))
+
+
+class SampledLogger:
+    """
+    Debug logging for high rate events: only one of every `every` events of the same key is logged.
+    When debug is disabled, `debug` returns before counting or formatting anything.
+    """
+    def __init__(self, logger, every=FUSION_LOG_SAMPLE_EVERY):
+        self.logger = logger
+        self.every = max(1, every)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def is_enabled(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, key, msg, *args):
+        if not self.is_enabled():
+            return
+        with self.lock:
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+        if (count - 1) % self.every == 0:
+            self.logger.debug("[%s #%d, 1 in %d] " + msg, key, count, self.every, *args)
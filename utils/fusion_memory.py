@@ -0,0 +1,138 @@
+import os
+import sys
+import threading
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Opt-in, tracing the allocations slows the fusion down.
+FUSION_MEMORY_PROFILE = os.environ.get("FUSION_MEMORY_PROFILE", "false").lower() == "true"
+FUSION_MEMORY_TOP_ALLOCATORS = int(os.environ.get("FUSION_MEMORY_TOP_ALLOCATORS", 10))
+# A stage takes a new snapshot of the allocators when the traced memory grew by this many bytes
+# since its last one, which bounds the number of (slow) snapshots of a movie.
+MEMORY_SNAPSHOT_STEP = 1024 * 1024
+_IGNORED_FILES = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>",
+                  "<unknown>")
+
+
+def peak_rss_bytes():
+    """
+    The peak resident set size of the process, None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """
+    The resident set size of the process, None when /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def top_allocators(snapshot, baseline=None, limit=FUSION_MEMORY_TOP_ALLOCATORS):
+    """
+    The source lines that hold the most memory in `snapshot`, or that grew the most since `baseline`.
+    """
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, name) for name in _IGNORED_FILES])
+    if baseline is not None:
+        stats = snapshot.compare_to(baseline, 'lineno')
+        stats.sort(key=lambda stat: stat.size_diff, reverse=True)
+        return [{'location': "{}:{}".format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                 'size_bytes': stat.size_diff, 'count': stat.count_diff} for stat in stats[:limit] if stat.size_diff > 0]
+    return [{'location': "{}:{}".format(stat.traceback[0].filename, stat.traceback[0].lineno),
+             'size_bytes': stat.size, 'count': stat.count} for stat in snapshot.statistics('lineno')[:limit]]
+
+
+class MemoryProfile:
+    """
+    The memory accounting of a movie: the peak RSS of the process, the peak memory traced by tracemalloc,
+    per stage the highest traced memory at the end of the stage and the top allocators at that point, and the
+    sizes of the large structures of the movie (see `record_size`).
+    Stages report to it from `FusionMetrics.stage`, on any thread.
+    """
+    def __init__(self, movie_id=None, top_allocators=FUSION_MEMORY_TOP_ALLOCATORS, snapshot_step=MEMORY_SNAPSHOT_STEP):
+        self.movie_id = movie_id
+        self.top_allocators = top_allocators
+        self.snapshot_step = snapshot_step
+        self.started_tracing = False
+        self.baseline = None
+        self.rss_start_bytes = None
+        self.stages = {}
+        self.sizes = {}
+        self.peak_traced_bytes = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.baseline = tracemalloc.take_snapshot()
+        self.rss_start_bytes = current_rss_bytes()
+
+    def stop(self):
+        """
+        Stops tracing, if this profile started it.
+        """
+        if tracemalloc.is_tracing():
+            self.peak_traced_bytes = max(self.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+            if self.started_tracing:
+                tracemalloc.stop()
+        self.started_tracing = False
+
+    def stage_finished(self, name):
+        if not tracemalloc.is_tracing():
+            return
+        traced_bytes = tracemalloc.get_traced_memory()[0]
+        with self.lock:
+            stage = self.stages.setdefault(name, {'max_traced_bytes': 0, 'snapshot_traced_bytes': None,
+                                                  'top_allocators': []})
+            if traced_bytes <= stage['max_traced_bytes']:
+                return
+            stage['max_traced_bytes'] = traced_bytes
+            if stage['snapshot_traced_bytes'] is not None and \
+                    traced_bytes < stage['snapshot_traced_bytes'] + self.snapshot_step:
+                return
+            stage['snapshot_traced_bytes'] = traced_bytes
+        allocators = top_allocators(tracemalloc.take_snapshot(), self.baseline, self.top_allocators)
+        with self.lock:
+            if stage['snapshot_traced_bytes'] == traced_bytes:
+                stage['top_allocators'] = allocators
+
+    def record_size(self, name, nbytes):
+        """
+        Keeps the largest size recorded under `name`, e.g. the RE-ID document or the candidates of a frame.
+        """
+        with self.lock:
+            self.sizes[name] = max(self.sizes.get(name, 0), nbytes)
+
+    def to_report(self):
+        if tracemalloc.is_tracing():
+            self.peak_traced_bytes = max(self.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+        with self.lock:
+            stages = {name: {'max_traced_bytes': stage['max_traced_bytes'], 'top_allocators': stage['top_allocators']}
+                      for name, stage in self.stages.items()}
+            sizes = dict(self.sizes)
+        peak_stage = max(stages.values(), key=lambda stage: stage['max_traced_bytes'], default=None)
+        return {
+            'peak_rss_bytes': peak_rss_bytes(),
+            'rss_start_bytes': self.rss_start_bytes,
+            'rss_end_bytes': current_rss_bytes(),
+            'peak_traced_bytes': self.peak_traced_bytes,
+            'sizes': sizes,
+            'stages': stages,
+            # The allocators of the stage that saw the highest traced memory.
+            'top_allocators': peak_stage['top_allocators'] if peak_stage else [],
+        }
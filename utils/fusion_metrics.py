@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from utils.fusion_storage import FIND_BATCH_SIZE
+
+# The stages that wait on the database, the others are compute.
+DB_STAGES = ('reid_fetch', 'vc_fetch', 'db_write')
+COMPUTE_STAGES = ('candidate_generation', 'correct_matches')
+# MeteredStorage sizes one in this many documents as JSON to estimate the bytes read and written, 0 only counts
+# the documents.
+FUSION_METRICS_BYTES_SAMPLE_EVERY = int(os.environ.get("FUSION_METRICS_BYTES_SAMPLE_EVERY", 0))
+
+
+def doc_size(doc):
+    """
+    The size in bytes of a document as JSON, an estimate of what it weighs on the wire.
+    """
+    return len(json.dumps(doc, default=str, separators=(',', ':'), check_circular=False))
+
+
+class FusionMetrics:
+    """
+    Per-movie timings and counters of a fusion run.
+    Stages may run on several threads at once, so the stage times can add up to more than the wall time.
+    With a `memory` profile (see utils/fusion_memory.py) the memory is also accounted at the end of every stage.
+    """
+    def __init__(self, movie_id=None, memory=None):
+        self.movie_id = movie_id
+        self.memory = memory
+        self.start_time = time.perf_counter()
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+                self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+            if self.memory is not None:
+                self.memory.stage_finished(name)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_size(self, name, nbytes_fn):
+        """
+        Records the size `nbytes_fn()` into the memory profile, `nbytes_fn` is only called when profiling.
+        """
+        if self.memory is not None:
+            self.memory.record_size(name, nbytes_fn())
+
+    def to_report(self, success=None, run_stats=None):
+        """
+        The JSON report of the run. `bound` tells whether the run spent more time waiting on the database
+        or computing the matches.
+        """
+        with self.lock:
+            stages = {name: {'seconds': seconds, 'calls': self.stage_calls[name]}
+                      for name, seconds in self.stage_seconds.items()}
+            counters = dict(self.counters)
+        counters.update(run_stats or {})
+        db_seconds = sum(self.stage_seconds.get(name, 0.0) for name in DB_STAGES)
+        compute_seconds = sum(self.stage_seconds.get(name, 0.0) for name in COMPUTE_STAGES)
+        report = {
+            'movie_id': self.movie_id,
+            'success': success,
+            'wall_seconds': time.perf_counter() - self.start_time,
+            'db_seconds': db_seconds,
+            'compute_seconds': compute_seconds,
+            'bound': 'db' if db_seconds >= compute_seconds else 'compute',
+            'stages': stages,
+            'counters': counters,
+        }
+        if self.memory is not None:
+            report['memory'] = self.memory.to_report()
+        return report
+
+
+class MeteredStorage:
+    """
+    Wraps a FusionStorage and counts the database round-trips and the documents read and written
+    into `self.metrics`, which the pipeline replaces for every movie.
+    With `bytes_sample_every` one in that many documents is sized as JSON and the bytes read and written are
+    estimated from it, sizing every document would cost as much as the fusion of a frame.
+    """
+    def __init__(self, storage, metrics=None, bytes_sample_every=FUSION_METRICS_BYTES_SAMPLE_EVERY):
+        self.storage = storage
+        self.metrics = metrics if metrics is not None else FusionMetrics()
+        self.bytes_sample_every = bytes_sample_every
+        self.num_docs = 0
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def count_docs(self, metrics, name, docs):
+        metrics.count('db_docs_' + name, len(docs))
+        if self.bytes_sample_every <= 0:
+            return
+        # Not locked: a lost update only moves the sample by a document.
+        first = -self.num_docs % self.bytes_sample_every
+        self.num_docs += len(docs)
+        for doc in docs[first::self.bytes_sample_every]:
+            metrics.count('db_bytes_' + name, doc_size(doc) * self.bytes_sample_every)
+
+    def get_doc_by_key(self, query, collection):
+        doc = self.storage.get_doc_by_key(query, collection)
+        self.metrics.count('db_round_trips')
+        if doc:
+            self.count_docs(self.metrics, 'read', [doc])
+        return doc
+
+    def find_docs(self, filters, collection, fields=None, batch_size=FIND_BATCH_SIZE, sort=None):
+        metrics = self.metrics
+        metrics.count('db_round_trips')
+        for idx, doc in enumerate(self.storage.find_docs(filters, collection, fields=fields, batch_size=batch_size,
+                                                         sort=sort)):
+            if idx and not idx % batch_size:
+                # The cursor fetches the next batch.
+                metrics.count('db_round_trips')
+            self.count_docs(metrics, 'read', [doc])
+            yield doc
+
+    def write_doc_by_key(self, doc, collection, overwrite=False, key_list=[]):
+        res = self.storage.write_doc_by_key(doc, collection, overwrite=overwrite, key_list=key_list)
+        self.metrics.count('db_round_trips')
+        self.count_docs(self.metrics, 'written', [doc])
+        return res
+
+    def write_docs_by_key(self, docs, collection, key_list=[]):
+        res = self.storage.write_docs_by_key(docs, collection, key_list=key_list)
+        self.metrics.count('db_round_trips')
+        self.count_docs(self.metrics, 'written', docs)
+        return res
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus_textfile(path, report):
+    """
+    Writes the report of a fusion run in the Prometheus textfile collector format.
+    The file is replaced atomically, so the collector never reads a partial file.
+    """
+    movie_label = 'movie_id="{}"'.format(_escape_label(report['movie_id']))
+    lines = [
+        '# HELP fusion_stage_seconds Seconds spent in each stage of the last fused movie.',
+        '# TYPE fusion_stage_seconds gauge',
+    ]
+    for stage, values in sorted(report['stages'].items()):
+        lines.append('fusion_stage_seconds{{{},stage="{}"}} {}'.format(movie_label, stage, values['seconds']))
+    for name, value in sorted(report['counters'].items()):
+        lines.append('# TYPE fusion_{} gauge'.format(name))
+        lines.append('fusion_{}{{{}}} {}'.format(name, movie_label, value))
+    lines.append('# TYPE fusion_wall_seconds gauge')
+    lines.append('fusion_wall_seconds{{{}}} {}'.format(movie_label, report['wall_seconds']))
+    memory = report.get('memory')
+    if memory:
+        for name in ('peak_rss_bytes', 'peak_traced_bytes'):
+            if memory[name] is not None:
+                lines.append('# TYPE fusion_{} gauge'.format(name))
+                lines.append('fusion_{}{{{}}} {}'.format(name, movie_label, memory[name]))
+        for name, value in sorted(memory['sizes'].items()):
+            lines.append('# TYPE fusion_{} gauge'.format(name))
+            lines.append('fusion_{}{{{}}} {}'.format(name, movie_label, value))
+    lines.append('# TYPE fusion_success gauge')
+    lines.append('fusion_success{{{}}} {}'.format(movie_label, int(bool(report['success']))))
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
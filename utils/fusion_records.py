@@ -0,0 +1,149 @@
+import sys
+import numpy as np
+
+# One row per face/person ROI pair that passed the intersection threshold.
+CANDIDATE_DTYPE = np.dtype([
+    ('face_idx', np.int32),
+    ('vc_idx', np.int32),
+    ('bbox_intersection', np.float64),
+    ('face_area', np.float64),
+    ('iou', np.float64),
+])
+
+
+def parse_bbox(bbox):
+    """
+    Visual Clues bboxes are stored as strings, e.g. "[1.0, 2.0, 3.0, 4.0]".
+    """
+    if isinstance(bbox, str):
+        bbox = bbox.replace("[","").replace("]","").split(",")
+    return [float(xy) for xy in bbox]
+
+
+class FrameFaces:
+    """
+    The RE-ID faces of a frame, parsed once: integer face ids and an (N, 4) bbox array.
+    The boxes are kept in float64 so the scores are identical to the scalar bbox functions.
+    """
+    __slots__ = ('face_ids', 'bboxes', 'raw_bboxes')
+
+    def __init__(self, reid_bboxes):
+        self.face_ids = np.asarray([int(reid_bbox_obj['id']) for reid_bbox_obj in reid_bboxes], dtype=np.int64)
+        self.raw_bboxes = [reid_bbox_obj['bbox'] for reid_bbox_obj in reid_bboxes]
+        self.bboxes = np.asarray(self.raw_bboxes, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def from_frame_detections(cls, frame_detections):
+        return cls(cls.frame_reid_bboxes(frame_detections))
+
+    @staticmethod
+    def frame_reid_bboxes(frame_detections):
+        return [reid_bbox_obj for reid_detection in frame_detections for reid_bbox_obj in reid_detection['re-id']]
+
+    def has_inputs(self, reid_bboxes):
+        """
+        Whether these faces were parsed from `reid_bboxes`, so they need not be parsed again.
+        """
+        return len(reid_bboxes) == len(self.raw_bboxes) and \
+            all(reid_bbox_obj['bbox'] == raw_bbox and int(reid_bbox_obj['id']) == face_id
+                for reid_bbox_obj, raw_bbox, face_id in zip(reid_bboxes, self.raw_bboxes, self.face_ids.tolist()))
+
+    def take(self, idxs):
+        """
+        The faces at `idxs`.
+        """
+        faces = FrameFaces.__new__(FrameFaces)
+        faces.face_ids = self.face_ids[idxs]
+        faces.raw_bboxes = [self.raw_bboxes[idx] for idx in idxs]
+        faces.bboxes = self.bboxes[idxs]
+        return faces
+
+    def __len__(self):
+        return len(self.face_ids)
+
+
+class FrameRois:
+    """
+    The Visual Clues person ROIs of a frame, with their bbox strings parsed once into an (M, 4) array.
+    `raw_ids` keeps the ROI ids as stored, they are written back as is for the unmatched ROIs.
+    """
+    __slots__ = ('raw_ids', 'raw_bboxes', 'bboxes')
+
+    def __init__(self, vc_rois):
+        self.raw_ids = [vc_roi['roi_id'] for vc_roi in vc_rois]
+        self.raw_bboxes = [vc_roi['bbox'] for vc_roi in vc_rois]
+        self.bboxes = np.asarray([parse_bbox(raw_bbox) for raw_bbox in self.raw_bboxes], dtype=np.float64).reshape(-1, 4)
+
+    def has_inputs(self, vc_rois):
+        """
+        Whether these ROIs were parsed from `vc_rois`, so they need not be parsed again.
+        """
+        return len(vc_rois) == len(self.raw_ids) and \
+            all(vc_roi['bbox'] == raw_bbox and vc_roi['roi_id'] == raw_id
+                for vc_roi, raw_bbox, raw_id in zip(vc_rois, self.raw_bboxes, self.raw_ids))
+
+    def take(self, idxs):
+        """
+        The ROIs at `idxs`.
+        """
+        rois = FrameRois.__new__(FrameRois)
+        rois.raw_ids = [self.raw_ids[idx] for idx in idxs]
+        rois.raw_bboxes = [self.raw_bboxes[idx] for idx in idxs]
+        rois.bboxes = self.bboxes[idxs]
+        return rois
+
+    def __len__(self):
+        return len(self.raw_ids)
+
+
+class FrameCandidates:
+    """
+    The candidate face/ROI pairs of a frame, as a structured array of CANDIDATE_DTYPE rows
+    that index into `faces` and `rois`. `kept` holds the indices of the corrected rows once they are known.
+    """
+    __slots__ = ('faces', 'rois', 'rows', 'kept')
+
+    def __init__(self, faces, rois, rows=None, kept=None):
+        self.faces = faces
+        self.rois = rois
+        self.rows = rows if rows is not None else np.empty(0, dtype=CANDIDATE_DTYPE)
+        self.kept = kept
+
+    def __len__(self):
+        return len(self.rows)
+
+    def nbytes(self):
+        """
+        The memory held by the candidates: the arrays, and the lists of the raw inputs (not the objects they hold).
+        """
+        nbytes = self.rows.nbytes + self.faces.face_ids.nbytes + self.faces.bboxes.nbytes + self.rois.bboxes.nbytes + \
+            sum(sys.getsizeof(items) for items in (self.faces.raw_bboxes, self.rois.raw_ids, self.rois.raw_bboxes))
+        if self.kept is not None:
+            nbytes += sys.getsizeof(self.kept)
+        return nbytes
+
+    def face_bboxes(self):
+        return self.faces.bboxes[self.rows['face_idx']]
+
+    def vc_bboxes(self):
+        return self.rois.bboxes[self.rows['vc_idx']]
+
+    def to_dicts(self):
+        """
+        The candidates in the dict layout of the fusion output (used by the QA path).
+        """
+        candidates = []
+        for row in self.rows.tolist():
+            face_idx, vc_idx, bbox_intersection, face_area, iou = row
+            candidates.append(
+                {
+                    'reid_bbox': self.faces.raw_bboxes[face_idx],
+                    'vc_bbox': self.rois.bboxes[vc_idx].tolist(),
+                    'bbox_intersection': bbox_intersection,
+                    'face_area': face_area,
+                    'face_id': str(self.faces.face_ids[face_idx]),
+                    'iou': iou,
+                    'vc_id': str(self.rois.raw_ids[vc_idx])
+                }
+            )
+        return candidates
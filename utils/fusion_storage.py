@@ -0,0 +1,297 @@
+import abc
+import copy
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from utils.fusion_logging import get_logger
+
+FIND_BATCH_SIZE = 500
+SNAPSHOT_SUFFIX = ".jsonl"
+REID_COLLECTION_NAME = "s4_re_id"
+VISUAL_CLUES_COLLECTION_NAME = "s4_visual_clues"
+
+logger = get_logger("storage")
+
+_ATTRIBUTE_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_\-]*$')
+
+
+def _get_attribute(doc, attribute):
+    """
+    Returns the (possibly nested, dot separated) attribute of a document or None.
+    """
+    value = doc
+    for name in attribute.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return None
+        value = value[name]
+    return value
+
+
+def _matches(doc, filters):
+    return all(_get_attribute(doc, attribute) == value for attribute, value in filters.items())
+
+
+def _project(doc, fields):
+    if fields is None:
+        return doc
+    return {field: doc.get(field) for field in fields}
+
+
+class FusionStorage(abc.ABC):
+    """
+    The documents storage used by FusionPipeline.
+    Filters are {attribute: value} equality conditions, nested attributes are dot separated.
+    """
+    name = "storage"
+
+    @abc.abstractmethod
+    def get_doc_by_key(self, query, collection):
+        """
+        Returns the first document of the collection that matches the query, or None.
+        """
+
+    @abc.abstractmethod
+    def find_docs(self, filters, collection, fields=None, batch_size=FIND_BATCH_SIZE, sort=None):
+        """
+        Yields all the documents of the collection that match the filters,
+        projected to `fields` (top level attributes) if given, in the order of the (dot separated) `sort` attribute
+        if given.
+        """
+
+    @abc.abstractmethod
+    def write_doc_by_key(self, doc, collection, overwrite=False, key_list=[]):
+        """
+        Inserts the document, or replaces (if `overwrite`) the document with the same `key_list` attributes.
+        """
+
+    def write_docs_by_key(self, docs, collection, key_list=[]):
+        """
+        Inserts or replaces (by the `key_list` attributes) multiple documents at once.
+        """
+        for doc in docs:
+            self.write_doc_by_key(doc, collection, overwrite=True, key_list=key_list)
+        return True
+
+    def ensure_index(self, collection, fields):
+        """
+        Makes sure the collection has an index on the (dot separated) `fields`, for the `find_docs` filters.
+        Storages that scan their documents anyway have nothing to do.
+        """
+        return None
+
+
+class ArangoStorage(FusionStorage):
+    """
+    The ArangoDB storage, through `database.arangodb.DBBase`.
+    """
+    name = "arangodb"
+
+    def __init__(self):
+        self._nre = None
+        self._nre_lock = threading.Lock()
+        # The (collection, key_list) of `write_docs_by_key` whose index was already ensured.
+        self._key_indexes = set()
+
+    @property
+    def nre(self):
+        """
+        The database connection, opened on first use: creating the storage (and the pipeline) does not connect.
+        """
+        if self._nre is None:
+            with self._nre_lock:
+                if self._nre is None:
+                    from database.arangodb import DBBase
+                    nre = DBBase()
+                    logger.info("Connected to database: %s", nre.database)
+                    self._nre = nre
+        return self._nre
+
+    def get_doc_by_key(self, query, collection):
+        return self.nre.get_doc_by_key(query, collection)
+
+    def _attribute_to_aql(self, attribute):
+        names = attribute.split('.')
+        if not all(_ATTRIBUTE_NAME.match(name) for name in names):
+            raise ValueError("Invalid attribute name: {}".format(attribute))
+        return 'doc.{}'.format('.'.join('`{}`'.format(name) for name in names))
+
+    def _filters_to_aql(self, filters, bind_vars):
+        conditions = []
+        for idx, (attribute, value) in enumerate(filters.items()):
+            conditions.append('FILTER {} == @value{}'.format(self._attribute_to_aql(attribute), idx))
+            bind_vars['value{}'.format(idx)] = value
+        return ' '.join(conditions)
+
+    def find_docs(self, filters, collection, fields=None, batch_size=FIND_BATCH_SIZE, sort=None):
+        bind_vars = {'@collection': collection}
+        conditions = self._filters_to_aql(filters, bind_vars)
+        if sort is not None:
+            conditions += ' SORT {}'.format(self._attribute_to_aql(sort))
+        if fields is None:
+            projection = 'doc'
+        else:
+            projection = 'KEEP(doc, @fields)'
+            bind_vars['fields'] = list(fields)
+        query = 'FOR doc IN @@collection {} RETURN {}'.format(conditions, projection)
+        return self.nre.db.aql.execute(query, bind_vars=bind_vars, stream=True, batch_size=batch_size)
+
+    def write_doc_by_key(self, doc, collection, overwrite=False, key_list=[]):
+        return self.nre.write_doc_by_key(doc, collection, overwrite=overwrite, key_list=key_list)
+
+    def _doc_key(self, doc, key_list):
+        """
+        The `_key` of a new document: a digest of its `key_list` values, the same for every writer.
+        """
+        values = json.dumps([doc.get(key) for key in key_list], sort_keys=True, default=str)
+        return hashlib.sha1(values.encode('utf-8')).hexdigest()
+
+    def _existing_keys(self, docs, collection, key_list):
+        """
+        Returns the `_key` of the stored document of every `key_list` values tuple of the documents,
+        found with one AQL query through the index on `key_list`.
+        """
+        conditions = ' '.join('FILTER {} == key.`{}`'.format(self._attribute_to_aql(key), key) for key in key_list)
+        query = 'FOR key IN @keys FOR doc IN @@collection {} RETURN MERGE(KEEP(doc, @fields), {{_key: doc._key}})'
+        query = query.format(conditions)
+        bind_vars = {'@collection': collection, 'fields': list(key_list),
+                     'keys': [{key: doc.get(key) for key in key_list} for doc in docs]}
+        existing_keys = {}
+        for doc in self.nre.db.aql.execute(query, bind_vars=bind_vars):
+            existing_keys.setdefault(tuple(doc.get(key) for key in key_list), doc['_key'])
+        return existing_keys
+
+    def write_docs_by_key(self, docs, collection, key_list=[]):
+        """
+        Inserts or replaces all the documents with one multi-document insert.
+        A document replaces the stored document with the same `key_list` values by taking its `_key`
+        (the one `write_doc_by_key` gave it), a new document gets the `_key` of `_doc_key`,
+        so rewriting or concurrently writing a frame never duplicates it.
+        """
+        if not docs:
+            return None
+        if key_list:
+            if (collection, tuple(key_list)) not in self._key_indexes:
+                self.ensure_index(collection, key_list)
+                self._key_indexes.add((collection, tuple(key_list)))
+            existing_keys = self._existing_keys(docs, collection, key_list)
+            docs = [dict(doc, _key=existing_keys.get(tuple(doc.get(key) for key in key_list))
+                         or self._doc_key(doc, key_list)) for doc in docs]
+        results = self.nre.db.collection(collection).insert_many(docs, overwrite=bool(key_list), silent=False)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        return results
+
+    def ensure_index(self, collection, fields):
+        """
+        Creates a sparse persistent index on `fields`, ArangoDB returns the existing one if it is already there.
+        """
+        index = self.nre.db.collection(collection).add_persistent_index(fields=list(fields), sparse=True)
+        logger.info("Index on %s.%s: %s", collection, list(fields), index.get('id'))
+        return index
+
+
+class InMemoryStorage(FusionStorage):
+    """
+    A process local storage, for profiling and load tests without a live ArangoDB.
+    Documents are copied on read and write, as if they went through a database.
+    """
+    name = "memory"
+
+    def __init__(self, collections=None):
+        self.collections = {}
+        for collection, docs in (collections or {}).items():
+            self.collections[collection] = [copy.deepcopy(doc) for doc in docs]
+
+    def get_doc_by_key(self, query, collection):
+        for doc in self.collections.get(collection, []):
+            if _matches(doc, query):
+                return copy.deepcopy(doc)
+        return None
+
+    def find_docs(self, filters, collection, fields=None, batch_size=FIND_BATCH_SIZE, sort=None):
+        docs = [doc for doc in self.collections.get(collection, []) if _matches(doc, filters)]
+        if sort is not None:
+            docs.sort(key=lambda doc: _get_attribute(doc, sort))
+        for doc in docs:
+            yield copy.deepcopy(_project(doc, fields))
+
+    def write_doc_by_key(self, doc, collection, overwrite=False, key_list=[]):
+        docs = self.collections.setdefault(collection, [])
+        doc = copy.deepcopy(doc)
+        if key_list:
+            key = {attribute: doc.get(attribute) for attribute in key_list}
+            for idx, cur_doc in enumerate(docs):
+                if _matches(cur_doc, key):
+                    if not overwrite:
+                        return False
+                    docs[idx] = doc
+                    return True
+        docs.append(doc)
+        return True
+
+
+class SnapshotStorage(InMemoryStorage):
+    """
+    An InMemoryStorage loaded from a local snapshot directory, with one `<collection>.jsonl` file per collection.
+    Writes stay in memory until `save` is called, so replays run at full speed.
+    """
+    name = "snapshot"
+
+    def __init__(self, snapshot_dir):
+        super().__init__()
+        self.snapshot_dir = snapshot_dir
+        if os.path.isdir(snapshot_dir):
+            for file_name in sorted(os.listdir(snapshot_dir)):
+                if file_name.endswith(SNAPSHOT_SUFFIX):
+                    collection = file_name[:-len(SNAPSHOT_SUFFIX)]
+                    with open(os.path.join(snapshot_dir, file_name), 'r') as f:
+                        self.collections[collection] = [json.loads(line) for line in f if line.strip()]
+        logger.info("Loaded snapshot: %s, collections: %s", snapshot_dir, sorted(self.collections))
+
+    def save(self, collections=None):
+        """
+        Writes the collections (all of them by default) to the snapshot directory.
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        for collection in (collections or self.collections):
+            with open(os.path.join(self.snapshot_dir, collection + SNAPSHOT_SUFFIX), 'w') as f:
+                for doc in self.collections.get(collection, []):
+                    f.write(json.dumps(doc) + "\n")
+
+
+def record_movie_snapshot(source_storage, snapshot_dir, movie_ids):
+    """
+    Records the s4_re_id and s4_visual_clues documents of the movies from `source_storage`
+    into the snapshot directory, to be replayed with SnapshotStorage.
+    """
+    snapshot = SnapshotStorage(snapshot_dir)
+    for movie_id in movie_ids:
+        reid_doc = source_storage.get_doc_by_key({'movie_id': movie_id}, REID_COLLECTION_NAME)
+        if not reid_doc:
+            logger.warning("Movie ID %s not found in %s, skipping.", movie_id, REID_COLLECTION_NAME)
+            continue
+        snapshot.write_doc_by_key(reid_doc, REID_COLLECTION_NAME, overwrite=True, key_list=['movie_id'])
+        vc_docs = list(source_storage.find_docs({'movie_id': movie_id}, VISUAL_CLUES_COLLECTION_NAME))
+        snapshot.write_docs_by_key(vc_docs, VISUAL_CLUES_COLLECTION_NAME, key_list=['movie_id', 'frame_num'])
+        logger.info("Recorded Movie ID: %s, %d Visual Clues frames", movie_id, len(vc_docs))
+    snapshot.save([REID_COLLECTION_NAME, VISUAL_CLUES_COLLECTION_NAME])
+    return snapshot
+
+
+def create_storage():
+    """
+    The storage selected by the environment: a SnapshotStorage of FUSION_SNAPSHOT_DIR if set, else ArangoDB.
+    """
+    snapshot_dir = os.environ.get("FUSION_SNAPSHOT_DIR")
+    if snapshot_dir:
+        return SnapshotStorage(snapshot_dir)
+    return ArangoStorage()
+
+
+if __name__ == '__main__':
+    # python -m utils.fusion_storage <snapshot_dir> <movie_id> [<movie_id> ...]
+    record_movie_snapshot(ArangoStorage(), sys.argv[1], sys.argv[2:])
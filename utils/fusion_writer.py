@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+
+WRITER_BATCH_SIZE = 200
+WRITER_FLUSH_INTERVAL = 5.0
+WRITER_MAX_QUEUE_SIZE = 1000
+
+_CLOSE = object()
+
+
+class FusionDocWriter:
+    """
+    Write-behind writer for fusion documents.
+    Documents are queued by the compute loop and flushed in batches by a background thread,
+    either when `batch_size` documents are collected or when `flush_interval` seconds passed.
+    `write` blocks when `max_queue_size` documents are waiting (backpressure), and `close`
+    flushes the remaining documents exactly once.
+    """
+    def __init__(self, flush_fn, batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL,
+                 max_queue_size=WRITER_MAX_QUEUE_SIZE):
+        self.flush_fn = flush_fn
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.num_docs = 0
+        self.num_flushes = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="fusion-doc-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, doc):
+        if self.closed:
+            raise RuntimeError("FusionDocWriter is closed")
+        if self.error:
+            raise self.error
+        self.queue.put(doc)
+
+    def close(self):
+        """
+        Flush the pending documents and stop the writer thread.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _flush(self, batch):
+        if not batch or self.error:
+            return
+        try:
+            self.flush_fn(batch)
+            self.num_docs += len(batch)
+            self.num_flushes += 1
+        except Exception as e:
+            # Keep draining the queue so producers never block on a dead writer,
+            # the error is raised to them on the next `write` / `close`.
+            self.error = e
+
+    def _run(self):
+        batch = []
+        last_flush = None
+        while True:
+            timeout = None
+            if batch and self.flush_interval:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _CLOSE:
+                break
+            if item is not None:
+                if not batch:
+                    # The flush interval counts from the oldest pending document.
+                    last_flush = time.monotonic()
+                batch.append(item)
+            if not batch:
+                continue
+            is_due = self.flush_interval and time.monotonic() - last_flush >= self.flush_interval
+            if len(batch) >= self.batch_size or is_due:
+                self._flush(batch)
+                batch = []
+        self._flush(batch)
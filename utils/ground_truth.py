@@ -0,0 +1,46 @@
+GROUND_TRUTH_COLLECTION_NAME = "s4_fusion_groundtruth"
+
+
+def ground_truth_doc(movie_id, frame_docs, movie_names=()):
+    """
+    The ground truth document of a movie, keyed by its 'movie_id'.
+    """
+    return {'movie_id': movie_id, 'movie_names': list(movie_names), 'frames': frame_docs}
+
+
+def _insertion_order(docs):
+    """
+    Sorts the documents by their ArangoDB `_key` when all of them have a generated (numeric, increasing) one,
+    otherwise keeps the order of the storage.
+    """
+    keys = [str(doc.get('_key') or '') for doc in docs]
+    if all(key.isdigit() for key in keys):
+        return [doc for _, doc in sorted(zip(keys, docs), key=lambda item: int(item[0]))]
+    return docs
+
+
+def load_ground_truth(storage, movie_ids, collection=GROUND_TRUTH_COLLECTION_NAME):
+    """
+    Returns movie_id -> frame documents of the ground truth of the movies, the movies without one are left out.
+    A movie's own document (see `ground_truth_doc`) is read first. The other movies are read from the documents of
+    the original format, which hold the frame documents of many movies in 'movie_ids': the first of them that
+    has frames of a movie holds its ground truth, the later ones were written by reruns and are ignored.
+    """
+    ground_truth = {}
+    for movie_id in movie_ids:
+        doc = storage.get_doc_by_key({'movie_id': movie_id}, collection)
+        if doc:
+            ground_truth[movie_id] = doc.get('frames', [])
+    missing = set(movie_ids) - set(ground_truth)
+    if not missing:
+        return ground_truth
+    for doc in _insertion_order(list(storage.find_docs({}, collection, fields=['_key', 'movie_ids']))):
+        doc_frames = {}
+        for frame_doc in doc.get('movie_ids') or []:
+            if frame_doc.get('movie_id') in missing:
+                doc_frames.setdefault(frame_doc['movie_id'], []).append(frame_doc)
+        ground_truth.update(doc_frames)
+        missing.difference_update(doc_frames)
+        if not missing:
+            break
+    return ground_truth
@@ -1,12 +1,14 @@
-import requests
 import numpy as np
-import cv2
 import random
 import os
-import PIL.ImageColor as ImageColor
 import math
 
 CUR_FOLDER = os.path.abspath(__file__ + "/../../")
+# Beyond this the grid cells of `bb_overlapping_pairs` lose float precision, all the pairs are scored instead.
+GRID_MAX_COORDINATE = 1e9
+# `bb_overlapping_pairs` gives up when it expects to keep more than this fraction of the pairs,
+# scoring all the pairs at once is faster then.
+GRID_MAX_PAIRS_FRACTION = 0.25
 
 def bb_intersection_over_union(boxA, boxB):
 	# determine the (x, y)-coordinates of the intersection rectangle
@@ -97,8 +99,175 @@ def distance_between_two_points(pointA, pointB):
     dist = math.sqrt( (pointB[0] - pointA[0])**2 + (pointB[1] - pointA[1])**2 )
     return dist
 
+def _as_boxes(boxes):
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+def _broadcast_areas(boxesA, boxesB):
+    """
+    Returns the intersection areas and the areas of boxesA and boxesB, whose shapes (..., 4) broadcast together.
+    Uses the same +1 pixel convention as the scalar functions.
+    """
+    xA = np.maximum(boxesA[..., 0], boxesB[..., 0])
+    yA = np.maximum(boxesA[..., 1], boxesB[..., 1])
+    xB = np.minimum(boxesA[..., 2], boxesB[..., 2])
+    yB = np.minimum(boxesA[..., 3], boxesB[..., 3])
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+    boxAArea = (boxesA[..., 2] - boxesA[..., 0] + 1) * (boxesA[..., 3] - boxesA[..., 1] + 1)
+    boxBArea = (boxesB[..., 2] - boxesB[..., 0] + 1) * (boxesB[..., 3] - boxesB[..., 1] + 1)
+    return interArea, boxAArea, boxBArea
+
+def _pairwise_areas(boxesA, boxesB):
+    """
+    Returns the (N, M) intersection areas and the broadcastable areas of boxesA (N, 1) and boxesB (1, M).
+    """
+    return _broadcast_areas(_as_boxes(boxesA)[:, None, :], _as_boxes(boxesB)[None, :, :])
+
+def _paired_areas(boxesA, boxesB):
+    """
+    Returns the (K,) intersection areas and areas of the matching rows of boxesA (K, 4) and boxesB (K, 4).
+    """
+    return _broadcast_areas(_as_boxes(boxesA), _as_boxes(boxesB))
+
+def _intersection_over_union(interArea, boxAArea, boxBArea):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return interArea / (boxAArea + boxBArea - interArea)
+
+def _intersection(interArea, boxAArea, boxBArea):
+    smallBboxArea = np.minimum(boxAArea, boxBArea)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intersection = np.where((smallBboxArea <= interArea) & (interArea > 0),
+                                smallBboxArea / interArea, 0.0)
+        intersection = np.where((smallBboxArea > interArea) & (smallBboxArea > 0),
+                                interArea / smallBboxArea, intersection)
+    return intersection
+
+def bb_intersection_over_union_matrix(boxesA, boxesB):
+    """
+    Vectorized `bb_intersection_over_union` of every box in boxesA (N, 4) with every box in boxesB (M, 4).
+    Returns an (N, M) matrix.
+    """
+    return _intersection_over_union(*_pairwise_areas(boxesA, boxesB))
+
+def bb_intersection_matrix(boxesA, boxesB):
+    """
+    Vectorized `bb_intersection` of every box in boxesA (N, 4) with every box in boxesB (M, 4).
+    Returns an (N, M) matrix.
+    """
+    return _intersection(*_pairwise_areas(boxesA, boxesB))
+
+def bb_smallest_area_matrix(boxesA, boxesB):
+    """
+    Vectorized `bb_smallest_area` of every box in boxesA (N, 4) with every box in boxesB (M, 4).
+    Returns an (N, M) matrix.
+    """
+    _, boxAArea, boxBArea = _pairwise_areas(boxesA, boxesB)
+    return np.minimum(boxAArea, boxBArea)
+
+def bb_intersection_over_union_pairs(boxesA, boxesB):
+    """
+    Vectorized `bb_intersection_over_union` of the matching rows of boxesA (K, 4) and boxesB (K, 4).
+    """
+    return _intersection_over_union(*_paired_areas(boxesA, boxesB))
+
+def bb_intersection_pairs(boxesA, boxesB):
+    """
+    Vectorized `bb_intersection` of the matching rows of boxesA (K, 4) and boxesB (K, 4).
+    """
+    return _intersection(*_paired_areas(boxesA, boxesB))
+
+def bb_smallest_area_pairs(boxesA, boxesB):
+    """
+    Vectorized `bb_smallest_area` of the matching rows of boxesA (K, 4) and boxesB (K, 4).
+    """
+    _, boxAArea, boxBArea = _paired_areas(boxesA, boxesB)
+    return np.minimum(boxAArea, boxBArea)
+
+def bb_overlapping_pairs(boxesA, boxesB, max_coordinate=GRID_MAX_COORDINATE, max_pairs_fraction=GRID_MAX_PAIRS_FRACTION):
+    """
+    Uniform grid index over boxesB: returns the (idxA, idxB) pairs of boxesA (N, 4) and boxesB (M, 4) that may
+    overlap, a superset of the pairs with a positive intersection area (+1 pixel convention), so of the pairs that
+    `bb_intersection` scores above 0. The pairs are not sorted.
+    Returns None when the grid wouldn't prune enough (non finite or huge coordinates, or boxes of B that cover
+    a large part of the frame), the caller should then score all the pairs.
+
+    A pair overlaps only if the center of the box of A lies in the box of B expanded by half of the size of the box
+    of A + 1. Every box of A is put in the grid cell of its center, every box of B in all the cells of its box
+    expanded by the largest half size of A (+ 1 pixel of slack), and the pairs are the boxes that share a cell.
+    """
+    boxesA = _as_boxes(boxesA)
+    boxesB = _as_boxes(boxesB)
+    if not len(boxesA) or not len(boxesB):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    if not (np.all(np.abs(boxesA) <= max_coordinate) and np.all(np.abs(boxesB) <= max_coordinate)):
+        return None
+    centersA = np.stack([(boxesA[:, 0] + boxesA[:, 2]) / 2, (boxesA[:, 1] + boxesA[:, 3]) / 2], axis=1)
+    margins = np.maximum(0, np.max((boxesA[:, 2:] - boxesA[:, :2]) / 2, axis=0)) + 2
+    expandedB = np.concatenate([boxesB[:, :2] - margins, boxesB[:, 2:] + margins], axis=1)
+    # About 2 x 2 cells per expanded box of B.
+    cell_size = max(1.0, float(np.median(np.maximum(expandedB[:, 2] - expandedB[:, 0],
+                                                      expandedB[:, 3] - expandedB[:, 1]))))
+    cellsB = np.floor(expandedB / cell_size).astype(np.int64)
+    cellsA = np.floor(centersA / cell_size).astype(np.int64)
+    num_x = np.maximum(0, cellsB[:, 2] - cellsB[:, 0] + 1)
+    num_y = np.maximum(0, cellsB[:, 3] - cellsB[:, 1] + 1)
+    counts = num_x * num_y
+    total = int(counts.sum())
+    if total > len(boxesA) * len(boxesB):
+        return None
+    if not total:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    # The grid cells of every box of B, as (cell key, idxB) entries sorted by key.
+    entryB = np.repeat(np.arange(len(boxesB)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    entry_x = cellsB[entryB, 0] + offsets % num_x[entryB]
+    entry_y = cellsB[entryB, 1] + offsets // num_x[entryB]
+    min_x = min(cellsA[:, 0].min(), entry_x.min())
+    min_y = min(cellsA[:, 1].min(), entry_y.min())
+    span_y = max(cellsA[:, 1].max(), entry_y.max()) - min_y + 1
+    entry_keys = (entry_x - min_x) * span_y + (entry_y - min_y)
+    order = np.argsort(entry_keys, kind='stable')
+    entry_keys, entryB = entry_keys[order], entryB[order]
+
+    keysA = (cellsA[:, 0] - min_x) * span_y + (cellsA[:, 1] - min_y)
+    starts = np.searchsorted(entry_keys, keysA, side='left')
+    ends = np.searchsorted(entry_keys, keysA, side='right')
+    countsA = ends - starts
+    if countsA.sum() > max_pairs_fraction * len(boxesA) * len(boxesB):
+        return None
+    idxA = np.repeat(np.arange(len(boxesA)), countsA)
+    offsets = np.arange(int(countsA.sum())) - np.repeat(np.cumsum(countsA) - countsA, countsA)
+    idxB = entryB[np.repeat(starts, countsA) + offsets]
+    return idxA, idxB
+
+def bb_center_coordinates(boxes):
+    """
+    Vectorized `bb_center_coordinate`, returns an (N, 2) array of (cX, cY).
+    """
+    boxes = _as_boxes(boxes)
+    return np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+
+def bb_hueristic_face_coordinates(boxes):
+    """
+    Vectorized `bb_hueristic_face_coordinate`, returns an (N, 2) array of (cX, cY).
+    """
+    boxes = _as_boxes(boxes)
+    return np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 4], axis=1)
+
+def distances_between_points(pointsA, pointsB):
+    """
+    Vectorized `distance_between_two_points` of matching rows in pointsA (N, 2) and pointsB (N, 2).
+    """
+    pointsA = np.asarray(pointsA, dtype=np.float64).reshape(-1, 2)
+    pointsB = np.asarray(pointsB, dtype=np.float64).reshape(-1, 2)
+    return np.sqrt((pointsB[:, 0] - pointsA[:, 0])**2 + (pointsB[:, 1] - pointsA[:, 1])**2)
+
 def plot_one_box(x, img, color=None, label=None, line_thickness=3):
     # Plots one bounding box on image img
+    # OpenCV is only needed for drawing, the box functions import without it.
+    import cv2
     tl = line_thickness or round(0.002 * (img.shape[0] + img.shape[1]) / 2) + 1  # line/font thickness
     color = color or [random.randint(0, 255) for _ in range(3)]
     c1, c2 = (int(x[0]), int(x[1])), (int(x[2]), int(x[3]))
@@ -106,24 +275,11 @@ def plot_one_box(x, img, color=None, label=None, line_thickness=3):
     cv2.putText(img, str(label), (c2[0], c2[1]), 0, tl / 3, [225, 255, 255], thickness=max(tl - 1, 1), lineType=cv2.LINE_AA)
 
 def save_img_with_bboxes(bbox_details, image_url, frame_num, movie_name):
-    
-    resp = requests.get(image_url, stream=True).raw
-    image = np.asarray(bytearray(resp.read()), dtype="uint8")
-    img_orig = cv2.imdecode(image, cv2.IMREAD_COLOR)
-    color_space = [ImageColor.getrgb(n) for n, c in ImageColor.colormap.items()][7:]
-    for cur_details in bbox_details:
-        reid_bbox = cur_details['reid_bbox']
-        vc_bbox = cur_details['vc_bbox']
-        face_id = cur_details['face_id']
-        color = [random.randint(0, 255) for _ in range(3)]
-        plot_one_box(reid_bbox, img_orig, label=face_id, color=color, line_thickness=3)
-        plot_one_box(vc_bbox, img_orig, label=face_id, color=color, line_thickness=3)
-    # TO DELETE - SANITY TEXT OF BBOXES ON IMAGE
-    movie_name_path =  os.path.join(CUR_FOLDER, "images/{}".format(movie_name))
-    if not os.path.exists(movie_name_path):
-        os.makedirs(movie_name_path)
-    cv2.imwrite(os.path.join(movie_name_path, "frame_{}.jpg".format(frame_num)), img_orig)
-    print(f"The image is saved with bboxes")
+    """
+    Renders a single frame synchronously, through the pooled and cached `utils.frame_renderer.FrameRenderer`.
+    """
+    from utils.frame_renderer import get_frame_renderer
+    get_frame_renderer().render_frame(bbox_details, image_url, frame_num, movie_name)
     return
 
 distance_between_two_points((0,0), (1,1))
\ No newline at end of file
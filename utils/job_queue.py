@@ -0,0 +1,267 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from utils.fusion_logging import get_logger
+
+JOB_LEASE_SECONDS = float(os.environ.get("FUSION_JOB_LEASE_SECONDS", 600))
+JOB_MAX_ATTEMPTS = int(os.environ.get("FUSION_JOB_MAX_ATTEMPTS", 3))
+# Seconds a connection waits for the lock of the queue database held by another worker.
+JOB_QUEUE_LOCK_TIMEOUT = 60.0
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = get_logger("job_queue")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    movie_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    movie_id TEXT NOT NULL,
+    frame_num INTEGER NOT NULL,
+    PRIMARY KEY (movie_id, frame_num)
+);
+CREATE INDEX IF NOT EXISTS movies_status ON movies (status, lease_expires);
+"""
+
+
+class LeaseLostError(Exception):
+    """
+    The lease of a movie expired and another worker claimed it.
+    """
+
+
+def default_worker_id():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class FusionJobQueue:
+    """
+    A durable queue of movies to fuse, in a SQLite database. Workers claim a movie with a lease, checkpoint its
+    frames as their documents are flushed, and complete or fail it. A movie whose lease expired (its worker
+    was killed) is claimed again, and its checkpointed frames are skipped.
+    Several processes may drain the same queue: on one host, or on several with the database on a shared
+    filesystem whose file locks work (SQLite's rollback journal is used, not WAL, for that reason).
+    """
+    def __init__(self, path, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit, every transaction is explicit. The checkpoints are written from the writer thread,
+        # the lock serializes the transactions of the threads on the connection.
+        self.conn = sqlite3.connect(path, timeout=JOB_QUEUE_LOCK_TIMEOUT, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _transaction(self):
+        """
+        An immediate transaction, so two workers never claim the same movie.
+        """
+        return _Transaction(self.conn, self.lock)
+
+    def enqueue(self, movie_ids):
+        """
+        Adds the movies that are not queued yet, returns the number of added movies.
+        """
+        now = time.time()
+        with self._transaction():
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO movies (movie_id, status, updated) VALUES (?, ?, ?)",
+                                  [(movie_id, PENDING, now) for movie_id in movie_ids])
+            return self.conn.total_changes - before
+
+    def claim(self, worker_id):
+        """
+        Leases the next pending movie (or a running one whose lease expired) to the worker.
+        Returns its movie id, or None when there is nothing left to claim.
+        """
+        now = time.time()
+        with self._transaction():
+            # A movie whose every attempt ended with a lost lease (its worker was killed) is given up.
+            self.conn.execute("UPDATE movies SET status = ?, lease_owner = NULL, last_error = ?, updated = ? "
+                              "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                              (FAILED, "The lease expired", now, RUNNING, now, self.max_attempts))
+            row = self.conn.execute(
+                "SELECT movie_id FROM movies WHERE (status = ? OR (status = ? AND lease_expires < ?)) "
+                "AND attempts < ? ORDER BY rowid LIMIT 1", (PENDING, RUNNING, now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE movies SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?, "
+                "updated = ? WHERE movie_id = ?", (RUNNING, worker_id, now + self.lease_seconds, now, row[0]))
+        return row[0]
+
+    def _renew(self, movie_id, worker_id, now):
+        cursor = self.conn.execute(
+            "UPDATE movies SET lease_expires = ?, updated = ? WHERE movie_id = ? AND status = ? AND lease_owner = ?",
+            (now + self.lease_seconds, now, movie_id, RUNNING, worker_id))
+        if cursor.rowcount != 1:
+            raise LeaseLostError("The lease of Movie ID {} is no longer held by {}".format(movie_id, worker_id))
+
+    def renew(self, movie_id, worker_id):
+        with self._transaction():
+            self._renew(movie_id, worker_id, time.time())
+
+    def checkpoint_frames(self, movie_id, worker_id, frame_nums):
+        """
+        Records the frames whose documents were written, and renews the lease.
+        Raises LeaseLostError when the movie was claimed by another worker.
+        """
+        with self._transaction():
+            self._renew(movie_id, worker_id, time.time())
+            self.conn.executemany("INSERT OR IGNORE INTO frames (movie_id, frame_num) VALUES (?, ?)",
+                                  [(movie_id, int(frame_num)) for frame_num in frame_nums])
+
+    def completed_frames(self, movie_id):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute("SELECT frame_num FROM frames WHERE movie_id = ?",
+                                                           (movie_id,)))
+
+    def _finish(self, movie_id, worker_id, status, error=None):
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE movies SET status = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?, updated = ? "
+                "WHERE movie_id = ? AND status = ? AND lease_owner = ?",
+                (status, error, time.time(), movie_id, RUNNING, worker_id))
+            if status == DONE and cursor.rowcount:
+                # The frames of a finished movie are not needed anymore.
+                self.conn.execute("DELETE FROM frames WHERE movie_id = ?", (movie_id,))
+            return cursor.rowcount == 1
+
+    def complete(self, movie_id, worker_id):
+        return self._finish(movie_id, worker_id, DONE)
+
+    def fail(self, movie_id, worker_id, error):
+        """
+        Releases a failed movie: it is retried by the next claim, until it failed `max_attempts` times.
+        """
+        with self.lock:
+            attempts = self.conn.execute("SELECT attempts FROM movies WHERE movie_id = ?", (movie_id,)).fetchone()
+            status = FAILED if attempts and attempts[0] >= self.max_attempts else PENDING
+            return self._finish(movie_id, worker_id, status, error=str(error))
+
+    def checkpoint(self, movie_id, worker_id):
+        return MovieCheckpoint(self, movie_id, worker_id)
+
+    def heartbeat(self, movie_id, worker_id, interval=None):
+        return LeaseHeartbeat(self, movie_id, worker_id, interval=interval)
+
+    def stats(self):
+        """
+        The number of movies by status, and the checkpointed frames of the unfinished movies.
+        """
+        stats = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        with self.lock:
+            for status, count in self.conn.execute("SELECT status, COUNT(*) FROM movies GROUP BY status"):
+                stats[status] = count
+            stats['checkpointed_frames'] = self.conn.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+        return stats
+
+    def failed_movies(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT movie_id, last_error FROM movies WHERE status = ?", (FAILED,)))
+
+
+class _Transaction:
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+class MovieCheckpoint:
+    """
+    The frame checkpoint of a claimed movie, for `FusionPipeline.run_fusion_pipeline(checkpoint=...)`.
+    """
+    def __init__(self, job_queue, movie_id, worker_id):
+        self.job_queue = job_queue
+        self.movie_id = movie_id
+        self.worker_id = worker_id
+
+    def completed_frames(self):
+        return self.job_queue.completed_frames(self.movie_id)
+
+    def frames_flushed(self, docs):
+        self.job_queue.checkpoint_frames(self.movie_id, self.worker_id, [doc['frame_num'] for doc in docs])
+
+
+class LeaseHeartbeat:
+    """
+    Renews the lease of a claimed movie every `interval` seconds (a third of the lease by default) on a daemon
+    thread while the movie is fused, so a run that writes nothing for a while (a long prefetch, frames that are all
+    reused or have no candidates) keeps its lease. `lost` is set when another worker claimed the movie.
+        with job_queue.heartbeat(movie_id, worker_id) as heartbeat:
+            ...
+    """
+    def __init__(self, job_queue, movie_id, worker_id, interval=None):
+        self.job_queue = job_queue
+        self.movie_id = movie_id
+        self.worker_id = worker_id
+        self.interval = interval if interval is not None else job_queue.lease_seconds / 3
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="fusion-lease", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.job_queue.renew(self.movie_id, self.worker_id)
+            except LeaseLostError:
+                logger.warning("Lost the lease of Movie ID %s", self.movie_id)
+                self.lost = True
+                return
+            except sqlite3.Error:
+                # The queue is busy, renew on the next beat: the lease outlasts a few of them.
+                logger.warning("Could not renew the lease of Movie ID %s", self.movie_id, exc_info=True)
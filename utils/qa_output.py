@@ -0,0 +1,229 @@
+import abc
+import collections
+import json
+import os
+
+import cv2
+import numpy as np
+
+from utils.frame_renderer import get_frame_renderer, IMAGES_DIR
+from utils.fusion_logging import get_logger
+
+QA_OUTPUT_MODES = ('frames', 'video', 'contact_sheet')
+# 'frames' writes a frame_<num>.jpg and a frame_<num>.txt per matched frame,
+# 'video' one qa.mp4 per movie and 'contact_sheet' tiled contact_sheet_<num>.jpg images,
+# both with the per-frame IoU data in one qa_frames.jsonl sidecar.
+FUSION_QA_OUTPUT = os.environ.get("FUSION_QA_OUTPUT", "frames")
+# Only every k-th matched frame is rendered, the sidecar still has all of them.
+FUSION_QA_SAMPLE_EVERY = int(os.environ.get("FUSION_QA_SAMPLE_EVERY", 1))
+QA_SIDECAR_NAME = "qa_frames.jsonl"
+QA_VIDEO_NAME = "qa.mp4"
+QA_VIDEO_FOURCC = "mp4v"
+QA_VIDEO_FPS = 2
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_ROWS = 4
+CONTACT_SHEET_TILE_WIDTH = 480
+# Rendered frames waiting to be written in order, bounds the memory of the video and contact sheet outputs.
+QA_MAX_PENDING_FRAMES = 32
+
+logger = get_logger("qa_output")
+
+
+def _label_frame(image, frame_num):
+    cv2.putText(image, "frame {}".format(frame_num), (10, 30), 0, 1, [225, 255, 255], thickness=2,
+                lineType=cv2.LINE_AA)
+    return image
+
+
+class QAOutput(abc.ABC):
+    """
+    The QA output of a movie, frames are added in order with `add_frame` and the output is complete after `close`.
+    """
+    def __init__(self, movie_name, images_dir=IMAGES_DIR, sample_every=FUSION_QA_SAMPLE_EVERY, renderer=None):
+        self.movie_name = movie_name
+        self.movie_dir = os.path.join(images_dir, movie_name)
+        os.makedirs(self.movie_dir, exist_ok=True)
+        self.sample_every = max(1, sample_every)
+        self.renderer = renderer or get_frame_renderer()
+        self.num_frames = 0
+        self.num_rendered = 0
+
+    def add_frame(self, frame_num, image_url, bbox_details, ious):
+        render = self.num_frames % self.sample_every == 0
+        self.num_frames += 1
+        self.write_frame_data(frame_num, image_url, bbox_details, ious, render)
+        if render:
+            self.num_rendered += 1
+            self.render(frame_num, image_url, bbox_details)
+
+    @abc.abstractmethod
+    def write_frame_data(self, frame_num, image_url, bbox_details, ious, rendered):
+        pass
+
+    @abc.abstractmethod
+    def render(self, frame_num, image_url, bbox_details):
+        pass
+
+    def close(self):
+        logger.debug("QA output of movie %s: %d of %d frames rendered", self.movie_name, self.num_rendered,
+                     self.num_frames)
+
+
+class FramesQAOutput(QAOutput):
+    """
+    A frame_<num>.jpg and a frame_<num>.txt (the IoUs) per matched frame.
+    """
+    def write_frame_data(self, frame_num, image_url, bbox_details, ious, rendered):
+        if not rendered:
+            return
+        with open(os.path.join(self.movie_dir, "frame_{}.txt".format(frame_num)), 'w+') as f:
+            for iou_data in ious:
+                f.write("-------- IOUs Frame Number: {} -------\n".format(str(frame_num)))
+                f.write("VC_ID: {}\n".format(iou_data['vc_id']))
+                f.write("FACE_ID: {}\n".format(iou_data['face_id']))
+                f.write("VC_BBOX: {}\n".format(iou_data['vc_bbox']))
+                f.write("FACE_BBOX: {}\n".format(iou_data['reid_bbox']))
+                f.write("IOU: {}\n".format(iou_data['iou']))
+
+    def render(self, frame_num, image_url, bbox_details):
+        self.renderer.submit(bbox_details, image_url, frame_num, self.movie_name)
+
+    def close(self):
+        self.renderer.wait()
+        super().close()
+
+
+class _StreamedQAOutput(QAOutput):
+    """
+    Writes the IoUs to the JSONL sidecar and the rendered frames, in frame order, to `write_image`.
+    The frames are drawn on the renderer pool, at most QA_MAX_PENDING_FRAMES ahead of the writer.
+    """
+    def __init__(self, movie_name, images_dir=IMAGES_DIR, sample_every=FUSION_QA_SAMPLE_EVERY, renderer=None):
+        super().__init__(movie_name, images_dir=images_dir, sample_every=sample_every, renderer=renderer)
+        self.sidecar = open(os.path.join(self.movie_dir, QA_SIDECAR_NAME), 'w')
+        self.pending = collections.deque()
+
+    def write_frame_data(self, frame_num, image_url, bbox_details, ious, rendered):
+        record = {
+            'frame_num': frame_num,
+            'image_url': image_url,
+            'rendered': rendered,
+            'matches': [{'face_id': match['face_id'], 'vc_id': match['vc_id'], 'reid_bbox': match['reid_bbox'],
+                         'vc_bbox': match['vc_bbox']} for match in bbox_details],
+            'ious': ious,
+        }
+        self.sidecar.write(json.dumps(record, default=str) + "\n")
+
+    def render(self, frame_num, image_url, bbox_details):
+        self.pending.append((frame_num, self.renderer.submit_draw(bbox_details, image_url, frame_num)))
+        while len(self.pending) > QA_MAX_PENDING_FRAMES:
+            self.write_next()
+
+    def write_next(self):
+        frame_num, future = self.pending.popleft()
+        try:
+            image = future.result()
+        except Exception:
+            logger.exception("Failed to render frame %s of movie %s", frame_num, self.movie_name)
+            return
+        self.write_image(frame_num, _label_frame(image, frame_num))
+
+    @abc.abstractmethod
+    def write_image(self, frame_num, image):
+        pass
+
+    def close(self):
+        while self.pending:
+            self.write_next()
+        self.sidecar.close()
+        super().close()
+
+
+class VideoQAOutput(_StreamedQAOutput):
+    """
+    One qa.mp4 per movie, at QA_VIDEO_FPS frames per second. Frames are resized to the size of the first one.
+    When the video cannot be opened its frames are dropped, the sidecar is still written.
+    """
+    def __init__(self, movie_name, images_dir=IMAGES_DIR, sample_every=FUSION_QA_SAMPLE_EVERY, renderer=None,
+                 fps=QA_VIDEO_FPS):
+        super().__init__(movie_name, images_dir=images_dir, sample_every=sample_every, renderer=renderer)
+        self.fps = fps
+        self.video_path = os.path.join(self.movie_dir, QA_VIDEO_NAME)
+        self.video_writer = None
+        self.frame_size = None
+        self.num_dropped = 0
+
+    def write_image(self, frame_num, image):
+        if self.num_dropped:
+            self.num_dropped += 1
+            return
+        if self.video_writer is None:
+            frame_size = (image.shape[1], image.shape[0])
+            video_writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*QA_VIDEO_FOURCC), self.fps,
+                                           frame_size)
+            if not video_writer.isOpened():
+                logger.error("Could not open the QA video %s, dropping the frames of movie %s from frame %s",
+                             self.video_path, self.movie_name, frame_num)
+                self.num_dropped += 1
+                return
+            self.video_writer, self.frame_size = video_writer, frame_size
+        if (image.shape[1], image.shape[0]) != self.frame_size:
+            image = cv2.resize(image, self.frame_size)
+        self.video_writer.write(image)
+
+    def close(self):
+        super().close()
+        if self.video_writer is not None:
+            self.video_writer.release()
+        if self.num_dropped:
+            logger.warning("QA video of movie %s: dropped %d frames", self.movie_name, self.num_dropped)
+
+
+class ContactSheetQAOutput(_StreamedQAOutput):
+    """
+    Tiles of CONTACT_SHEET_COLUMNS x CONTACT_SHEET_ROWS frames per contact_sheet_<num>.jpg.
+    The tiles keep the aspect ratio of the first frame.
+    """
+    def __init__(self, movie_name, images_dir=IMAGES_DIR, sample_every=FUSION_QA_SAMPLE_EVERY, renderer=None,
+                 columns=CONTACT_SHEET_COLUMNS, rows=CONTACT_SHEET_ROWS, tile_width=CONTACT_SHEET_TILE_WIDTH):
+        super().__init__(movie_name, images_dir=images_dir, sample_every=sample_every, renderer=renderer)
+        self.columns = columns
+        self.rows = rows
+        self.tile_size = None
+        self.tile_width = tile_width
+        self.tiles = []
+        self.num_sheets = 0
+
+    def write_image(self, frame_num, image):
+        if self.tile_size is None:
+            self.tile_size = (self.tile_width, max(1, int(round(image.shape[0] * self.tile_width / image.shape[1]))))
+        self.tiles.append(cv2.resize(image, self.tile_size))
+        if len(self.tiles) == self.columns * self.rows:
+            self.write_sheet()
+
+    def write_sheet(self):
+        blank = np.zeros_like(self.tiles[0])
+        tiles = self.tiles + [blank] * (self.columns * self.rows - len(self.tiles))
+        num_rows = (len(self.tiles) + self.columns - 1) // self.columns
+        sheet = np.vstack([np.hstack(tiles[row * self.columns:(row + 1) * self.columns]) for row in range(num_rows)])
+        cv2.imwrite(os.path.join(self.movie_dir, "contact_sheet_{:04d}.jpg".format(self.num_sheets)), sheet)
+        self.num_sheets += 1
+        self.tiles = []
+
+    def close(self):
+        super().close()
+        if self.tiles:
+            self.write_sheet()
+
+
+QA_OUTPUT_CLASSES = {
+    'frames': FramesQAOutput,
+    'video': VideoQAOutput,
+    'contact_sheet': ContactSheetQAOutput,
+}
+
+
+def create_qa_output(movie_name, mode=FUSION_QA_OUTPUT, sample_every=FUSION_QA_SAMPLE_EVERY, images_dir=IMAGES_DIR):
+    if mode not in QA_OUTPUT_CLASSES:
+        raise ValueError("Unknown QA output mode: {}, expected one of {}".format(mode, QA_OUTPUT_MODES))
+    return QA_OUTPUT_CLASSES[mode](movie_name, images_dir=images_dir, sample_every=sample_every)
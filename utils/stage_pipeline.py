@@ -0,0 +1,55 @@
+import queue
+import threading
+
+STAGE_PUT_TIMEOUT = 0.1
+
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+def bounded_stage(iterable, maxsize):
+    """
+    Runs the `iterable` stage on a background thread and yields its items through a queue of `maxsize` items.
+    The producing stage runs at most `maxsize` items ahead of the consuming one, so the items held in memory
+    depend on the window size and not on the total number of items.
+    An exception raised by the producing stage is re-raised to the consumer. Closing the returned generator
+    stops the producing thread.
+    """
+    items = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=STAGE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_StageError(e))
+
+    thread = threading.Thread(target=produce, name="fusion-stage", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()